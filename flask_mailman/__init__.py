@@ -1,12 +1,15 @@
 """
 Tools for sending email.
 """
+import threading
 import types
 import typing as t
 from importlib import import_module
 
 from flask import current_app
 
+from flask_mailman.cli import mailman_cli
+from flask_mailman.sendqueue import SendQueue
 from flask_mailman.utils import DNS_NAME, CachedDnsName
 
 from .message import (
@@ -14,6 +17,7 @@ from .message import (
     BadHeaderError,
     EmailMessage,
     EmailMultiAlternatives,
+    MailMerge,
     SafeMIMEMultipart,
     SafeMIMEText,
     forbid_multi_line_headers,
@@ -28,6 +32,7 @@ __all__ = [
     'DNS_NAME',
     'EmailMessage',
     'EmailMultiAlternatives',
+    'MailMerge',
     'SafeMIMEText',
     'SafeMIMEMultipart',
     'DEFAULT_ATTACHMENT_MIME_TYPE',
@@ -38,7 +43,7 @@ __all__ = [
 ]
 
 
-available_backends = ['console', 'dummy', 'file', 'smtp', 'locmem']
+available_backends = ['console', 'dummy', 'file', 'smtp', 'smtp_pool', 'asyncsmtp', 'spool', 'locmem']
 
 
 class _MailMixin(object):
@@ -130,6 +135,45 @@ class _MailMixin(object):
 
         return klass(mailman=mailman, fail_silently=fail_silently, **kwds)
 
+    def get_send_queue(self):
+        """Return the application's background send queue, creating it if needed."""
+        app = getattr(self, "app", None) or current_app._get_current_object()
+        try:
+            mailman = app.extensions['mailman']
+        except KeyError:
+            raise RuntimeError("The current application was not configured with Flask-Mailman")
+
+        return mailman.get_shared(
+            'send_queue',
+            lambda: SendQueue(
+                app,
+                maxsize=mailman.queue_maxsize,
+                workers=mailman.queue_workers,
+                batch_size=mailman.queue_batch_size,
+                full_policy=mailman.queue_full_policy,
+                put_timeout=mailman.queue_put_timeout,
+                idle_timeout=mailman.queue_idle_timeout,
+                backend=mailman.queue_backend,
+            ),
+        )
+
+    def enqueue(self, message):
+        """
+        Queue an EmailMessage to be sent by the background workers instead of
+        sending it from the current thread. Return whether it was queued.
+        """
+        if not message.recipients():
+            return False
+        return self.get_send_queue().put(message)
+
+    def shutdown_queue(self, wait=True, timeout=None):
+        """Send the queued messages and stop the background workers."""
+        app = getattr(self, "app", None) or current_app
+        mailman = app.extensions['mailman']
+        send_queue = mailman.reset_shared('send_queue')
+        if send_queue is not None:
+            send_queue.shutdown(wait=wait, timeout=timeout)
+
     def send_mail(
         self,
         subject,
@@ -160,6 +204,33 @@ class _MailMixin(object):
 
         return mail.send()
 
+    async def send_mail_async(
+        self,
+        subject,
+        message,
+        from_email=None,
+        recipient_list=None,
+        fail_silently=False,
+        auth_user=None,
+        auth_password=None,
+        connection=None,
+        html_message=None,
+    ):
+        """
+        Coroutine counterpart of send_mail(). The message is sent natively
+        with the asyncsmtp backend, or in a worker thread with other backends.
+        """
+        connection = connection or self.get_connection(
+            username=auth_user,
+            password=auth_password,
+            fail_silently=fail_silently,
+        )
+        mail = EmailMultiAlternatives(subject, message, from_email, recipient_list, connection=connection)
+        if html_message:
+            mail.attach_alternative(html_message, 'text/html')
+
+        return await mail.send_async()
+
     def send_mass_mail(self, datatuple, fail_silently=False, auth_user=None, auth_password=None, connection=None):
         """
         Given a datatuple of (subject, message, from_email, recipient_list), send
@@ -188,6 +259,9 @@ class _MailMixin(object):
 class _Mail(_MailMixin):
     """Initialize a state instance with all configs and methods"""
 
+    # Guards the creation of the shared objects of every state instance.
+    _shared_lock = threading.Lock()
+
     def __init__(
         self,
         server,
@@ -205,6 +279,49 @@ class _Mail(_MailMixin):
         default_charset,
         mail_options,
         backend,
+        pool_min_size=0,
+        pool_max_size=10,
+        pool_max_idle=60,
+        pool_max_age=None,
+        pool_timeout=None,
+        smtp_concurrency=1,
+        smtp_concurrency_max=None,
+        smtp_latency_target=None,
+        smtp_retries=0,
+        smtp_retry_backoff=0.5,
+        smtp_retry_backoff_max=30,
+        max_messages_per_connection=None,
+        max_bytes_per_connection=None,
+        max_recipients_per_transaction=None,
+        bdat_chunk_size=1024 * 1024,
+        stream_threshold=1024 * 1024,
+        use_smtputf8=False,
+        attachment_cache_size=16 * 1024 * 1024,
+        queue_maxsize=1000,
+        queue_workers=1,
+        queue_batch_size=100,
+        queue_full_policy='block',
+        queue_put_timeout=None,
+        queue_idle_timeout=30,
+        queue_backend=None,
+        spool_path=None,
+        spool_backend='smtp',
+        spool_fsync=True,
+        spool_max_failures=10,
+        spool_retry_delay=60,
+        refused_retries=0,
+        refused_retry_delay=300,
+        relays=None,
+        relay_strategy='round_robin',
+        relay_eject_time=30,
+        circuit_breaker_threshold=None,
+        circuit_breaker_cooldown=30,
+        circuit_breaker_fallback=None,
+        rate_limit=None,
+        rate_limit_burst=None,
+        rate_limit_per_host=False,
+        domain_concurrency=None,
+        domain_rate_limit=None,
     ):
         self.server = server
         self.port = port
@@ -221,6 +338,94 @@ class _Mail(_MailMixin):
         self.default_charset = default_charset
         self.mail_options = mail_options
         self.backend = backend
+        self.pool_min_size = pool_min_size
+        self.pool_max_size = pool_max_size
+        self.pool_max_idle = pool_max_idle
+        self.pool_max_age = pool_max_age
+        self.pool_timeout = pool_timeout
+        self.smtp_concurrency = smtp_concurrency
+        self.smtp_concurrency_max = smtp_concurrency_max
+        self.smtp_latency_target = smtp_latency_target
+        self.smtp_retries = smtp_retries
+        self.smtp_retry_backoff = smtp_retry_backoff
+        self.smtp_retry_backoff_max = smtp_retry_backoff_max
+        self.max_messages_per_connection = max_messages_per_connection
+        self.max_bytes_per_connection = max_bytes_per_connection
+        self.max_recipients_per_transaction = max_recipients_per_transaction
+        self.bdat_chunk_size = bdat_chunk_size
+        self.stream_threshold = stream_threshold
+        self.use_smtputf8 = use_smtputf8
+        self.attachment_cache_size = attachment_cache_size
+        self.queue_maxsize = queue_maxsize
+        self.queue_workers = queue_workers
+        self.queue_batch_size = queue_batch_size
+        self.queue_full_policy = queue_full_policy
+        self.queue_put_timeout = queue_put_timeout
+        self.queue_idle_timeout = queue_idle_timeout
+        self.queue_backend = queue_backend
+        self.spool_path = spool_path
+        self.spool_backend = spool_backend
+        self.spool_fsync = spool_fsync
+        self.spool_max_failures = spool_max_failures
+        self.spool_retry_delay = spool_retry_delay
+        self.refused_retries = refused_retries
+        self.refused_retry_delay = refused_retry_delay
+        self.relays = relays
+        self.relay_strategy = relay_strategy
+        self.relay_eject_time = relay_eject_time
+        self.circuit_breaker_threshold = circuit_breaker_threshold
+        self.circuit_breaker_cooldown = circuit_breaker_cooldown
+        self.circuit_breaker_fallback = circuit_breaker_fallback
+        self.rate_limit = rate_limit
+        self.rate_limit_burst = rate_limit_burst
+        self.rate_limit_per_host = rate_limit_per_host
+        self.domain_concurrency = domain_concurrency
+        self.domain_rate_limit = domain_rate_limit
+
+        # Created on first use and shared by every backend instance and thread
+        # of the process, see get_shared() and get_shared_item().
+        self.smtp_pools = {}
+        self.ssl_contexts = {}
+        self.relay_set = None
+        self.circuit_breakers = {}
+        self.rate_limiters = {}
+        self.domain_rate_limiters = {}
+        self.concurrency_controllers = {}
+        self.attachment_cache = None
+        self.send_queue = None
+
+    def get_shared(self, name, factory):
+        """Return the ``name`` attribute, setting it to ``factory()`` first if it is None."""
+        with self._shared_lock:
+            value = getattr(self, name)
+            if value is None:
+                value = factory()
+                setattr(self, name, value)
+            return value
+
+    def get_shared_item(self, name, key, factory):
+        """Return ``key`` of the ``name`` dict, setting it to ``factory()`` first if it is missing."""
+        with self._shared_lock:
+            items = getattr(self, name)
+            value = items.get(key)
+            if value is None:
+                value = items[key] = factory()
+            return value
+
+    def reset_shared(self, name):
+        """Set the ``name`` attribute back to None and return its previous value."""
+        with self._shared_lock:
+            value = getattr(self, name)
+            setattr(self, name, None)
+            return value
+
+    def close_pools(self):
+        """Close the idle connections of every SMTP connection pool."""
+        with self._shared_lock:
+            pools = list(self.smtp_pools.values())
+            self.smtp_pools.clear()
+        for pool in pools:
+            pool.close()
 
 
 class Mail(_MailMixin):
@@ -259,6 +464,49 @@ class Mail(_MailMixin):
             config.get('MAIL_DEFAULT_CHARSET', 'utf-8'),
             config.get('MAIL_SEND_OPTIONS', []),
             mail_backend,
+            pool_min_size=config.get('MAIL_POOL_MIN_SIZE', 0),
+            pool_max_size=config.get('MAIL_POOL_MAX_SIZE', 10),
+            pool_max_idle=config.get('MAIL_POOL_MAX_IDLE', 60),
+            pool_max_age=config.get('MAIL_POOL_MAX_AGE'),
+            pool_timeout=config.get('MAIL_POOL_TIMEOUT'),
+            smtp_concurrency=config.get('MAIL_SMTP_CONCURRENCY', 1),
+            smtp_concurrency_max=config.get('MAIL_SMTP_CONCURRENCY_MAX'),
+            smtp_latency_target=config.get('MAIL_SMTP_LATENCY_TARGET'),
+            smtp_retries=config.get('MAIL_SMTP_RETRIES', 0),
+            smtp_retry_backoff=config.get('MAIL_SMTP_RETRY_BACKOFF', 0.5),
+            smtp_retry_backoff_max=config.get('MAIL_SMTP_RETRY_BACKOFF_MAX', 30),
+            max_messages_per_connection=config.get('MAIL_MAX_MESSAGES_PER_CONNECTION'),
+            max_bytes_per_connection=config.get('MAIL_MAX_BYTES_PER_CONNECTION'),
+            max_recipients_per_transaction=config.get('MAIL_MAX_RECIPIENTS_PER_TRANSACTION'),
+            bdat_chunk_size=config.get('MAIL_BDAT_CHUNK_SIZE', 1024 * 1024),
+            stream_threshold=config.get('MAIL_STREAM_THRESHOLD', 1024 * 1024),
+            use_smtputf8=config.get('MAIL_USE_SMTPUTF8', False),
+            attachment_cache_size=config.get('MAIL_ATTACHMENT_CACHE_SIZE', 16 * 1024 * 1024),
+            queue_maxsize=config.get('MAIL_QUEUE_MAXSIZE', 1000),
+            queue_workers=config.get('MAIL_QUEUE_WORKERS', 1),
+            queue_batch_size=config.get('MAIL_QUEUE_BATCH_SIZE', 100),
+            queue_full_policy=config.get('MAIL_QUEUE_FULL_POLICY', 'block'),
+            queue_put_timeout=config.get('MAIL_QUEUE_PUT_TIMEOUT'),
+            queue_idle_timeout=config.get('MAIL_QUEUE_IDLE_TIMEOUT', 30),
+            queue_backend=config.get('MAIL_QUEUE_BACKEND'),
+            spool_path=config.get('MAIL_SPOOL_PATH'),
+            spool_backend=config.get('MAIL_SPOOL_BACKEND', 'smtp'),
+            spool_fsync=config.get('MAIL_SPOOL_FSYNC', True),
+            spool_max_failures=config.get('MAIL_SPOOL_MAX_FAILURES', 10),
+            spool_retry_delay=config.get('MAIL_SPOOL_RETRY_DELAY', 60),
+            refused_retries=config.get('MAIL_REFUSED_RETRIES', 0),
+            refused_retry_delay=config.get('MAIL_REFUSED_RETRY_DELAY', 300),
+            relays=config.get('MAIL_RELAYS'),
+            relay_strategy=config.get('MAIL_RELAY_STRATEGY', 'round_robin'),
+            relay_eject_time=config.get('MAIL_RELAY_EJECT_TIME', 30),
+            circuit_breaker_threshold=config.get('MAIL_CIRCUIT_BREAKER_THRESHOLD'),
+            circuit_breaker_cooldown=config.get('MAIL_CIRCUIT_BREAKER_COOLDOWN', 30),
+            circuit_breaker_fallback=config.get('MAIL_CIRCUIT_BREAKER_FALLBACK'),
+            rate_limit=config.get('MAIL_RATE_LIMIT'),
+            rate_limit_burst=config.get('MAIL_RATE_LIMIT_BURST'),
+            rate_limit_per_host=config.get('MAIL_RATE_LIMIT_PER_HOST', False),
+            domain_concurrency=config.get('MAIL_DOMAIN_CONCURRENCY'),
+            domain_rate_limit=config.get('MAIL_DOMAIN_RATE_LIMIT'),
         )
 
     def init_app(self, app):
@@ -274,6 +522,7 @@ class Mail(_MailMixin):
         # register extension with app
         app.extensions = getattr(app, 'extensions', {})
         app.extensions['mailman'] = state
+        app.cli.add_command(mailman_cli)
         return state
 
     def __getattr__(self, name):
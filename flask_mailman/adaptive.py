@@ -0,0 +1,101 @@
+"""
+Adapting the number of SMTP connections to how the server copes.
+"""
+import threading
+
+
+class AdaptiveConcurrency:
+    """
+    A thread-safe AIMD (additive increase, multiplicative decrease) limit on
+    the number of connections open at once to a mail server.
+
+    Every transaction reports its latency and whether the server pushed back
+    (a temporary failure, a lost connection, or a latency above
+    ``latency_target``). The limit grows by one after ``limit`` transactions
+    in a row went well, and is multiplied by ``backoff`` when the server
+    pushes back, at most once per ``limit`` transactions so the failures of
+    the transactions already in flight don't collapse it.
+    """
+
+    def __init__(self, initial=1, minimum=1, maximum=10, latency_target=None, backoff=0.5):
+        if not 1 <= minimum <= maximum:
+            raise ValueError('The limits must satisfy 1 <= minimum <= maximum.')
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._limit = min(max(initial, minimum), maximum)
+        self._in_use = 0
+        self._successes = 0
+        self._since_decrease = self._limit
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def limit(self):
+        """The current number of connections allowed."""
+        return self._limit
+
+    @property
+    def in_use(self):
+        """The number of connections currently open."""
+        return self._in_use
+
+    def acquire(self):
+        """Block until a connection may be opened."""
+        with self._cond:
+            while self._in_use >= self._limit:
+                self._cond.wait()
+            self._in_use += 1
+
+    def release(self):
+        """Report that a connection was closed."""
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def release_if_over_limit(self):
+        """
+        Release the caller's connection, and return True, if more
+        connections are open than the limit allows.
+        """
+        with self._cond:
+            if self._in_use <= self._limit:
+                return False
+            self._in_use -= 1
+            return True
+
+    def record(self, latency, pushed_back=False):
+        """Adjust the limit after a transaction that took ``latency`` seconds."""
+        if self.latency_target is not None and latency > self.latency_target:
+            pushed_back = True
+        with self._cond:
+            self._since_decrease += 1
+            if pushed_back:
+                self._successes = 0
+                if self._since_decrease >= self._limit:
+                    self._limit = max(self.minimum, int(self._limit * self.backoff))
+                    self._since_decrease = 0
+                return
+            self._successes += 1
+            if self._successes >= self._limit and self._limit < self.maximum:
+                self._limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+
+def get_concurrency_controller(mailman, key):
+    """
+    Return the AdaptiveConcurrency of the mail server identified by ``key``,
+    or None if MAIL_SMTP_CONCURRENCY_MAX isn't set.
+    """
+    if not mailman.smtp_concurrency_max:
+        return None
+    return mailman.get_shared_item(
+        'concurrency_controllers',
+        key,
+        lambda: AdaptiveConcurrency(
+            initial=mailman.smtp_concurrency,
+            maximum=mailman.smtp_concurrency_max,
+            latency_target=mailman.smtp_latency_target,
+        ),
+    )
@@ -0,0 +1,197 @@
+"""
+Encoding identical attachments only once, and file attachments only when
+they're sent.
+"""
+import base64
+import hashlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from email import encoders
+from email.mime.base import MIMEBase
+
+# base64 encodes each 57 bytes of content to a line of 76 characters.
+_LINE_SIZE = 57
+
+# Size of the chunks file attachments are read and encoded in, a multiple of
+# _LINE_SIZE so that the encoded chunks end on a line break.
+CHUNK_SIZE = _LINE_SIZE * 1024
+
+
+class EncodedAttachmentCache:
+    """
+    A thread-safe LRU cache of base64-encoded attachment payloads, keyed by
+    the SHA-256 digest of their content, holding at most ``max_size``
+    characters of payloads.
+
+    Hashing the content is much cheaper than encoding it, and the messages
+    sharing an attachment share its encoded payload in memory.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # Total length of the cached payloads.
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._payloads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._payloads)
+
+    def encode_base64(self, content):
+        """Return ``content`` encoded like email.encoders.encode_base64() does."""
+        key = hashlib.sha256(content).digest()
+        with self._lock:
+            payload = self._payloads.get(key)
+            if payload is not None:
+                self._payloads.move_to_end(key)
+                self.hits += 1
+                return payload
+            self.misses += 1
+        payload = str(encoders._bencode(content), 'ascii')
+        if len(payload) > self.max_size:
+            return payload
+        with self._lock:
+            if key not in self._payloads:
+                self._payloads[key] = payload
+                self.size += len(payload)
+                while self.size > self.max_size:
+                    key, evicted = self._payloads.popitem(last=False)
+                    self.size -= len(evicted)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._payloads.clear()
+            self.size = 0
+
+
+class FileContent:
+    """
+    The content of a file attachment, read from ``file`` -- a path or a
+    binary file object, read from its current position -- only when the
+    message is serialized, so that it isn't held in memory until then.
+    """
+
+    def __init__(self, file):
+        if isinstance(file, (str, os.PathLike)):
+            self.path = os.fspath(file)
+            self.file = None
+            self.start = 0
+        else:
+            self.path = None
+            self.file = file
+            self.start = file.tell()
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.path or self.file)
+
+    def size(self):
+        """Return the size of the content in bytes."""
+        if self.path is not None:
+            return os.path.getsize(self.path)
+        return self.file.seek(0, os.SEEK_END) - self.start
+
+    def encoded_size(self, linesep='\n'):
+        """Return the length of the base64-encoded content, line breaks included."""
+        size = self.size()
+        return -(-size // 3) * 4 + -(-size // _LINE_SIZE) * len(linesep)
+
+    @contextmanager
+    def _open(self):
+        if self.path is None:
+            self.file.seek(self.start)
+            yield self.file
+        else:
+            with open(self.path, 'rb') as file:
+                yield file
+
+    def iter_base64(self, chunk_size=CHUNK_SIZE):
+        """
+        Yield the content encoded like email.encoders.encode_base64() does, in
+        chunks of ``chunk_size`` bytes of content, which must be a multiple
+        of 57 bytes.
+        """
+        with self._open() as file:
+            chunk = file.read(chunk_size)
+            while chunk:
+                next_chunk = file.read(chunk_size)
+                # Only the last chunk may end without a line break.
+                encode = base64.encodebytes if next_chunk else encoders._bencode
+                yield str(encode(chunk), 'ascii')
+                chunk = next_chunk
+
+    def encode_base64(self):
+        """Return the whole content encoded like email.encoders.encode_base64() does."""
+        if self.path is not None:
+            # Encode the file mapped in memory rather than a copy of it.
+            with open(self.path, 'rb') as file:
+                try:
+                    content = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    # The file is empty or can't be mapped.
+                    pass
+                else:
+                    with content:
+                        return str(encoders._bencode(content), 'ascii')
+        return ''.join(self.iter_base64())
+
+
+class MIMEFile(MIMEBase):
+    """
+    A base64-encoded MIME part whose payload is encoded from a FileContent
+    every time it's needed instead of being stored. The StreamingGenerator
+    writes it chunk by chunk.
+    """
+
+    def __init__(self, _maintype, _subtype, file_content, **_params):
+        self.file_content = file_content
+        super().__init__(_maintype, _subtype, **_params)
+        self['Content-Transfer-Encoding'] = 'base64'
+
+    @property
+    def _payload(self):
+        payload = self.__dict__.get('_stored_payload')
+        if payload is None:
+            return self.__dict__.get('_encoded_payload') or self.file_content.encode_base64()
+        return payload
+
+    @_payload.setter
+    def _payload(self, payload):
+        # Message.__init__() sets it to None, set_payload() replaces the file.
+        self.__dict__['_stored_payload'] = payload
+
+    @contextmanager
+    def encoded(self):
+        """
+        Encode the file once and return the same payload every time it's read
+        within the block, e.g. while the message is flattened.
+        """
+        self.__dict__['_encoded_payload'] = self.file_content.encode_base64()
+        try:
+            yield
+        finally:
+            self.__dict__.pop('_encoded_payload', None)
+
+    @property
+    def is_lazy(self):
+        """Whether the payload is still read from the file."""
+        return self.__dict__.get('_stored_payload') is None
+
+    def is_multipart(self):
+        return isinstance(self.__dict__.get('_stored_payload'), list)
+
+
+def get_attachment_cache(mailman):
+    """
+    Return the EncodedAttachmentCache of the mail state, or None if
+    MAIL_ATTACHMENT_CACHE_SIZE isn't set.
+    """
+    if not mailman.attachment_cache_size:
+        return None
+    return mailman.get_shared('attachment_cache', lambda: EncodedAttachmentCache(mailman.attachment_cache_size))
@@ -0,0 +1,578 @@
+"""SMTP email backend built on asyncio streams."""
+import asyncio
+import base64
+import hmac
+import smtplib
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from flask_mailman.backends.smtp import DeliveryResult
+from flask_mailman.backends.smtp import EmailBackend as SMTPEmailBackend
+from flask_mailman.backends.smtp import (
+    MessageTooLarge,
+    SMTPUTF8NotSupported,
+    _check_size,
+    _connection_relays,
+    _connection_usage,
+    _format_options,
+    _is_disconnection,
+    _quote_periods,
+    _with_smtputf8,
+)
+from flask_mailman.backends.spool import RecipientsDeferred
+from flask_mailman.message import sanitize_address
+from flask_mailman.utils import DNS_NAME
+
+CRLF = '\r\n'
+
+
+class AsyncSMTP:
+    """
+    A small SMTP client for asyncio streams.
+
+    It implements the subset of smtplib.SMTP used by the email backends
+    (EHLO, STARTTLS, AUTH, mail transactions, NOOP, RSET and QUIT) and raises
+    the same smtplib exceptions.
+    """
+
+    def __init__(self, host, port, local_hostname=None, timeout=None, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.local_hostname = local_hostname or DNS_NAME.get_fqdn()
+        self.timeout = timeout
+        # Implicit TLS, like smtplib.SMTP_SSL, when an SSL context is given.
+        self.ssl_context = ssl_context
+        self.command_encoding = 'ascii'
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        self.ehlo_resp = None
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        """Connect to the server and read its greeting."""
+        kwargs = {}
+        if self.ssl_context is not None:
+            kwargs = {'ssl': self.ssl_context, 'server_hostname': self.host}
+        self.reader, self.writer = await self._wait(asyncio.open_connection(self.host, self.port, **kwargs))
+        code, msg = await self.getreply()
+        if code != 220:
+            await self.close()
+            raise smtplib.SMTPConnectError(code, msg)
+        return code, msg
+
+    async def _wait(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise TimeoutError('SMTP operation timed out') from None
+
+    async def send(self, data):
+        """Write a string or bytes to the server."""
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        if isinstance(data, str):
+            data = data.encode(self.command_encoding)
+        self.writer.write(data)
+        await self._wait(self.writer.drain())
+
+    async def getreply(self):
+        """Read a (possibly multi-line) reply and return (code, message)."""
+        lines = []
+        code = -1
+        while True:
+            line = await self._wait(self.reader.readline())
+            if not line:
+                await self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip(b' \t\r\n'))
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+                break
+            if line[3:4] != b'-':
+                break
+        return code, b'\n'.join(lines)
+
+    async def docmd(self, cmd, args=''):
+        await self.send('%s %s%s' % (cmd, args, CRLF) if args else '%s%s' % (cmd, CRLF))
+        return await self.getreply()
+
+    async def ehlo(self):
+        self.esmtp_features = {}
+        code, msg = await self.docmd('ehlo', self.local_hostname)
+        self.ehlo_resp = msg
+        if code != 250:
+            return code, msg
+        self.does_esmtp = True
+        for line in msg.decode('latin-1').split('\n')[1:]:
+            feature, _, params = line.partition(' ')
+            feature = feature.lower()
+            if feature == 'auth':
+                self.esmtp_features[feature] = self.esmtp_features.get(feature, '') + ' ' + params
+            elif feature:
+                self.esmtp_features[feature] = params.strip()
+        return code, msg
+
+    async def helo(self):
+        code, msg = await self.docmd('helo', self.local_hostname)
+        self.ehlo_resp = msg
+        return code, msg
+
+    async def ehlo_or_helo_if_needed(self):
+        if self.ehlo_resp is None:
+            code, resp = await self.ehlo()
+            if not 200 <= code <= 299:
+                code, resp = await self.helo()
+                if not 200 <= code <= 299:
+                    raise smtplib.SMTPHeloError(code, resp)
+
+    def has_extn(self, opt):
+        return opt.lower() in self.esmtp_features
+
+    async def starttls(self, context):
+        """Upgrade the connection to TLS (RFC 3207)."""
+        await self.ehlo_or_helo_if_needed()
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server.')
+        code, resp = await self.docmd('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, resp)
+        start_tls = getattr(self.writer, 'start_tls', None)
+        if start_tls is not None:
+            await self._wait(start_tls(context, server_hostname=self.host))
+        else:
+            # Python < 3.11: upgrade the transport by hand, like
+            # StreamWriter.start_tls() does. The stream reader keeps receiving
+            # data through the same protocol, only the writer has to be bound
+            # to the new transport. A new writer would close the old transport
+            # when garbage collected.
+            loop = asyncio.get_running_loop()
+            transport = self.writer.transport
+            protocol = transport.get_protocol()
+            tls_transport = await self._wait(loop.start_tls(transport, protocol, context, server_hostname=self.host))
+            self.writer._transport = tls_transport
+        # RFC 3207: the client must discard the knowledge obtained before TLS.
+        self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        return code, resp
+
+    async def login(self, user, password):
+        await self.ehlo_or_helo_if_needed()
+        if not self.has_extn('auth'):
+            raise smtplib.SMTPNotSupportedError('SMTP AUTH extension not supported by server.')
+        advertised = self.esmtp_features['auth'].split()
+        methods = [method for method in ('CRAM-MD5', 'PLAIN', 'LOGIN') if method in advertised]
+        if not methods:
+            raise smtplib.SMTPException('No suitable authentication method found.')
+        last_exception = None
+        for method in methods:
+            code, resp = await getattr(self, '_auth_' + method.lower().replace('-', '_'))(user, password)
+            # 235 == 'Authentication successful'
+            # 503 == 'Error: already authenticated'
+            if code in (235, 503):
+                return code, resp
+            last_exception = smtplib.SMTPAuthenticationError(code, resp)
+        raise last_exception
+
+    async def _auth_cram_md5(self, user, password):
+        code, resp = await self.docmd('AUTH', 'CRAM-MD5')
+        if code != 334:
+            return code, resp
+        challenge = base64.decodebytes(resp)
+        response = user + ' ' + hmac.HMAC(password.encode('ascii'), challenge, 'md5').hexdigest()
+        return await self.docmd(_b64(response))
+
+    async def _auth_plain(self, user, password):
+        return await self.docmd('AUTH', 'PLAIN ' + _b64('\0%s\0%s' % (user, password)))
+
+    async def _auth_login(self, user, password):
+        code, resp = await self.docmd('AUTH', 'LOGIN ' + _b64(user))
+        if code != 334:
+            return code, resp
+        return await self.docmd(_b64(password))
+
+    async def sendmail(self, from_addr, to_addrs, msg, mail_options=()):
+        """
+        Run a mail transaction and return the refused recipients, like
+        smtplib.SMTP.sendmail(). Commands are pipelined when the server
+        supports PIPELINING (RFC 2920).
+        """
+        await self.ehlo_or_helo_if_needed()
+        _check_size(self, len(msg))
+        esmtp_opts = []
+        if self.does_esmtp:
+            if self.has_extn('size'):
+                esmtp_opts.append('size=%d' % len(msg))
+            esmtp_opts.extend(mail_options)
+        if any(option.lower() == 'smtputf8' for option in esmtp_opts):
+            if not self.has_extn('smtputf8'):
+                raise smtplib.SMTPNotSupportedError('SMTPUTF8 not supported by server')
+            self.command_encoding = 'utf-8'
+        mail_command = 'mail FROM:%s%s' % (smtplib.quoteaddr(from_addr), _format_options(esmtp_opts))
+        rcpt_commands = ['rcpt TO:%s' % smtplib.quoteaddr(addr) for addr in to_addrs]
+
+        if self.has_extn('pipelining'):
+            await self.send(''.join(command + CRLF for command in [mail_command] + rcpt_commands + ['data']))
+            mail_reply = await self.getreply()
+            rcpt_replies = [await self.getreply() for command in rcpt_commands]
+            data_reply = await self.getreply()
+            if data_reply[0] == 354 and (mail_reply[0] != 250 or not _accepted(rcpt_replies)):
+                # The server should have rejected DATA, end the empty message.
+                await self.docmd('.')
+        else:
+            mail_reply = await self.docmd(mail_command)
+            rcpt_replies = []
+            data_reply = None
+            if mail_reply[0] == 250:
+                rcpt_replies = [await self.docmd(command) for command in rcpt_commands]
+                if _accepted(rcpt_replies):
+                    data_reply = await self.docmd('data')
+
+        refused = {addr: reply for addr, reply in zip(to_addrs, rcpt_replies) if reply[0] not in (250, 251)}
+        if mail_reply[0] != 250:
+            await self._abort(mail_reply[0])
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        if not _accepted(rcpt_replies):
+            await self._abort(data_reply[0] if data_reply else None)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_reply[0] != 354:
+            await self._abort(data_reply[0])
+            raise smtplib.SMTPDataError(*data_reply)
+
+        data = _quote_periods(msg)
+        if data[-2:] != b'\r\n':
+            data += b'\r\n'
+        await self.send(data + b'.\r\n')
+        code, resp = await self.getreply()
+        if code != 250:
+            await self._abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    async def _abort(self, code):
+        """Reset the transaction after an error, or drop a closing server."""
+        if code == 421:
+            await self.close()
+        else:
+            try:
+                await self.rset()
+            except smtplib.SMTPServerDisconnected:
+                pass
+
+    async def noop(self):
+        return await self.docmd('noop')
+
+    async def rset(self):
+        self.command_encoding = 'ascii'
+        return await self.docmd('rset')
+
+    async def quit(self):
+        result = await self.docmd('quit')
+        await self.close()
+        return result
+
+    async def close(self):
+        writer, self.writer, self.reader = self.writer, None, None
+        self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+def _b64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def _accepted(rcpt_replies):
+    return any(reply[0] in (250, 251) for reply in rcpt_replies)
+
+
+class EmailBackend(SMTPEmailBackend):
+    """
+    A SMTP backend running on asyncio, so that many messages can be in
+    flight on a single event loop thread.
+
+    Use open_async(), close_async() and send_messages_async() (or ``async
+    with``) from coroutines. The blocking open(), close() and send_messages()
+    keep working by running the coroutines on a private loop owned by the
+    backend, in a worker thread if they're called from a running event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = None
+
+    async def open_async(self):
+        """
+        Ensure an open connection to the email server. Return whether or not a
+        new connection was required (True or False) or None if an exception
+        passed silently.
+        """
+        if self.connection:
+            return False
+        try:
+            self.connection = await self._connect_async()
+            return True
+        except OSError:
+            if not self.fail_silently:
+                raise
+
+    async def _connect_async(self):
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return await self._connect_any_async()
+        breaker.check()
+        try:
+            connection = await self._connect_any_async()
+        except BaseException:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return connection
+
+    async def _connect_any_async(self):
+        if self.relays is None:
+            return await self._connect_async_to(self.host, self.port)
+        error = None
+        for relay in self.relays.candidates():
+            try:
+                connection = await self._connect_async_to(relay.host, relay.port)
+            except OSError as exc:
+                # Fail over to the next relay.
+                self.relays.failed(relay)
+                error = exc
+                continue
+            self.relays.connected(relay, connection)
+            _connection_relays[connection] = (relay.host, relay.port)
+            return connection
+        raise error
+
+    async def _connect_async_to(self, host, port):
+        connection = AsyncSMTP(
+            host,
+            port,
+            local_hostname=DNS_NAME.get_fqdn(),
+            timeout=self.timeout,
+            ssl_context=self.ssl_context if self.use_ssl else None,
+        )
+        await connection.connect()
+        try:
+            if not self.use_ssl and self.use_tls:
+                await connection.starttls(self.ssl_context)
+            if self.username and self.password:
+                await connection.login(self.username, self.password)
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    async def close_async(self):
+        """Close the connection to the email server."""
+        if self.connection is None:
+            return
+        try:
+            try:
+                await self.connection.quit()
+            except (OSError, smtplib.SMTPServerDisconnected):
+                await self.connection.close()
+            except smtplib.SMTPException:
+                if self.fail_silently:
+                    return
+                raise
+        finally:
+            self.connection = None
+
+    async def send_messages_async(self, email_messages):
+        """
+        Send one or more EmailMessage objects and return the number of email
+        messages sent.
+        """
+        if not email_messages:
+            return 0
+        if self._circuit_diverted():
+            return await self._fallback().send_messages_async(email_messages)
+        self.results = []
+        new_conn_created = await self.open_async()
+        if not self.connection or new_conn_created is None:
+            # We failed silently on open().
+            # Trying to send would be pointless.
+            return 0
+        num_sent = 0
+        try:
+            for message in email_messages:
+                sent = await self._send_async(message)
+                if sent:
+                    num_sent += 1
+        finally:
+            if new_conn_created:
+                await self.close_async()
+        return num_sent
+
+    async def _send_async(self, email_message):
+        """A helper method that does the actual sending."""
+        if not email_message.recipients():
+            return False
+        encoding = email_message.encoding or self.mailman.default_charset
+        utf8 = self.mailman.use_smtputf8
+        from_email = sanitize_address(email_message.from_email, encoding, utf8)
+        recipients = [sanitize_address(addr, encoding, utf8) for addr in email_message.recipients()]
+        msg_bytes = email_message.message().as_bytes(linesep='\r\n')
+        try:
+            try:
+                refused = await self._deliver_async(from_email, recipients, msg_bytes)
+            except SMTPUTF8NotSupported:
+                from_email, recipients, message = self._without_smtputf8(email_message, recipients)
+                msg_bytes = message.as_bytes(linesep='\r\n')
+                refused = await self._deliver_async(from_email, recipients, msg_bytes)
+        except smtplib.SMTPRecipientsRefused as exc:
+            result = DeliveryResult.from_refused(email_message, recipients, exc.recipients)
+            self.results.append(result)
+            # Every recipient was refused, some may accept the message later.
+            deferred = self._retry_refused(email_message, from_email, result, msg_bytes)
+            if not self.fail_silently:
+                if deferred:
+                    raise RecipientsDeferred(exc.recipients) from exc
+                raise
+            return False
+        except MessageTooLarge as exc:
+            refused = dict.fromkeys(recipients, (exc.smtp_code, exc.smtp_error))
+            self.results.append(DeliveryResult.from_refused(email_message, recipients, refused))
+            if not self.fail_silently:
+                raise
+            return False
+        except smtplib.SMTPException:
+            if not self.fail_silently:
+                raise
+            return False
+        self._delivered(email_message, from_email, recipients, refused, msg_bytes)
+        return True
+
+    async def _deliver_async(self, from_email, recipients, msg):
+        """
+        Send the message to all its recipients and return the refused ones,
+        in transactions of at most MAIL_MAX_RECIPIENTS_PER_TRANSACTION
+        recipients, like _deliver().
+        """
+        if self._single_transaction(recipients):
+            return await self._transaction_async(from_email, recipients, msg)
+        chunk_size = self.mailman.max_recipients_per_transaction
+        refused = {}
+        for start in range(0, len(recipients), chunk_size):
+            try:
+                refused.update(await self._transaction_async(from_email, recipients[start : start + chunk_size], msg))
+            except smtplib.SMTPRecipientsRefused as exc:
+                # The other chunks may still be accepted.
+                refused.update(exc.recipients)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    async def _transaction_async(self, from_email, recipients, msg):
+        """
+        Run a mail transaction and return the refused recipients, reopening
+        the connection and trying again if it's lost, like _transaction().
+        """
+        attempt = 0
+        while True:
+            try:
+                if attempt or self.connection is None:
+                    await self._reconnect_async()
+                elif self._connection_exhausted(len(msg)):
+                    await self._recycle_async()
+                mail_options = self.mailman.mail_options
+                if self.mailman.use_smtputf8:
+                    await self.connection.ehlo_or_helo_if_needed()
+                    mail_options = _with_smtputf8(self.connection, from_email, recipients, msg, mail_options)
+                rate_limiter = self._connection_rate_limiter()
+                if rate_limiter is not None:
+                    await rate_limiter.acquire_async()
+                refused = await self.connection.sendmail(from_email, recipients, msg, mail_options=mail_options)
+                messages, size = _connection_usage.get(self.connection, (0, 0))
+                _connection_usage[self.connection] = (messages + 1, size + len(msg))
+                return refused
+            except OSError as exc:
+                if attempt < self.max_retries and _is_disconnection(exc):
+                    attempt += 1
+                    await asyncio.sleep(self._retry_delay(attempt))
+                    continue
+                raise
+
+    async def _recycle_async(self):
+        """Close the connection gracefully and open a new one."""
+        connection, self.connection = self.connection, None
+        try:
+            await connection.quit()
+        except (smtplib.SMTPException, OSError):
+            await connection.close()
+        self.connection = await self._connect_async()
+
+    async def _reconnect_async(self):
+        """Replace a dead connection with a new one."""
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            await connection.close()
+        self.connection = await self._connect_async()
+
+    async def __aenter__(self):
+        try:
+            await self.open_async()
+        except Exception:
+            await self.close_async()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close_async()
+
+    def _run(self, coroutine):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self._loop.run_until_complete(coroutine)
+        # A loop is already running in this thread, e.g. in an async view,
+        # and can't run another one. Block on the private loop from a worker
+        # thread instead, like the blocking API does outside of a loop.
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                return self._loop.run_until_complete(coroutine)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(run).result()
+
+    def open(self):
+        return self._run(self.open_async())
+
+    def close(self):
+        if self._loop is None:
+            return
+        try:
+            self._run(self.close_async())
+        finally:
+            self._loop.close()
+            self._loop = None
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        with self._lock:
+            opened = self.connection is not None
+            try:
+                return self._run(self.send_messages_async(email_messages))
+            finally:
+                if not opened:
+                    # Don't leave the private event loop behind.
+                    self.close()
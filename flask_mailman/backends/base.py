@@ -1,4 +1,6 @@
 """Base email backend class."""
+import asyncio
+
 from flask import current_app
 
 
@@ -63,3 +65,20 @@ class BaseEmailBackend:
         messages sent.
         """
         raise NotImplementedError('subclasses of BaseEmailBackend must override send_messages() method')
+
+    async def send_messages_async(self, email_messages):
+        """
+        Send one or more EmailMessage objects from a coroutine and return the
+        number of email messages sent.
+
+        The default implementation runs send_messages() in the event loop's
+        default executor, so it doesn't block the loop. Backends with native
+        asyncio support override it.
+        """
+        app = current_app._get_current_object()
+
+        def send_messages():
+            with app.app_context():
+                return self.send_messages(email_messages)
+
+        return await asyncio.get_running_loop().run_in_executor(None, send_messages)
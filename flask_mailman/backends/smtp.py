@@ -1,14 +1,119 @@
 """SMTP email backend class."""
+import copy
+import random
+import re
 import smtplib
 import ssl
 import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from werkzeug.utils import cached_property
+from flask import current_app
 
+from flask_mailman.adaptive import get_concurrency_controller
+from flask_mailman.attachments import MIMEFile
 from flask_mailman.backends.base import BaseEmailBackend
-from flask_mailman.message import sanitize_address
+from flask_mailman.backends.file import ImproperlyConfigured
+from flask_mailman.backends.spool import RecipientsDeferred, Spool, SpooledMessage
+from flask_mailman.circuitbreaker import get_circuit_breaker
+from flask_mailman.message import MIMEMixin, sanitize_address
+from flask_mailman.ratelimit import get_domain_rate_limiter, get_rate_limiter
+from flask_mailman.relays import get_relay_set
+from flask_mailman.scheduler import DomainScheduler, Transaction, recipient_domain
+from flask_mailman.tls import get_shared_context
 from flask_mailman.utils import DNS_NAME
 
+# Size of the writes of streamed messages after DATA.
+DATA_BUFFER_SIZE = 64 * 1024
+
+# Number of messages and bytes sent so far over each open connection. Kept
+# apart from the connections so the counts follow them in and out of pools.
+_connection_usage = weakref.WeakKeyDictionary()
+
+# The (host, port) of the relay each connection to MAIL_RELAYS was opened to.
+_connection_relays = weakref.WeakKeyDictionary()
+
+
+class MessageTooLarge(smtplib.SMTPResponseException):
+    """
+    The message is larger than the limit the server advertised with SIZE
+    (RFC 1870), so it wasn't sent.
+    """
+
+    def __init__(self, size, limit):
+        self.size = size
+        self.limit = limit
+        super().__init__(552, b'Message size of %d bytes exceeds the server limit of %d bytes' % (size, limit))
+
+
+class SMTPUTF8NotSupported(smtplib.SMTPNotSupportedError):
+    """
+    The message has UTF-8 headers or addresses and the server doesn't
+    support SMTPUTF8 (RFC 6531).
+    """
+
+    pass
+
+
+class StreamedMessage:
+    """
+    A message flattened while it's sent rather than up front, so it's never
+    held in memory as a whole. Its length is an estimate, which is all the
+    SIZE extension (RFC 1870) requires.
+    """
+
+    def __init__(self, message, size):
+        self.message = message
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return self.message.as_bytes(linesep='\r\n')
+
+    def write_to(self, fp):
+        self.message.write_to(fp, linesep='\r\n')
+
+
+class DeliveryResult:
+    """
+    The outcome of a message the server answered for: the recipients it
+    accepted, and those it refused temporarily (4xx replies) or permanently
+    (5xx replies), mapped to the server's (code, message) reply.
+    """
+
+    def __init__(self, message, accepted, temp_refused, perm_refused):
+        self.message = message
+        self.accepted = accepted
+        self.temp_refused = temp_refused
+        self.perm_refused = perm_refused
+
+    @classmethod
+    def from_refused(cls, message, recipients, refused):
+        """Build the result from the refused recipients of sendmail()."""
+        return cls(
+            message,
+            [addr for addr in recipients if addr not in refused],
+            {addr: reply for addr, reply in refused.items() if reply[0] < 500},
+            {addr: reply for addr, reply in refused.items() if reply[0] >= 500},
+        )
+
+    @property
+    def sent(self):
+        """Whether at least one recipient accepted the message."""
+        return bool(self.accepted)
+
+    def __repr__(self):
+        return '<%s accepted=%d temp_refused=%d perm_refused=%d>' % (
+            self.__class__.__name__,
+            len(self.accepted),
+            len(self.temp_refused),
+            len(self.perm_refused),
+        )
+
 
 class EmailBackend(BaseEmailBackend):
     """
@@ -27,6 +132,8 @@ class EmailBackend(BaseEmailBackend):
         timeout=None,
         ssl_keyfile=None,
         ssl_certfile=None,
+        concurrency=None,
+        max_retries=None,
         **kwargs,
     ):
         super().__init__(fail_silently=fail_silently, **kwargs)
@@ -39,25 +146,36 @@ class EmailBackend(BaseEmailBackend):
         self.timeout = self.mailman.timeout if timeout is None else timeout
         self.ssl_keyfile = self.mailman.ssl_keyfile if ssl_keyfile is None else ssl_keyfile
         self.ssl_certfile = self.mailman.ssl_certfile if ssl_certfile is None else ssl_certfile
+        self.concurrency = self.mailman.smtp_concurrency if concurrency is None else concurrency
+        self.max_retries = self.mailman.smtp_retries if max_retries is None else max_retries
         if self.use_ssl and self.use_tls:
             raise ValueError(
                 "EMAIL_USE_TLS/EMAIL_USE_SSL are mutually exclusive, so only set " "one of those settings to True."
             )
+        # Connections are spread over MAIL_RELAYS unless a host is given.
+        self.relays = get_relay_set(self.mailman) if host is None and self.mailman.relays else None
+        server = 'relays' if self.relays else (self.host, self.port)
+        self.circuit_breaker = get_circuit_breaker(self.mailman, server)
+        self.rate_limiter = get_rate_limiter(self.mailman, server)
+        self.concurrency_controller = get_concurrency_controller(self.mailman, server)
+        if self.mailman.refused_retries and not self.mailman.spool_path:
+            raise ImproperlyConfigured('MAIL_SPOOL_PATH must be set to retry refused recipients.')
         self.connection = None
+        # DeliveryResult of every message of the last send_messages() call
+        # that reached the recipients stage.
+        self.results = []
+        # Whether the connection holds a slot of the adaptive concurrency limit.
+        self._holds_slot = False
         self._lock = threading.RLock()
 
     @property
     def connection_class(self):
         return smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
 
-    @cached_property
+    @property
     def ssl_context(self):
-        if self.ssl_certfile or self.ssl_keyfile:
-            ssl_context = ssl.SSLContext(protocol=ssl.PROTOCOL_TLS_CLIENT)
-            ssl_context.load_cert_chain(self.ssl_certfile, self.ssl_keyfile)
-            return ssl_context
-        else:
-            return ssl.create_default_context()
+        """The SSLContext shared by the connections with these SSL settings."""
+        return get_shared_context(self.mailman, self.ssl_certfile, self.ssl_keyfile).context
 
     def open(self):
         """
@@ -69,30 +187,73 @@ class EmailBackend(BaseEmailBackend):
             # Nothing to do if the connection is already open.
             return False
 
+        try:
+            self.connection = self._connect()
+            return True
+        except OSError:
+            if not self.fail_silently:
+                raise
+
+    def _connect(self):
+        """Return a new connection to the email server, ready to send mail."""
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return self._connect_any()
+        breaker.check()
+        try:
+            connection = self._connect_any()
+        except BaseException:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return connection
+
+    def _connect_any(self):
+        if self.relays is None:
+            return self._connect_to(self.host, self.port)
+        error = None
+        for relay in self.relays.candidates():
+            try:
+                connection = self._connect_to(relay.host, relay.port)
+            except OSError as exc:
+                # Fail over to the next relay.
+                self.relays.failed(relay)
+                error = exc
+                continue
+            self.relays.connected(relay, connection)
+            _connection_relays[connection] = (relay.host, relay.port)
+            return connection
+        raise error
+
+    def _connect_to(self, host, port):
         # If local_hostname is not specified, socket.getfqdn() gets used.
         # For performance, we use the cached FQDN for local_hostname.
         connection_params = {'local_hostname': DNS_NAME.get_fqdn()}
         if self.timeout is not None:
             connection_params['timeout'] = self.timeout
         if self.use_ssl:
-            connection_params["context"] = self.ssl_context
+            # Certificates are verified with implicit TLS only, STARTTLS keeps
+            # smtplib's historical behavior.
+            shared = get_shared_context(self.mailman, self.ssl_certfile, self.ssl_keyfile)
+            connection_params["context"] = shared.for_server(host, port)
+        elif self.use_tls:
+            shared = get_shared_context(self.mailman, self.ssl_certfile, self.ssl_keyfile, verify=False)
+        connection = self.connection_class(host, port, **connection_params)
         try:
-            self.connection = self.connection_class(self.host, self.port, **connection_params)
-
             # TLS/SSL are mutually exclusive, so only attempt TLS over
             # non-secure connections.
             if not self.use_ssl and self.use_tls:
-                if self.ssl_certfile:
-                    context = ssl.SSLContext().load_cert_chain(self.ssl_certfile, keyfile=self.ssl_keyfile)
-                else:
-                    context = None
-                self.connection.starttls(context=context)
+                connection.starttls(context=shared.for_server(host, port))
             if self.username and self.password:
-                self.connection.login(self.username, self.password)
-            return True
-        except OSError:
-            if not self.fail_silently:
-                raise
+                connection.login(self.username, self.password)
+        except BaseException:
+            connection.close()
+            raise
+        if self.use_ssl or self.use_tls:
+            # With TLS 1.3 the session tickets come after the handshake, they
+            # have been read along with the replies by now.
+            shared.save_session((host, port), connection.sock)
+        return connection
 
     def close(self):
         """Close the connection to the email server."""
@@ -120,38 +281,692 @@ class EmailBackend(BaseEmailBackend):
         """
         if not email_messages:
             return 0
+        if self._circuit_diverted():
+            return self._fallback().send_messages(email_messages)
         with self._lock:
-            new_conn_created = self.open()
-            if not self.connection or new_conn_created is None:
-                # We failed silently on open().
-                # Trying to send would be pointless.
-                return 0
+            # Worker backends share this list with the backend they copy.
+            self.results = []
+            if self.mailman.domain_concurrency or self.mailman.domain_rate_limit:
+                return self._send_scheduled(email_messages)
+            workers = self._max_workers()
+            if workers > 1:
+                email_messages = list(email_messages)
+                if len(email_messages) > 1:
+                    return self._send_concurrently(email_messages, min(workers, len(email_messages)))
+            with self._concurrency_slot():
+                new_conn_created = self.open()
+                if not self.connection or new_conn_created is None:
+                    # We failed silently on open().
+                    # Trying to send would be pointless.
+                    return 0
+                num_sent = 0
+                for message in email_messages:
+                    sent = self._send(message)
+                    if sent:
+                        num_sent += 1
+                if new_conn_created:
+                    self.close()
+        return num_sent
+
+    def _circuit_diverted(self):
+        """
+        Whether the messages go to MAIL_CIRCUIT_BREAKER_FALLBACK because the
+        circuit breaker is open.
+        """
+        return (
+            self.connection is None
+            and self.mailman.circuit_breaker_fallback is not None
+            and self.circuit_breaker is not None
+            and self.circuit_breaker.is_open
+        )
+
+    def _fallback(self):
+        return self.mailman.get_connection(
+            backend=self.mailman.circuit_breaker_fallback, fail_silently=self.fail_silently
+        )
+
+    def _send_concurrently(self, email_messages, workers):
+        """
+        Send the messages over ``workers`` connections at once, the workers
+        pulling the next message to send from a shared iterator until none
+        is left.
+        """
+        pending = iter(email_messages)
+        pending_lock = threading.Lock()
+        # A message taken from ``pending`` to tell whether any is left.
+        peeked = []
+
+        def next_message():
+            with pending_lock:
+                return peeked.pop() if peeked else next(pending, None)
+
+        def has_work():
+            with pending_lock:
+                if not peeked:
+                    message = next(pending, None)
+                    if message is None:
+                        return False
+                    peeked.append(message)
+                return True
+
+        def deliver(backend):
             num_sent = 0
-            for message in email_messages:
-                sent = self._send(message)
-                if sent:
+            message = next_message()
+            while message is not None:
+                self._respect_limit(backend)
+                if backend._send(message):
                     num_sent += 1
-            if new_conn_created:
-                self.close()
-        return num_sent
+                message = next_message()
+            return num_sent
+
+        return sum(self._run_workers(deliver, workers, has_work))
+
+    def _send_scheduled(self, email_messages):
+        """
+        Send the messages in one transaction per recipient domain, handed out
+        by a DomainScheduler to ``concurrency`` workers. A message counts as
+        sent if any of its transactions is.
+        """
+        transactions = list(self._transactions(email_messages))
+        domains = {transaction.domain for transaction in transactions}
+        scheduler = DomainScheduler(
+            transactions,
+            concurrency=self.mailman.domain_concurrency,
+            rate_limiters={domain: get_domain_rate_limiter(self.mailman, domain) for domain in domains},
+        )
+
+        def deliver(backend):
+            sent = set()
+            transaction = scheduler.next()
+            while transaction is not None:
+                self._respect_limit(backend)
+                try:
+                    if backend._send(transaction.message, transaction.recipients, transaction.msg):
+                        sent.add(id(transaction.message))
+                finally:
+                    scheduler.done(transaction)
+                transaction = scheduler.next()
+            return sent
+
+        if self._max_workers() > 1:
+            results = self._run_workers(deliver, self._max_workers(), scheduler.has_pending)
+        else:
+            with self._concurrency_slot():
+                new_conn_created = self.open()
+                if not self.connection or new_conn_created is None:
+                    # We failed silently on open().
+                    return 0
+                results = [deliver(self)]
+                if new_conn_created:
+                    self.close()
+        return len(set().union(*results))
+
+    def _transactions(self, email_messages):
+        """Split the messages into Transaction objects, one per recipient domain."""
+        for message in email_messages:
+            encoding = message.encoding or self.mailman.default_charset
+            domains = {}
+            for addr in message.recipients():
+                addr = sanitize_address(addr, encoding, self.mailman.use_smtputf8)
+                domains.setdefault(recipient_domain(addr), []).append(addr)
+            # Serialize messages split in several transactions only once.
+            msg = self._serialize(message.message(), stream=False) if len(domains) > 1 else None
+            for domain, recipients in domains.items():
+                yield Transaction(message, domain, recipients, msg)
+
+    def _run_workers(self, deliver, workers, has_work):
+        """
+        Call ``deliver(backend)`` in ``workers`` threads at once and return
+        the results of the workers that could connect. Each thread owns a
+        copy of this backend and its own connection, opened only if
+        ``has_work()`` still returns True once the thread may connect.
+        """
+        app = current_app._get_current_object()
+
+        def run(backend):
+            with app.app_context():
+                if not has_work():
+                    return None
+                with backend._concurrency_slot():
+                    # The other workers may have sent everything while this
+                    # one waited for the concurrency limit.
+                    if not has_work() or backend.open() is None or not backend.connection:
+                        # We failed silently on open(), leave the messages to
+                        # the other workers.
+                        return None
+                    try:
+                        return deliver(backend)
+                    finally:
+                        backend.close()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run, self._worker_backend()) for _ in range(workers)]
+        results = [future.result() for future in futures]
+        return [result for result in results if result is not None]
+
+    @contextmanager
+    def _concurrency_slot(self):
+        """
+        Hold a slot of the adaptive concurrency limit, shared by the backends
+        sending to the same server, while a new connection is used.
+        """
+        controller = self.concurrency_controller
+        if controller is None or self.connection:
+            yield
+            return
+        controller.acquire()
+        self._holds_slot = True
+        try:
+            yield
+        finally:
+            if self._holds_slot:
+                self._holds_slot = False
+                controller.release()
+
+    def _max_workers(self):
+        controller = self.concurrency_controller
+        return self.concurrency if controller is None else controller.maximum
 
-    def _send(self, email_message):
-        """A helper method that does the actual sending."""
+    def _respect_limit(self, backend):
+        """
+        Close the connection of a worker while more connections are open than
+        the adaptive concurrency limit allows, and wait until it's allowed to
+        reopen it.
+        """
+        controller = self.concurrency_controller
+        if backend._holds_slot and controller.release_if_over_limit():
+            backend._holds_slot = False
+            backend.close()
+            # The connection is reopened by the next transaction.
+            controller.acquire()
+            backend._holds_slot = True
+
+    def _worker_backend(self):
+        """Return a copy of this backend with its own, closed, connection."""
+        backend = copy.copy(self)
+        backend.connection = None
+        backend.concurrency = 1
+        backend._holds_slot = False
+        backend._lock = threading.RLock()
+        return backend
+
+    def _send(self, email_message, recipients=None, msg=None):
+        """
+        A helper method that does the actual sending. ``recipients`` limits
+        the envelope to some of the (sanitized) recipients, and ``msg`` is
+        the message when it's already serialized.
+        """
         if not email_message.recipients():
             return False
         encoding = email_message.encoding or self.mailman.default_charset
-        from_email = sanitize_address(email_message.from_email, encoding)
-        recipients = [sanitize_address(addr, encoding) for addr in email_message.recipients()]
-        message = email_message.message()
+        utf8 = self.mailman.use_smtputf8
+        from_email = sanitize_address(email_message.from_email, encoding, utf8)
+        if recipients is None:
+            recipients = [sanitize_address(addr, encoding, utf8) for addr in email_message.recipients()]
+        stream = self._single_transaction(recipients)
+        if msg is None:
+            msg = self._serialize(email_message.message(), stream)
         try:
-            self.connection.sendmail(
-                from_email,
-                recipients,
-                message.as_bytes(linesep='\r\n'),
-                mail_options=self.mailman.mail_options,
-            )
+            try:
+                refused = self._deliver(from_email, recipients, msg)
+            except SMTPUTF8NotSupported:
+                from_email, recipients, message = self._without_smtputf8(email_message, recipients)
+                msg = self._serialize(message, stream)
+                refused = self._deliver(from_email, recipients, msg)
+        except smtplib.SMTPRecipientsRefused as exc:
+            result = DeliveryResult.from_refused(email_message, recipients, exc.recipients)
+            self.results.append(result)
+            # Every recipient was refused, some may accept the message later.
+            deferred = self._retry_refused(email_message, from_email, result, msg)
+            if not self.fail_silently:
+                if deferred:
+                    raise RecipientsDeferred(exc.recipients) from exc
+                raise
+            return False
+        except MessageTooLarge as exc:
+            refused = dict.fromkeys(recipients, (exc.smtp_code, exc.smtp_error))
+            self.results.append(DeliveryResult.from_refused(email_message, recipients, refused))
+            if not self.fail_silently:
+                raise
+            return False
         except smtplib.SMTPException:
             if not self.fail_silently:
                 raise
             return False
+        self._delivered(email_message, from_email, recipients, refused, msg)
+        return True
+
+    def _without_smtputf8(self, email_message, recipients):
+        """
+        Return the envelope and MIME message of ``email_message`` with their
+        non-ASCII addresses and headers encoded as usual, for the servers that
+        don't support SMTPUTF8 when MAIL_USE_SMTPUTF8 is set.
+        """
+        encoding = email_message.encoding or self.mailman.default_charset
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(addr, encoding) for addr in recipients]
+        return from_email, recipients, email_message._get_message(smtputf8=False)
+
+    def _serialize(self, message, stream=True):
+        """
+        Serialize the message once, every chunk of recipients and every retry
+        send the same bytes. Messages larger than MAIL_STREAM_THRESHOLD are
+        flattened while they are sent instead, if ``stream`` is True, i.e.
+        when they go out in a single transaction; a streamed message is only
+        flattened again if its connection is lost and the transaction retried.
+        """
+        threshold = self.mailman.stream_threshold
+        if stream and threshold is not None and isinstance(message, MIMEMixin):
+            size = _estimate_size(message)
+            if size >= threshold:
+                return StreamedMessage(message, size)
+        return message.as_bytes(linesep='\r\n')
+
+    def _delivered(self, email_message, from_email, recipients, refused, msg):
+        """
+        Record the result of a message accepted for at least one recipient,
+        and spool it again for the recipients refused temporarily, if
+        MAIL_REFUSED_RETRIES allows it.
+        """
+        result = DeliveryResult.from_refused(email_message, recipients, refused)
+        self.results.append(result)
+        self._retry_refused(email_message, from_email, result, msg)
+        return result
+
+    def _retry_refused(self, email_message, from_email, result, msg):
+        """
+        Spool the message again for the recipients of ``result`` refused
+        temporarily, if MAIL_REFUSED_RETRIES allows it. Return whether it was
+        spooled.
+        """
+        attempt = getattr(email_message, 'attempts', 0) + 1
+        if not result.temp_refused or attempt > self.mailman.refused_retries:
+            return False
+        retry = SpooledMessage(
+            from_email,
+            list(result.temp_refused),
+            bytes(msg),
+            encoding=email_message.encoding,
+            subject=str(email_message.subject),
+            attempts=attempt,
+        )
+        # Back off exponentially, the servers refusing temporarily (e.g.
+        # greylisting) want to be retried minutes later.
+        delay = self.mailman.refused_retry_delay * 2 ** (attempt - 1)
+        Spool(self.mailman.spool_path, fsync=self.mailman.spool_fsync).put([retry], delay=delay)
+        return True
+
+    def _single_transaction(self, recipients):
+        """Whether the message goes out to ``recipients`` in a single transaction."""
+        chunk_size = self.mailman.max_recipients_per_transaction
+        return not chunk_size or len(recipients) <= chunk_size
+
+    def _deliver(self, from_email, recipients, msg):
+        """
+        Send the message to all its recipients and return the refused ones.
+
+        Servers limit the number of RCPT TO per transaction, so the recipients
+        are split in chunks of MAIL_MAX_RECIPIENTS_PER_TRANSACTION, each one
+        sent in its own transaction.
+        """
+        if self._single_transaction(recipients):
+            return self._transaction(from_email, recipients, msg)
+        chunk_size = self.mailman.max_recipients_per_transaction
+        refused = {}
+        for start in range(0, len(recipients), chunk_size):
+            try:
+                refused.update(self._transaction(from_email, recipients[start : start + chunk_size], msg))
+            except smtplib.SMTPRecipientsRefused as exc:
+                # The other chunks may still be accepted.
+                refused.update(exc.recipients)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    def _transaction(self, from_email, recipients, msg):
+        """
+        Run a mail transaction and return the refused recipients. Reopen the
+        connection and try again, up to ``max_retries`` times, if it's lost.
+        """
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                if attempt or self.connection is None:
+                    self._reconnect()
+                elif self._connection_exhausted(len(msg)):
+                    self._recycle()
+                rate_limiter = self._connection_rate_limiter()
+                if rate_limiter is not None:
+                    rate_limiter.acquire()
+                started = time.monotonic()
+                refused = self._sendmail(from_email, recipients, msg, mail_options=self.mailman.mail_options)
+                messages, size = _connection_usage.get(self.connection, (0, 0))
+                _connection_usage[self.connection] = (messages + 1, size + len(msg))
+                self._observe(started, any(code < 500 for code, msg in refused.values()))
+                return refused
+            except OSError as exc:
+                self._observe(started, _is_temporary_failure(exc))
+                if attempt < self.max_retries and _is_disconnection(exc):
+                    attempt += 1
+                    time.sleep(self._retry_delay(attempt))
+                    continue
+                raise
+
+    def _connection_rate_limiter(self):
+        """
+        Return the TokenBucket of the server the connection goes to: with
+        MAIL_RELAYS and MAIL_RATE_LIMIT_PER_HOST, the relay it was opened to.
+        """
+        if self.relays is not None and self.mailman.rate_limit_per_host:
+            relay = _connection_relays.get(self.connection)
+            if relay is not None:
+                return get_rate_limiter(self.mailman, relay)
+        return self.rate_limiter
+
+    def _observe(self, started, pushed_back):
+        """Report the outcome of a transaction to the adaptive concurrency limit."""
+        if self.concurrency_controller is not None:
+            self.concurrency_controller.record(time.monotonic() - started, pushed_back)
+
+    def _retry_delay(self, attempt):
+        """Exponential backoff with full jitter before the given retry."""
+        delay = min(self.mailman.smtp_retry_backoff_max, self.mailman.smtp_retry_backoff * 2 ** (attempt - 1))
+        return random.uniform(0, delay)
+
+    def _connection_exhausted(self, size):
+        """
+        Whether sending ``size`` more bytes would exceed the number of messages
+        or bytes a server accepts per connection.
+        """
+        messages, sent = _connection_usage.get(self.connection, (0, 0))
+        if not messages:
+            return False
+        max_messages = self.mailman.max_messages_per_connection
+        max_bytes = self.mailman.max_bytes_per_connection
+        return bool((max_messages and messages >= max_messages) or (max_bytes and sent + size > max_bytes))
+
+    def _recycle(self):
+        """Close the connection gracefully and open a new one."""
+        connection, self.connection = self.connection, None
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+        self.connection = self._connect()
+
+    def _reconnect(self):
+        """Replace a dead connection with a new one."""
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except OSError:
+                pass
+        self.connection = self._connect()
+
+    def _sendmail(self, from_addr, to_addrs, msg, mail_options=()):
+        """
+        Run a mail transaction on the open connection and return the
+        recipients refused by the server, like smtplib.SMTP.sendmail().
+
+        When the server supports PIPELINING (RFC 2920), MAIL FROM, all the
+        RCPT TO and DATA are written at once and their replies read back in
+        bulk, which costs one round trip instead of one per command.
+        """
+        connection = self.connection
+        connection.ehlo_or_helo_if_needed()
+        _check_size(connection, len(msg))
+        if self.mailman.use_smtputf8:
+            mail_options = _with_smtputf8(connection, from_addr, to_addrs, msg, mail_options)
+        chunking = bool(self.mailman.bdat_chunk_size) and connection.has_extn('chunking')
+        pipelining = connection.has_extn('pipelining')
+        streamed = isinstance(msg, StreamedMessage)
+        if not chunking and not pipelining and not streamed:
+            return connection.sendmail(from_addr, to_addrs, msg, mail_options=mail_options)
+
+        esmtp_opts = _esmtp_options(connection, msg, mail_options)
+        commands = ['mail FROM:%s%s' % (smtplib.quoteaddr(from_addr), _format_options(esmtp_opts))]
+        commands.extend('rcpt TO:%s' % smtplib.quoteaddr(addr) for addr in to_addrs)
+        if not chunking:
+            commands.append('data')
+        if pipelining:
+            connection.send(''.join('%s\r\n' % command for command in commands))
+            replies = [connection.getreply() for command in commands]
+        else:
+            replies = []
+            for command in commands:
+                connection.send('%s\r\n' % command)
+                replies.append(connection.getreply())
+
+        mail_reply = replies[0]
+        rcpt_replies = replies[1 : len(to_addrs) + 1]
+        # BDAT has no reply before the data is sent.
+        data_reply = (354, b'') if chunking else replies[-1]
+        refused = {addr: reply for addr, reply in zip(to_addrs, rcpt_replies) if reply[0] not in (250, 251)}
+        if not chunking and data_reply[0] == 354 and (mail_reply[0] != 250 or len(refused) == len(to_addrs)):
+            # The server should have rejected DATA, end the empty message.
+            connection.send('.\r\n')
+            connection.getreply()
+        if 421 in (mail_reply[0], data_reply[0]):
+            connection.close()
+        elif mail_reply[0] != 250 or len(refused) == len(to_addrs) or data_reply[0] != 354:
+            connection._rset()
+        if mail_reply[0] != 250:
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        if len(refused) == len(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_reply[0] != 354:
+            raise smtplib.SMTPDataError(*data_reply)
+
+        if chunking or streamed:
+            code, resp = self._write_data(msg, chunking)
+        else:
+            data = _quote_periods(msg)
+            if data[-2:] != b'\r\n':
+                data += b'\r\n'
+            connection.send(data + b'.\r\n')
+            code, resp = connection.getreply()
+        if code != 250:
+            if code == 421:
+                connection.close()
+            else:
+                connection._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def _write_data(self, msg, chunking):
+        """
+        Send the message data in bounded pieces, in BDAT chunks (RFC 3030)
+        with CHUNKING or dot-stuffed after DATA, and return the final reply.
+        """
+        if chunking:
+            writer = _ChunkWriter(self.connection, self.mailman.bdat_chunk_size)
+        else:
+            writer = _DataWriter(self.connection, DATA_BUFFER_SIZE)
+        try:
+            if isinstance(msg, StreamedMessage):
+                msg.write_to(writer)
+            else:
+                for chunk in _chunks(msg, writer.size):
+                    writer.write(chunk)
+            return writer.close()
+        except smtplib.SMTPDataError as exc:
+            # A BDAT chunk was rejected.
+            return exc.smtp_code, exc.smtp_error
+        except BaseException:
+            # The transaction can't be ended cleanly in the middle of the data.
+            self.connection.close()
+            raise
+
+
+class _ChunkWriter:
+    """
+    A file object sending what is written to it in BDAT chunks of ``size``
+    bytes. Each chunk is sent as is, without dot-stuffing.
+    """
+
+    def __init__(self, connection, size):
+        self.connection = connection
+        self.size = size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        # Keep the end of the data in the buffer, the last chunk must be
+        # sent with BDAT LAST.
+        while len(self.buffer) > self.size:
+            self._send_chunk(self.buffer[: self.size])
+            del self.buffer[: self.size]
+
+    def _send_chunk(self, chunk, last=False):
+        # A single write per chunk, the copy is bounded by the chunk size.
+        self.connection.send(b'BDAT %d%s\r\n' % (len(chunk), b' LAST' if last else b'') + chunk)
+        code, resp = self.connection.getreply()
+        if code != 250 and not last:
+            raise smtplib.SMTPDataError(code, resp)
+        return code, resp
+
+    def close(self):
+        """Send the last chunk and return the server's reply."""
+        chunk, self.buffer = self.buffer, bytearray()
+        return self._send_chunk(chunk, last=True)
+
+
+class _DataWriter:
+    """
+    A file object sending what is written to it as DATA, dot-stuffed (RFC
+    5321, section 4.5.2), in writes of about ``size`` bytes.
+    """
+
+    def __init__(self, connection, size):
+        self.connection = connection
+        self.size = size
+        self.buffer = bytearray()
+        self.line_start = True
+
+    def write(self, data):
+        data = bytes(data)
+        if not data:
+            return
+        if self.line_start and data[:1] == b'.':
+            data = b'.' + data
+        self.buffer += data.replace(b'\n.', b'\n..')
+        self.line_start = data[-1:] == b'\n'
+        if len(self.buffer) >= self.size:
+            self.connection.send(bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self):
+        """End the data and return the server's reply."""
+        if not self.line_start:
+            self.buffer += b'\r\n'
+        self.buffer += b'.\r\n'
+        self.connection.send(bytes(self.buffer))
+        self.buffer.clear()
+        return self.connection.getreply()
+
+
+def _is_disconnection(exc):
+    """
+    Whether the error means the connection is lost, rather than the message
+    being refused.
+    """
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException):
+        # 421: the server is closing the transmission channel.
+        return exc.smtp_code == 421
+    return not isinstance(exc, smtplib.SMTPException)
+
+
+def _is_temporary_failure(exc):
+    """Whether the server is pushing back, rather than rejecting the message."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return any(code < 500 for code, msg in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code < 500
+    return _is_disconnection(exc)
+
+
+def _check_size(connection, size):
+    """
+    Raise MessageTooLarge if the message is larger than the limit advertised
+    by the server, rather than finding out once it's uploaded.
+    """
+    if not connection.has_extn('size'):
+        return
+    try:
+        limit = int(connection.esmtp_features['size'])
+    except ValueError:
+        # SIZE without a limit.
+        return
+    if limit and size > limit:
+        raise MessageTooLarge(size, limit)
+
+
+def _with_smtputf8(connection, from_addr, to_addrs, msg, mail_options):
+    """
+    Add SMTPUTF8 (RFC 6531) to the MAIL FROM options when the server supports
+    it. Raise SMTPUTF8NotSupported if it doesn't and the message requires it.
+    """
+    if any(option.lower() == 'smtputf8' for option in mail_options):
+        return mail_options
+    if connection.has_extn('smtputf8'):
+        return [*mail_options, 'SMTPUTF8']
+    if _is_internationalized(from_addr, to_addrs, msg):
+        raise SMTPUTF8NotSupported('SMTPUTF8 not supported by server')
+    return mail_options
+
+
+def _is_internationalized(from_addr, to_addrs, msg):
+    """Whether the envelope or the headers of a message aren't ASCII."""
+    if not from_addr.isascii() or not all(addr.isascii() for addr in to_addrs):
         return True
+    if isinstance(msg, StreamedMessage):
+        return not all(str(value).isascii() for value in msg.message.values())
+    end = msg.find(b'\r\n\r\n')
+    return not msg[: end if end >= 0 else None].isascii()
+
+
+def _esmtp_options(connection, msg, mail_options):
+    """Return the MAIL FROM options, like smtplib.SMTP.sendmail() does."""
+    esmtp_opts = []
+    if connection.has_extn('size'):
+        esmtp_opts.append('size=%d' % len(msg))
+    esmtp_opts.extend(mail_options)
+    if any(option.lower() == 'smtputf8' for option in esmtp_opts):
+        if not connection.has_extn('smtputf8'):
+            raise smtplib.SMTPNotSupportedError('SMTPUTF8 not supported by server')
+        connection.command_encoding = 'utf-8'
+    return esmtp_opts
+
+
+def _format_options(options):
+    return ''.join(' %s' % option for option in options)
+
+
+def _chunks(data, size):
+    """Yield ``data`` in slices of ``size`` bytes, without copying it."""
+    view = memoryview(data)
+    for start in range(0, len(view), size):
+        yield view[start : start + size]
+
+
+def _estimate_size(message):
+    """Estimate the size of a message serialized with CRLF line endings."""
+    size = 0
+    for part in message.walk():
+        size += sum(len(name) + len(str(value)) + 4 for name, value in part.items()) + 2
+        if isinstance(part, MIMEFile) and part.is_lazy:
+            size += part.file_content.encoded_size(linesep='\r\n')
+            continue
+        payload = part._payload
+        if isinstance(payload, str):
+            size += len(payload) + payload.count('\n')
+    return size
+
+
+def _quote_periods(data):
+    """Dot-stuff lines starting with a period (RFC 5321, section 4.5.2)."""
+    return re.sub(br'(?m)^\.', b'..', data)
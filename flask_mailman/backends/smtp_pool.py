@@ -0,0 +1,300 @@
+"""SMTP email backend that reuses connections from a shared pool."""
+import smtplib
+import threading
+import time
+from collections import deque
+
+from flask_mailman.backends.smtp import EmailBackend as SMTPEmailBackend
+
+
+class PoolTimeout(smtplib.SMTPException):
+    """No pooled connection became available in time."""
+
+    pass
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of open, authenticated SMTP connections.
+
+    New connections are created by calling ``connect``. Connections are
+    handed out by acquire() and given back with release(), so the TCP,
+    TLS and AUTH handshakes are only paid once per connection instead of
+    once per send.
+
+    Idle connections are closed once they have been idle for more than
+    ``max_idle`` seconds (while more than ``min_size`` connections are open),
+    and every connection is closed once it is older than ``max_age`` seconds.
+    A NOOP is issued on checkout so connections dropped by the server are
+    never handed out.
+    """
+
+    def __init__(self, connect, min_size=0, max_size=10, max_idle=None, max_age=None, timeout=None):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+        if min_size > max_size:
+            raise ValueError("min_size can't be greater than max_size.")
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.timeout = timeout
+        # Maps every open connection (idle or checked out) to its creation time.
+        self._created = {}
+        # (connection, last_used) pairs, the most recently used on the right.
+        self._idle = deque()
+        # Number of connections being opened outside of the lock.
+        self._pending = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def size(self):
+        """Number of open connections, idle or checked out."""
+        with self._cond:
+            return len(self._created) + self._pending
+
+    @property
+    def idle(self):
+        """Number of open connections waiting in the pool."""
+        with self._cond:
+            return len(self._idle)
+
+    def acquire(self):
+        """
+        Return a healthy connection, reusing an idle one if possible.
+
+        Block while the pool is exhausted, raising PoolTimeout if no
+        connection is released within ``timeout`` seconds.
+        """
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            connection = self._checkout(deadline)
+            if connection is None:
+                return self._create()
+            if self._is_usable(connection):
+                return connection
+            self.discard(connection)
+
+    def release(self, connection):
+        """Give a connection back to the pool once the caller is done with it."""
+        with self._cond:
+            created = self._created.get(connection)
+            if created is not None and not self._too_old(created, time.monotonic()):
+                self._idle.append((connection, time.monotonic()))
+                self._cond.notify()
+                return
+        self.discard(connection)
+
+    def discard(self, connection):
+        """Close a connection and free its slot in the pool."""
+        with self._cond:
+            if self._created.pop(connection, None) is not None:
+                self._cond.notify()
+        self._close_connection(connection)
+
+    def fill(self):
+        """Open idle connections until at least ``min_size`` of them are open."""
+        while True:
+            with self._cond:
+                if len(self._created) + self._pending >= self.min_size:
+                    return
+                self._pending += 1
+            self.release(self._create())
+
+    def close(self):
+        """
+        Close every idle connection. Connections currently checked out are
+        closed when they are released.
+        """
+        with self._cond:
+            idle = [connection for connection, last_used in self._idle]
+            self._idle.clear()
+            self._created.clear()
+            self._cond.notify_all()
+        for connection in idle:
+            self._close_connection(connection)
+
+    def _checkout(self, deadline):
+        """
+        Pop an idle connection, or reserve a slot for a new one and return
+        None.
+        """
+        reaped = []
+        try:
+            with self._cond:
+                while True:
+                    reaped.extend(self._reap(time.monotonic()))
+                    if self._idle:
+                        connection, last_used = self._idle.pop()
+                        return connection
+                    if len(self._created) + self._pending < self.max_size:
+                        self._pending += 1
+                        return None
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or not self._cond.wait(remaining):
+                            raise PoolTimeout("Timed out waiting for a pooled SMTP connection.")
+        finally:
+            for connection in reaped:
+                self._close_connection(connection)
+            if reaped:
+                self._refill()
+
+    def _create(self):
+        try:
+            connection = self.connect()
+        except BaseException:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._pending -= 1
+            self._created[connection] = time.monotonic()
+        return connection
+
+    def _refill(self):
+        # Replace the connections reaped below min_size. The caller already
+        # holds a connection or is about to open one, if the server can't be
+        # reached the next acquire() will tell.
+        try:
+            self.fill()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _reap(self, now):
+        """Forget idle connections past their lifetime and return them."""
+        reaped = []
+        keep = deque()
+        for connection, last_used in self._idle:
+            too_idle = self.max_idle is not None and now - last_used > self.max_idle
+            if self._too_old(self._created[connection], now) or (
+                too_idle and len(self._created) - len(reaped) > self.min_size
+            ):
+                reaped.append(connection)
+                del self._created[connection]
+            else:
+                keep.append((connection, last_used))
+        self._idle = keep
+        return reaped
+
+    def _too_old(self, created, now):
+        return self.max_age is not None and now - created > self.max_age
+
+    @staticmethod
+    def _is_usable(connection):
+        try:
+            return connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _close_connection(connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+
+class EmailBackend(SMTPEmailBackend):
+    """
+    A SMTP backend whose open() and close() check connections out of and
+    back into a pool held on the application's mail state, so warm
+    authenticated connections are shared across threads and requests.
+    """
+
+    @property
+    def pool(self):
+        key = (
+            self.host,
+            self.port,
+            self.username,
+            self.password,
+            self.use_tls,
+            self.use_ssl,
+            self.timeout,
+            self.ssl_keyfile,
+            self.ssl_certfile,
+        )
+        mailman = self.mailman
+        created = []
+
+        def create():
+            created.append(
+                ConnectionPool(
+                    self._connect,
+                    min_size=mailman.pool_min_size,
+                    max_size=mailman.pool_max_size,
+                    max_idle=mailman.pool_max_idle,
+                    max_age=mailman.pool_max_age,
+                    timeout=mailman.pool_timeout,
+                )
+            )
+            return created[0]
+
+        # Connection pools are keyed by connection settings.
+        pool = mailman.get_shared_item('smtp_pools', key, create)
+        if created:
+            # Open MAIL_POOL_MIN_SIZE connections up front.
+            pool.fill()
+        return pool
+
+    def open(self):
+        """
+        Check a connection out of the pool. Return whether or not a
+        connection was required (True or False) or None if an exception
+        passed silently.
+        """
+        if self.connection:
+            return False
+        try:
+            self.connection = self.pool.acquire()
+            return True
+        except OSError:
+            if not self.fail_silently:
+                raise
+
+    def send_messages(self, email_messages):
+        """
+        Send the messages like the SMTP backend. If sending raises, the
+        connection checked out for them is still given back to the pool, or
+        discarded if the server doesn't answer a RSET anymore.
+        """
+        checked_out = self.connection is None
+        try:
+            return super().send_messages(email_messages)
+        except BaseException:
+            if checked_out and self.connection is not None:
+                connection, self.connection = self.connection, None
+                try:
+                    reset = connection.rset()[0] == 250
+                except (smtplib.SMTPException, OSError):
+                    reset = False
+                if reset:
+                    self.pool.release(connection)
+                else:
+                    self.pool.discard(connection)
+            raise
+
+    def _reconnect(self):
+        """Replace a dead connection with a new one from the pool."""
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            self.pool.discard(connection)
+        self.connection = self.pool.acquire()
+
+    def _recycle(self):
+        """Close the connection gracefully and check out another one."""
+        connection, self.connection = self.connection, None
+        self.pool.discard(connection)
+        self.connection = self.pool.acquire()
+
+    def close(self):
+        """Return the connection to the pool."""
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        self.pool.release(connection)
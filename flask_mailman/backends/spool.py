@@ -0,0 +1,320 @@
+"""
+Email backend that stores messages in a durable on-disk spool, to be
+delivered later by the ``flask mailman worker`` command.
+"""
+import json
+import logging
+import os
+import smtplib
+import time
+import uuid
+from email import message_from_bytes
+from email.message import Message
+from email.parser import HeaderParser
+
+from flask_mailman.backends.base import BaseEmailBackend
+from flask_mailman.backends.file import ImproperlyConfigured
+from flask_mailman.message import forbid_multi_line_headers
+
+logger = logging.getLogger(__name__)
+
+
+class RecipientsDeferred(smtplib.SMTPRecipientsRefused):
+    """
+    Every recipient refused the message, and it was spooled again for those
+    that refused it temporarily (see MAIL_REFUSED_RETRIES).
+    """
+
+    pass
+
+
+class RawMessage(Message):
+    """
+    A parsed message that serializes back to the exact bytes it was parsed
+    from, instead of being flattened again.
+    """
+
+    raw = None
+
+    def as_bytes(self, unixfrom=False, linesep='\n', policy=None):
+        if self.raw is None or unixfrom:
+            return super().as_bytes(unixfrom=unixfrom, policy=policy)
+        if linesep == '\r\n':
+            return self.raw
+        return self.raw.replace(b'\r\n', linesep.encode('ascii'))
+
+
+class SpooledMessage:
+    """
+    A serialized message read back from the spool. It provides the parts of
+    the EmailMessage interface used by the backends to send it.
+    """
+
+    def __init__(self, from_email, recipients, data, encoding=None, subject='', attempts=0, failures=0):
+        self.from_email = from_email
+        self._recipients = recipients
+        # The message serialized with CRLF line endings, as sent over SMTP.
+        self.data = data
+        self.encoding = encoding
+        self.subject = subject
+        # Number of times the message was already sent to some of its
+        # recipients, the others having refused it temporarily.
+        self.attempts = attempts
+        # Number of times the worker failed to send it.
+        self.failures = failures
+
+    def recipients(self):
+        return list(self._recipients)
+
+    def message(self):
+        return _raw_message(self.data)
+
+    def _get_message(self, smtputf8):
+        """
+        Return the MIME message, with its non-ASCII headers encoded unless
+        ``smtputf8`` is True, for the servers that don't support SMTPUTF8.
+        The body is sent as it was spooled.
+        """
+        head, sep, body = self.data.partition(b'\r\n\r\n')
+        if smtputf8 or head.isascii():
+            return self.message()
+        lines = []
+        for name, value in HeaderParser().parsestr(head.decode('utf-8')).items():
+            if not value.isascii():
+                # Unfold the header, it's folded again once encoded.
+                name, value = forbid_multi_line_headers(name, value.replace('\r\n', ''), self.encoding)
+            lines.append('%s: %s\r\n' % (name, value.replace('\r\n', '\n').replace('\n', '\r\n')))
+        return _raw_message(''.join(lines).encode('ascii') + b'\r\n' + body)
+
+
+def _raw_message(data):
+    msg = message_from_bytes(data, _class=RawMessage)
+    msg.raw = data
+    return msg
+
+
+class Spool:
+    """
+    A directory of spooled messages, one file per message, laid out like a
+    maildir: messages are written to ``tmp``, renamed into ``new`` once
+    safely on disk, moved to ``cur`` while a worker sends them and to
+    ``failed`` when the server rejects them permanently.
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = os.path.abspath(path)
+        self.fsync = fsync
+        for name in ('tmp', 'new', 'cur', 'failed'):
+            try:
+                os.makedirs(os.path.join(self.path, name), exist_ok=True)
+            except OSError as err:
+                raise ImproperlyConfigured('Could not create spool directory: %s (%s)' % (self.path, err))
+
+    def _dir(self, name):
+        return os.path.join(self.path, name)
+
+    def put(self, messages, delay=0):
+        """
+        Spool EmailMessage objects, to be sent no sooner than ``delay``
+        seconds from now. Return the number of messages spooled.
+        """
+        names = []
+        for message in messages:
+            if not message.recipients():
+                continue
+            envelope = {
+                'from_email': message.from_email,
+                'recipients': message.recipients(),
+                'encoding': message.encoding,
+                'subject': str(message.subject),
+                'attempts': getattr(message, 'attempts', 0),
+                'failures': getattr(message, 'failures', 0),
+            }
+            data = message.message().as_bytes(linesep='\r\n')
+            # Names start with the time the message is due, so that sorting
+            # them gives the sending order.
+            name = '%d.%s.msg' % (time.time_ns() + int(delay * 1e9), uuid.uuid4().hex)
+            with open(os.path.join(self._dir('tmp'), name), 'wb') as fp:
+                fp.write(json.dumps(envelope).encode('utf-8') + b'\n')
+                fp.write(data)
+                if self.fsync:
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            names.append(name)
+        for name in names:
+            os.rename(os.path.join(self._dir('tmp'), name), os.path.join(self._dir('new'), name))
+        if names and self.fsync:
+            # A single directory sync makes the whole batch of renames durable.
+            self._fsync_dir(self._dir('new'))
+        return len(names)
+
+    def _fsync_dir(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # Directories can't be opened on some platforms (e.g. Windows).
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def claim(self, limit):
+        """
+        Move up to ``limit`` spooled messages that are due to ``cur`` and
+        return them as (name, SpooledMessage) pairs, oldest first.
+        """
+        claimed = []
+        now = time.time_ns()
+        for name in sorted(os.listdir(self._dir('new'))):
+            if len(claimed) >= limit or int(name.split('.', 1)[0]) > now:
+                break
+            path = os.path.join(self._dir('cur'), name)
+            try:
+                os.rename(os.path.join(self._dir('new'), name), path)
+            except FileNotFoundError:
+                # Claimed by another worker.
+                continue
+            os.utime(path)
+            with open(path, 'rb') as fp:
+                envelope = json.loads(fp.readline())
+                data = fp.read()
+            claimed.append((name, SpooledMessage(data=data, **envelope)))
+        return claimed
+
+    def complete(self, name):
+        """Forget a message that was sent."""
+        os.unlink(os.path.join(self._dir('cur'), name))
+
+    def defer(self, name, message, delay):
+        """
+        Replace a claimed message with ``message``, to be sent no sooner than
+        ``delay`` seconds from now.
+        """
+        self.put([message], delay=delay)
+        self.complete(name)
+
+    def retry(self, name):
+        """Put a claimed message back in the spool."""
+        os.rename(os.path.join(self._dir('cur'), name), os.path.join(self._dir('new'), name))
+
+    def fail(self, name):
+        """Set aside a message that can't be delivered."""
+        os.rename(os.path.join(self._dir('cur'), name), os.path.join(self._dir('failed'), name))
+
+    def recover(self, stale=3600):
+        """
+        Put back in the spool the messages claimed more than ``stale``
+        seconds ago by a worker that died before sending them.
+        """
+        now = time.time()
+        for name in os.listdir(self._dir('cur')):
+            try:
+                if now - os.stat(os.path.join(self._dir('cur'), name)).st_mtime > stale:
+                    self.retry(name)
+            except FileNotFoundError:
+                continue
+
+    def __len__(self):
+        return len(os.listdir(self._dir('new')))
+
+
+def is_permanent_failure(exc):
+    """Whether the server rejected the message for good (5xx replies)."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, msg in exc.recipients.values())
+    return isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code >= 500
+
+
+def drain(spool, connection, batch_size=100, max_failures=10, retry_delay=60):
+    """
+    Send a batch of spooled messages through ``connection`` over a single
+    session and return the number of messages sent. Messages rejected
+    permanently are set aside. A message that fails otherwise is put back in
+    the spool, due ``retry_delay`` seconds later, doubling after each failure,
+    and set aside after ``max_failures`` failures; the session is started
+    over for the rest of the batch. Messages already spooled again for the
+    recipients that refused them temporarily are done with.
+    """
+    pending = spool.claim(batch_size)
+    if not pending:
+        # Don't open a session to the server for nothing.
+        return 0
+    num_sent = 0
+    try:
+        with connection:
+            while pending:
+                name, message = pending.pop(0)
+                try:
+                    sent = connection.send_messages([message])
+                except RecipientsDeferred as exc:
+                    logger.info('Spooled message %s was refused, it will be retried: %s', name, exc)
+                    spool.complete(name)
+                    continue
+                except Exception as exc:
+                    if is_permanent_failure(exc):
+                        logger.error('Spooled message %s was rejected: %s', name, exc)
+                        spool.fail(name)
+                    else:
+                        _defer(spool, name, message, exc, max_failures, retry_delay)
+                        # The failure may have left the session unusable.
+                        connection.close()
+                        connection.open()
+                    continue
+                if sent:
+                    spool.complete(name)
+                    num_sent += 1
+                else:
+                    spool.fail(name)
+    except Exception as exc:
+        logger.warning('Failed to send spooled messages, %d will be retried: %s', len(pending), exc)
+        for name, message in pending:
+            _defer(spool, name, message, exc, max_failures, retry_delay)
+    return num_sent
+
+
+def _defer(spool, name, message, exc, max_failures, retry_delay):
+    """Put back in the spool a message that failed with ``exc``, or set it aside."""
+    failures = message.failures + 1
+    if max_failures is not None and failures >= max_failures:
+        logger.error('Spooled message %s failed %d times, giving up: %s', name, failures, exc)
+        spool.fail(name)
+        return
+    recipients = message.recipients()
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        # The recipients that refused it permanently won't accept it later.
+        recipients = [addr for addr, (code, msg) in exc.recipients.items() if code < 500]
+    retry = SpooledMessage(
+        message.from_email,
+        recipients,
+        message.data,
+        encoding=message.encoding,
+        subject=message.subject,
+        attempts=message.attempts,
+        failures=failures,
+    )
+    spool.defer(name, retry, retry_delay * 2 ** (failures - 1))
+
+
+class EmailBackend(BaseEmailBackend):
+    """
+    Write messages to the spool directory, durably, instead of sending them.
+    They are delivered through MAIL_SPOOL_BACKEND by ``flask mailman worker``.
+    """
+
+    def __init__(self, *args, spool_path=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        spool_path = spool_path or self.mailman.spool_path
+        if not spool_path:
+            raise ImproperlyConfigured('MAIL_SPOOL_PATH must be set to use the spool backend.')
+        self.spool = Spool(spool_path, fsync=self.mailman.spool_fsync)
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        try:
+            return self.spool.put(email_messages)
+        except Exception:
+            if not self.fail_silently:
+                raise
+            return 0
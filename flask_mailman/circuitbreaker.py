@@ -0,0 +1,104 @@
+"""
+Failing fast while the mail server is unreachable.
+"""
+import smtplib
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(smtplib.SMTPException):
+    """The mail server failed too many times, it isn't tried for now."""
+
+    pass
+
+
+class CircuitBreaker:
+    """
+    A thread-safe circuit breaker guarding the connections to a mail server.
+
+    After ``threshold`` consecutive connection failures the circuit opens:
+    check() raises CircuitOpen right away instead of letting callers wait
+    for the server to time out. Once ``cooldown`` seconds have passed the
+    circuit half-opens and a single caller is let through to probe the
+    server. The circuit closes again if it connects, and opens for another
+    ``cooldown`` seconds if it doesn't.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        if threshold < 1:
+            raise ValueError('threshold must be at least 1.')
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """The state of the circuit: 'closed', 'open' or 'half_open'."""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                return HALF_OPEN
+            return self._state
+
+    @property
+    def is_open(self):
+        """Whether check() would raise CircuitOpen."""
+        with self._lock:
+            return not self._allows(time.monotonic())
+
+    def _allows(self, now):
+        if self._state == CLOSED:
+            return True
+        if self._state == OPEN:
+            return now - self._opened_at >= self.cooldown
+        return not self._probing
+
+    def check(self):
+        """Raise CircuitOpen unless a connection may be attempted."""
+        with self._lock:
+            now = time.monotonic()
+            if not self._allows(now):
+                raise CircuitOpen('The mail server is unavailable, not trying to connect for now.')
+            if self._state != CLOSED:
+                self._state = HALF_OPEN
+                self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._state == HALF_OPEN or self.failures >= self.threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+def get_circuit_breaker(mailman, key):
+    """
+    Return the CircuitBreaker of the mail server identified by ``key``, or
+    None if MAIL_CIRCUIT_BREAKER_THRESHOLD isn't set.
+    """
+    if not mailman.circuit_breaker_threshold:
+        return None
+    # Shared by every backend instance, so that the failures of one request
+    # spare the next ones.
+    return mailman.get_shared_item(
+        'circuit_breakers',
+        key,
+        lambda: CircuitBreaker(
+            threshold=mailman.circuit_breaker_threshold,
+            cooldown=mailman.circuit_breaker_cooldown,
+        ),
+    )
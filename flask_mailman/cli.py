@@ -0,0 +1,40 @@
+"""
+Command line interface, available as ``flask mailman``.
+"""
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from flask_mailman.backends.spool import Spool, drain
+
+mailman_cli = AppGroup('mailman', help='Flask-Mailman commands.')
+
+
+@mailman_cli.command('worker')
+@click.option('--batch-size', default=100, show_default=True, help='Messages sent per SMTP session.')
+@click.option('--interval', default=1.0, show_default=True, help='Seconds to wait when there is nothing to send.')
+@click.option('--once', is_flag=True, help='Exit when there is nothing left to send.')
+def worker(batch_size, interval, once):
+    """Deliver the messages stored by the spool backend."""
+    mailman = current_app.extensions['mailman']
+    if not mailman.spool_path:
+        raise click.UsageError('MAIL_SPOOL_PATH is not configured.')
+    spool = Spool(mailman.spool_path, fsync=mailman.spool_fsync)
+    # Messages left behind by a worker that died while sending them.
+    spool.recover()
+    while True:
+        num_sent = drain(
+            spool,
+            mailman.get_connection(backend=mailman.spool_backend),
+            batch_size,
+            max_failures=mailman.spool_max_failures,
+            retry_delay=mailman.spool_retry_delay,
+        )
+        if num_sent:
+            click.echo('Sent %d message(s).' % num_sent)
+        elif once:
+            break
+        else:
+            time.sleep(interval)
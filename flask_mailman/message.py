@@ -1,7 +1,11 @@
+import copy
 import mimetypes
+import os
+from contextlib import ExitStack
 from email import charset as Charset
 from email import encoders as Encoders
 from email import generator, message_from_string
+from email._policybase import Compat32
 from email.errors import HeaderParseError
 from email.header import Header
 from email.headerregistry import Address, parser
@@ -10,12 +14,15 @@ from email.mime.base import MIMEBase
 from email.mime.message import MIMEMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.utils import formataddr, formatdate, getaddresses, make_msgid
+from email.utils import _has_surrogates, escapesre, formataddr, formatdate, getaddresses, make_msgid, specialsre
+from functools import lru_cache
 from io import BytesIO, StringIO
 from pathlib import Path
+from string import Template
 
 from flask import current_app
 
+from flask_mailman.attachments import FileContent, MIMEFile, get_attachment_cache
 from flask_mailman.utils import DNS_NAME, force_str, punycode
 
 # Don't BASE64-encode UTF-8 messages so that we avoid unwanted attention from
@@ -31,6 +38,10 @@ DEFAULT_ATTACHMENT_MIME_TYPE = 'application/octet-stream'
 
 RFC5322_EMAIL_LINE_LENGTH_LIMIT = 998
 
+# Number of sanitized addresses and encoded header values kept, as the same
+# senders and recipients come back from one message to the next.
+HEADER_CACHE_SIZE = 1024
+
 
 class BadHeaderError(ValueError):
     pass
@@ -52,29 +63,73 @@ ADDRESS_HEADERS = {
 }
 
 
-def forbid_multi_line_headers(name, val, encoding):
-    """Forbid multi-line headers to prevent header injection."""
+class SMTPUTF8Policy(Compat32):
+    """
+    The compat32 policy, except that non-ASCII header values are written as
+    UTF-8 (RFC 6532) instead of being encoded as RFC 2047 encoded words.
+    """
+
+    utf8 = True
+
+    def _fold(self, name, value, sanitize):
+        if not isinstance(value, str) or value.isascii() or _has_surrogates(value):
+            return super()._fold(name, value, sanitize)
+        # Fold on spaces only, the value has no encoded words to split.
+        words = value.split(' ')
+        lines = ['%s: %s' % (name, words[0])]
+        for word in words[1:]:
+            if word and self.max_line_length and len(lines[-1]) + len(word) >= self.max_line_length:
+                lines.append(' ' + word)
+            else:
+                lines[-1] += ' ' + word
+        return self.linesep.join(lines) + self.linesep
+
+    def fold_binary(self, name, value):
+        folded = self._fold(name, value, sanitize=self.cte_type == '7bit')
+        return folded.encode('utf-8', 'surrogateescape')
+
+
+smtputf8_policy = SMTPUTF8Policy()
+
+
+def forbid_multi_line_headers(name, val, encoding, utf8=False):
+    """
+    Forbid multi-line headers to prevent header injection. Unless ``utf8``
+    is True, non-ASCII values are encoded.
+    """
     encoding = encoding or current_app.extensions['mailman'].default_charset
     val = str(val)  # val may be lazy
     if '\n' in val or '\r' in val:
         raise BadHeaderError("Header values can't contain newlines (got %r for header %r)" % (val, name))
+    if utf8:
+        return name, val
     try:
         val.encode('ascii')
     except UnicodeEncodeError:
-        if name.lower() in ADDRESS_HEADERS:
-            val = ', '.join(sanitize_address(addr, encoding) for addr in getaddresses((val,)))
-        else:
-            val = Header(val, encoding).encode()
+        val = _cached(_encode_header, _encode_header_cached, name.lower() in ADDRESS_HEADERS, val, encoding)
     else:
         if name.lower() == 'subject':
             val = Header(val).encode()
     return name, val
 
 
-def sanitize_address(addr, encoding):
+def _encode_header(is_address, val, encoding):
+    if is_address:
+        return ', '.join(sanitize_address(addr, encoding) for addr in getaddresses((val,)))
+    return Header(val, encoding).encode()
+
+
+def sanitize_address(addr, encoding, utf8=False):
     """
-    Format a pair of (name, address) or an email address string.
+    Format a pair of (name, address) or an email address string. Unless
+    ``utf8`` is True, non-ASCII names and local parts are encoded.
+
+    The results are cached, see sanitize_address.cache_info().
     """
+    return _cached(_sanitize_address, _sanitize_address_cached, addr, encoding, utf8)
+
+
+def _sanitize_address(addr, encoding, utf8=False):
     address = None
     if not isinstance(addr, tuple):
         addr = force_str(addr)
@@ -97,6 +152,9 @@ def sanitize_address(addr, encoding):
     if '\n' in address_parts or '\r' in address_parts:
         raise ValueError('Invalid address; address parts cannot contain newlines.')
 
+    if utf8:
+        return _formataddr_utf8(nm, Address(username=localpart, domain=punycode(domain)).addr_spec)
+
     # Avoid UTF-8 encode, if it's possible.
     try:
         nm.encode('ascii')
@@ -113,6 +171,153 @@ def sanitize_address(addr, encoding):
     return formataddr((nm, parsed_address.addr_spec))
 
 
+_sanitize_address_cached = lru_cache(maxsize=HEADER_CACHE_SIZE)(_sanitize_address)
+_encode_header_cached = lru_cache(maxsize=HEADER_CACHE_SIZE)(_encode_header)
+
+# Hits and misses of the caches, like functools.lru_cache.
+sanitize_address.cache_info = _sanitize_address_cached.cache_info
+sanitize_address.cache_clear = _sanitize_address_cached.cache_clear
+forbid_multi_line_headers.cache_info = _encode_header_cached.cache_info
+forbid_multi_line_headers.cache_clear = _encode_header_cached.cache_clear
+
+
+def _cached(func, cached_func, *args):
+    try:
+        hash(args)
+    except TypeError:
+        # e.g. a Charset instance as encoding.
+        return func(*args)
+    return cached_func(*args)
+
+
+def _formataddr_utf8(name, address):
+    # Like formataddr(), for names written as is in UTF-8 headers.
+    if not name:
+        return address
+    quotes = '"' if specialsre.search(name) else ''
+    return '%s%s%s <%s>' % (quotes, escapesre.sub(r'\\\g<0>', name), quotes, address)
+
+
+def _is_lazy_file(msg):
+    return isinstance(msg, MIMEFile) and msg.is_lazy
+
+
+def _lazy_files(msg):
+    return [part for part in msg.walk() if _is_lazy_file(part)]
+
+
+def _may_have_surrogates(payload):
+    # str.isascii() is cheap, _has_surrogates() encodes the whole string.
+    return isinstance(payload, str) and not payload.isascii() and _has_surrogates(payload)
+
+
+class StreamingGenerator(generator.BytesGenerator):
+    """
+    A BytesGenerator writing the headers and payload of each part straight
+    to the output file as it goes, instead of first building every part in
+    memory, so large messages can be written to a socket in small pieces.
+
+    The boundaries of multipart messages are picked before their parts are
+    written, so they aren't checked against the parts' content. They are
+    random, like those of BytesGenerator.
+
+    File attachments are read and encoded in chunks as they're written.
+    """
+
+    def _write(self, msg):
+        if not _is_lazy_file(msg) and _may_have_surrogates(msg._payload):
+            # The generator may have to re-encode the payload and change the
+            # headers accordingly, let it buffer the part.
+            return super()._write(msg)
+        if msg.is_multipart() and msg.get_boundary() is None:
+            msg.set_boundary(self._make_boundary())
+        meth = getattr(msg, '_write_headers', None)
+        if meth is None:
+            self._write_headers(msg)
+        else:
+            meth(self)
+        self._dispatch(msg)
+
+    def _handle_text(self, msg):
+        if _is_lazy_file(msg):
+            for chunk in msg.file_content.iter_base64():
+                self._write_lines(chunk)
+            return
+        payload = msg._payload
+        if not isinstance(payload, str) or _may_have_surrogates(payload):
+            return super()._handle_text(msg)
+        # Generator._handle_text() without its checks for surrogates, which
+        # encode the whole payload.
+        if self._mangle_from_:
+            payload = generator.fcre.sub('>From ', payload)
+        self._write_lines(payload)
+
+    # Parts of other types are written as text.
+    _writeBody = _handle_text
+
+    def _handle_multipart(self, msg):
+        subparts = msg.get_payload()
+        if subparts is None:
+            subparts = []
+        elif isinstance(subparts, str):
+            self.write(subparts)
+            return
+        elif not isinstance(subparts, list):
+            subparts = [subparts]
+        boundary = msg.get_boundary()
+        if msg.preamble is not None:
+            self._write_lines(msg.preamble)
+            self.write(self._NL)
+        self.write('--' + boundary + self._NL)
+        for i, part in enumerate(subparts):
+            if i:
+                self.write(self._NL + '--' + boundary + self._NL)
+            self.clone(self._fp).flatten(part, unixfrom=False, linesep=self._NL)
+        self.write(self._NL + '--' + boundary + '--' + self._NL)
+        if msg.epilogue is not None:
+            self._write_lines(msg.epilogue)
+
+    def _write_lines(self, lines):
+        # Like Generator._write_lines(), without splitting the whole payload
+        # in a list of lines first.
+        start = 0
+        for match in generator.NLCRE.finditer(lines):
+            self.write(lines[start : match.start()] + self._NL)
+            start = match.end()
+        if start < len(lines):
+            self.write(lines[start:])
+
+    def _handle_message(self, msg):
+        payload = msg._payload
+        if isinstance(payload, list):
+            self.clone(self._fp).flatten(msg.get_payload(0), unixfrom=False, linesep=self._NL)
+        else:
+            self._fp.write(self._encode(payload))
+
+
+def _message_state(msg):
+    # The headers and payloads of a message and of all its parts, to tell when it changed.
+    # The file of a lazy attachment isn't read, its FileContent stands for it.
+    payload = msg.file_content if _is_lazy_file(msg) else msg._payload
+    if isinstance(payload, list):
+        payload = [(part, _message_state(part)) for part in payload]
+    return list(msg._headers), payload
+
+
+def _freeze(attrs):
+    # A copy of the public attributes of an EmailMessage, to tell when they change.
+    frozen = {}
+    for name, value in attrs.items():
+        if name.startswith('_') or name == 'connection':
+            continue
+        if isinstance(value, list):
+            value = tuple(value)
+        elif isinstance(value, dict):
+            value = tuple(value.items())
+        frozen[name] = value
+    return frozen
+
+
 class MIMEMixin:
     def as_string(self, unixfrom=False, linesep='\n'):
         """Return the entire formatted message as a string.
@@ -124,7 +329,12 @@ class MIMEMixin:
         """
         fp = StringIO()
         g = generator.Generator(fp, mangle_from_=False)
-        g.flatten(self, unixfrom=unixfrom, linesep=linesep)
+        with ExitStack() as stack:
+            # The generator reads the payloads several times, encode the
+            # file attachments only once.
+            for part in _lazy_files(self):
+                stack.enter_context(part.encoded())
+            g.flatten(self, unixfrom=unixfrom, linesep=linesep)
         return fp.getvalue()
 
     def as_bytes(self, unixfrom=False, linesep='\n'):
@@ -134,11 +344,35 @@ class MIMEMixin:
 
         This overrides the default as_bytes() implementation to not mangle
         lines that begin with 'From '. See bug #13433 for details.
+
+        The bytes are kept for each linesep, and returned again as long as
+        the headers and payloads of the message and its parts don't change,
+        unless the message has file attachments read lazily: these are
+        encoded once, chunk by chunk, and not kept in memory.
         """
+        if _lazy_files(self):
+            fp = BytesIO()
+            StreamingGenerator(fp, mangle_from_=False).flatten(self, unixfrom=unixfrom, linesep=linesep)
+            return fp.getvalue()
+        cache = self.__dict__.setdefault('_bytes_cache', {})
+        cached = cache.get(linesep)
+        if not unixfrom and cached is not None and cached[0] == _message_state(self):
+            return cached[1]
         fp = BytesIO()
         g = generator.BytesGenerator(fp, mangle_from_=False)
         g.flatten(self, unixfrom=unixfrom, linesep=linesep)
-        return fp.getvalue()
+        data = fp.getvalue()
+        if not unixfrom:
+            cache[linesep] = (_message_state(self), data)
+        return data
+
+    def write_to(self, fp, linesep='\n'):
+        """
+        Write the message as bytes to the file object ``fp`` while it's
+        flattened, like as_bytes() but without building it in memory.
+        """
+        g = StreamingGenerator(fp, mangle_from_=False)
+        g.flatten(self, linesep=linesep)
 
 
 class SafeMIMEMessage(MIMEMixin, MIMEMessage):
@@ -154,7 +388,7 @@ class SafeMIMEText(MIMEMixin, MIMEText):
         MIMEText.__init__(self, _text, _subtype=_subtype, _charset=_charset)
 
     def __setitem__(self, name, val):
-        name, val = forbid_multi_line_headers(name, val, self.encoding)
+        name, val = forbid_multi_line_headers(name, val, self.encoding, getattr(self.policy, 'utf8', False))
         MIMEText.__setitem__(self, name, val)
 
     def set_payload(self, payload, charset=None):
@@ -172,7 +406,7 @@ class SafeMIMEMultipart(MIMEMixin, MIMEMultipart):
         MIMEMultipart.__init__(self, _subtype, boundary, _subparts, **_params)
 
     def __setitem__(self, name, val):
-        name, val = forbid_multi_line_headers(name, val, self.encoding)
+        name, val = forbid_multi_line_headers(name, val, self.encoding, getattr(self.policy, 'utf8', False))
         MIMEMultipart.__setitem__(self, name, val)
 
 
@@ -248,9 +482,38 @@ class EmailMessage:
         return self.connection
 
     def message(self):
+        """
+        Return the MIME message. It's built once and returned again as long as
+        neither the attributes of the EmailMessage nor the headers and parts
+        of the message change, so sending it again doesn't rebuild it.
+        """
+        return self._get_message(current_app.extensions['mailman'].use_smtputf8)
+
+    def _get_message(self, smtputf8):
+        """
+        Return the MIME message, with UTF-8 headers if ``smtputf8`` is True
+        and encoded non-ASCII headers otherwise.
+        """
+        mailman = current_app.extensions['mailman']
+        key = (_freeze(vars(self)), mailman.default_charset, mailman.use_localtime, smtputf8)
+        cached = self.__dict__.get('_message_cache')
+        if cached is not None and cached[0] == key and cached[2] == _message_state(cached[1]):
+            return cached[1]
+        msg = self._build_message(smtputf8)
+        self._message_cache = (key, msg, _message_state(msg))
+        return msg
+
+    def _build_message(self, smtputf8=False):
         encoding = self.encoding or current_app.extensions['mailman'].default_charset
         msg = SafeMIMEText(self.body, self.content_subtype, encoding)
         msg = self._create_message(msg)
+        if msg.is_multipart():
+            # Pick the boundary now, rather than when the message is flattened,
+            # so that flattening it doesn't change its headers.
+            msg.set_boundary(generator.Generator._make_boundary())
+        if smtputf8:
+            # Write the headers in UTF-8 (RFC 6532) rather than encoding them.
+            msg.policy = smtputf8_policy
         msg['Subject'] = self.subject
         msg['From'] = self.extra_headers.get('From', self.from_email)
         self._set_list_header_if_not_empty(msg, 'To', self.to)
@@ -289,6 +552,14 @@ class EmailMessage:
             return 0
         return self.get_connection(fail_silently).send_messages([self])
 
+    async def send_async(self, fail_silently=False):
+        """Send the email message from a coroutine."""
+        if not self.recipients():
+            # Don't bother creating the network connection if there's nobody to
+            # send to.
+            return 0
+        return await self.get_connection(fail_silently).send_messages_async([self])
+
     def attach(self, filename=None, content=None, mimetype=None):
         """
         Attach a file with the given filename and content. The filename can
@@ -322,9 +593,10 @@ class EmailMessage:
 
             self.attachments.append((filename, content, mimetype))
 
-    def attach_file(self, path, mimetype=None):
+    def attach_file(self, path, mimetype=None, lazy=False):
         """
-        Attach a file from the filesystem.
+        Attach a file from the filesystem, given its path or a binary file
+        object.
 
         Set the mimetype to DEFAULT_ATTACHMENT_MIME_TYPE if it isn't specified
         and cannot be guessed.
@@ -332,11 +604,37 @@ class EmailMessage:
         For a text/* mimetype (guessed or specified), decode the file's content
         as UTF-8. If that fails, set the mimetype to
         DEFAULT_ATTACHMENT_MIME_TYPE and don't decode the content.
+
+        If ``lazy`` is True, other files aren't read until the message is
+        serialized, and then in chunks if it's streamed, so that their content
+        isn't held in memory while the message waits to be sent. The file must
+        then be left in place, or the file object open and unchanged, until
+        the message is sent.
         """
-        path = Path(path)
-        with path.open('rb') as file:
-            content = file.read()
-            self.attach(path.name, content, mimetype)
+        if hasattr(path, 'read'):
+            file = path
+            name = getattr(file, 'name', None)
+            filename = os.path.basename(name) if isinstance(name, str) else None
+        else:
+            path = Path(path)
+            file = None
+            filename = path.name
+        mimetype = mimetype or mimetypes.guess_type(filename or '')[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+        if not lazy or mimetype.startswith('text/') or mimetype == 'message/rfc822':
+            # Text is decoded and re-encoded with the message's charset.
+            if file is None:
+                with path.open('rb') as file:
+                    content = file.read()
+            else:
+                content = file.read()
+            self.attach(filename, content, mimetype)
+            return
+        if file is None:
+            # Fail now rather than when the message is sent if the file
+            # can't be read.
+            path.open('rb').close()
+            file = path
+        self.attach(filename, FileContent(file), mimetype)
 
     def _create_message(self, msg):
         return self._create_attachments(msg)
@@ -380,9 +678,16 @@ class EmailMessage:
             attachment = SafeMIMEMessage(content, subtype)
         else:
             # Encode non-text attachments with base64.
+            if isinstance(content, FileContent):
+                return MIMEFile(basetype, subtype, content)
             attachment = MIMEBase(basetype, subtype)
-            attachment.set_payload(content)
-            Encoders.encode_base64(attachment)
+            cache = get_attachment_cache(current_app.extensions['mailman'])
+            if cache is not None and isinstance(content, bytes):
+                attachment.set_payload(cache.encode_base64(content))
+                attachment['Content-Transfer-Encoding'] = 'base64'
+            else:
+                attachment.set_payload(content)
+                Encoders.encode_base64(attachment)
         return attachment
 
     def _create_attachment(self, filename, content, mimetype=None):
@@ -470,5 +775,98 @@ class EmailMultiAlternatives(EmailMessage):
             if self.body:
                 msg.attach(body_msg)
             for alternative in self.alternatives:
-                msg.attach(self._create_mime_attachment(*alternative))
+                if isinstance(alternative, MIMEBase):
+                    msg.attach(alternative)
+                else:
+                    msg.attach(self._create_mime_attachment(*alternative))
         return msg
+
+
+class MergeTemplate(Template):
+    """
+    A string.Template leaving a ``$`` that doesn't start a placeholder as
+    is, e.g. in ``Only $5 today``, instead of raising ValueError. ``$$``
+    still stands for a ``$``, e.g. to write ``$$name`` literally.
+    """
+
+    pattern = r"""
+    \$(?:
+      (?P<escaped>\$) |
+      (?P<named>(?a:[_a-z][_a-z0-9]*)) |
+      {(?P<braced>(?a:[_a-z][_a-z0-9]*))} |
+      (?P<invalid>(?!))
+    )
+    """
+
+    def has_placeholders(self):
+        """Whether substitute() may change the text."""
+        return self.pattern.search(self.template) is not None
+
+
+class MailMerge:
+    """
+    Build one message per recipient from a template EmailMessage (or
+    EmailMultiAlternatives), whose subject, body, alternatives and extra
+    headers may contain string.Template placeholders such as ``$name``, see
+    MergeTemplate.
+
+    The attachments, and the alternatives without placeholders, are built
+    and encoded once and shared by all the messages.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self._subject = MergeTemplate(str(template.subject))
+        self._body = MergeTemplate(template.body)
+        self._headers = {name: MergeTemplate(str(value)) for name, value in template.extra_headers.items()}
+        self._attachments = [
+            attachment if isinstance(attachment, MIMEBase) else template._create_attachment(*attachment)
+            for attachment in template.attachments
+        ]
+        for attachment in self._attachments:
+            if _is_lazy_file(attachment):
+                # Read the file once rather than for every message.
+                attachment.set_payload(attachment.file_content.encode_base64())
+        self._alternatives = []
+        for alternative in getattr(template, 'alternatives', ()):
+            if not isinstance(alternative, MIMEBase):
+                content, mimetype = alternative
+                if isinstance(content, str) and MergeTemplate(content).has_placeholders():
+                    alternative = (MergeTemplate(content), mimetype)
+                else:
+                    alternative = template._create_mime_attachment(content, mimetype)
+            self._alternatives.append(alternative)
+
+    def messages(self, recipients):
+        """
+        Yield a message for each ``(to, context)`` pair of ``recipients``,
+        ``to`` being an address or a list of addresses and ``context`` the
+        mapping the placeholders are substituted from. A missing placeholder
+        raises KeyError.
+        """
+        for to, context in recipients:
+            message = copy.copy(self.template)
+            message.__dict__.pop('_message_cache', None)
+            message.to = [to] if isinstance(to, str) else list(to)
+            message.subject = self._subject.substitute(context)
+            message.body = self._body.substitute(context)
+            message.extra_headers = {name: value.substitute(context) for name, value in self._headers.items()}
+            message.attachments = list(self._attachments)
+            if self._alternatives:
+                message.alternatives = [self._alternative(alternative, context) for alternative in self._alternatives]
+            yield message
+
+    @staticmethod
+    def _alternative(alternative, context):
+        if isinstance(alternative, MIMEBase):
+            return alternative
+        content, mimetype = alternative
+        return content.substitute(context), mimetype
+
+    def send(self, recipients, fail_silently=False):
+        """
+        Send a message to each ``(to, context)`` pair of ``recipients`` over
+        the template's connection and return the number of messages sent.
+        """
+        connection = self.template.get_connection(fail_silently)
+        return connection.send_messages(self.messages(recipients))
@@ -0,0 +1,85 @@
+"""
+Smoothing the rate at which messages are handed to the mail server.
+"""
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket letting through ``rate`` messages per second
+    on average, and bursts of up to ``capacity`` messages.
+
+    Callers reserve their token before waiting for it, so they are served in
+    the order they arrived, and the sleep happens outside of the lock.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive.')
+        self.rate = rate
+        self.capacity = max(1, rate) if capacity is None else capacity
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _reserve(self, tokens):
+        """Take ``tokens`` and return the seconds to wait until they are available."""
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+    def try_acquire(self, tokens=1):
+        """
+        Take ``tokens`` if they are available right away and return 0,
+        otherwise return the seconds until they are, without taking them.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Block until ``tokens`` messages may be sent."""
+        delay = self._reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens=1):
+        """Wait, without blocking the event loop, until ``tokens`` messages may be sent."""
+        delay = self._reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def get_rate_limiter(mailman, host):
+    """
+    Return the TokenBucket limiting the messages sent to ``host``, or to all
+    hosts unless MAIL_RATE_LIMIT_PER_HOST is set. Return None if
+    MAIL_RATE_LIMIT isn't set.
+    """
+    if not mailman.rate_limit:
+        return None
+    key = host if mailman.rate_limit_per_host else None
+    return mailman.get_shared_item(
+        'rate_limiters', key, lambda: TokenBucket(mailman.rate_limit, mailman.rate_limit_burst)
+    )
+
+
+def get_domain_rate_limiter(mailman, domain):
+    """
+    Return the TokenBucket limiting the messages sent to the recipients of
+    ``domain``, or None if MAIL_DOMAIN_RATE_LIMIT isn't set.
+    """
+    if not mailman.domain_rate_limit:
+        return None
+    return mailman.get_shared_item('domain_rate_limiters', domain, lambda: TokenBucket(mailman.domain_rate_limit))
@@ -0,0 +1,127 @@
+"""
+Spreading SMTP connections over several relay hosts.
+"""
+import threading
+import time
+import weakref
+
+STRATEGIES = ('round_robin', 'least_outstanding')
+
+
+class Relay:
+    """A relay host, with its share of the connections and its health."""
+
+    def __init__(self, host, port, weight=1):
+        if weight < 1:
+            raise ValueError('Relay weight must be at least 1, got %r.' % weight)
+        self.host = host
+        self.port = port
+        self.weight = weight
+        # Number of connections to the relay currently open.
+        self.outstanding = 0
+        # time.monotonic() until which the relay is left out after failing.
+        self.ejected_until = 0.0
+        # Running weight of the smooth weighted round-robin.
+        self._current_weight = 0
+
+    def __repr__(self):
+        return '<%s %s:%s weight=%d>' % (self.__class__.__name__, self.host, self.port, self.weight)
+
+
+class RelaySet:
+    """
+    A thread-safe set of relay hosts connections are distributed over, in
+    proportion to their weights (``strategy='round_robin'``) or to whichever
+    has the fewest open connections per weight (``'least_outstanding'``).
+
+    A relay that can't be connected to is ejected for ``eject_time`` seconds:
+    it is only tried again, as a last resort, when every other relay fails.
+    """
+
+    def __init__(self, relays, strategy='round_robin', eject_time=30):
+        if strategy not in STRATEGIES:
+            raise ValueError('strategy must be one of %s, got %r.' % (', '.join(STRATEGIES), strategy))
+        if not relays:
+            raise ValueError('At least one relay is required.')
+        self.relays = list(relays)
+        self.strategy = strategy
+        self.eject_time = eject_time
+        # Reentrant, the connections' finalizers may run while it's held.
+        self._lock = threading.RLock()
+
+    def candidates(self):
+        """Return the relays in the order they should be tried."""
+        with self._lock:
+            now = time.monotonic()
+            healthy = [relay for relay in self.relays if relay.ejected_until <= now]
+            ejected = sorted(
+                (relay for relay in self.relays if relay.ejected_until > now), key=lambda relay: relay.ejected_until
+            )
+            if not healthy:
+                return ejected
+            if self.strategy == 'least_outstanding':
+                healthy.sort(key=lambda relay: relay.outstanding / relay.weight)
+            else:
+                first = self._next_round_robin(healthy)
+                index = healthy.index(first)
+                healthy = healthy[index:] + healthy[:index]
+        return healthy + ejected
+
+    def _next_round_robin(self, relays):
+        # Smooth weighted round-robin: a relay of weight 3 among relays of
+        # weight 1 is picked every other time rather than 3 times in a row.
+        total = 0
+        best = None
+        for relay in relays:
+            relay._current_weight += relay.weight
+            total += relay.weight
+            if best is None or relay._current_weight > best._current_weight:
+                best = relay
+        best._current_weight -= total
+        return best
+
+    def connected(self, relay, connection):
+        """Count ``connection`` as open on ``relay`` until it is garbage collected."""
+        with self._lock:
+            relay.outstanding += 1
+            relay.ejected_until = 0.0
+        weakref.finalize(connection, self._disconnected, relay)
+
+    def _disconnected(self, relay):
+        with self._lock:
+            relay.outstanding -= 1
+
+    def failed(self, relay):
+        """Eject a relay that couldn't be connected to."""
+        with self._lock:
+            relay.ejected_until = time.monotonic() + self.eject_time
+
+
+def parse_relay(relay, default_port):
+    """
+    Build a Relay from a MAIL_RELAYS entry: a ``'host[:port]'`` string or a
+    dict with ``host`` and optional ``port`` and ``weight`` keys.
+    """
+    if isinstance(relay, dict):
+        return Relay(relay['host'], int(relay.get('port', default_port)), relay.get('weight', 1))
+    if relay.startswith('['):
+        # [IPv6 address]:port
+        host, _, port = relay[1:].partition(']')
+        port = port.lstrip(':')
+    elif relay.count(':') == 1:
+        host, port = relay.split(':')
+    else:
+        host, port = relay, ''
+    return Relay(host, int(port) if port else default_port)
+
+
+def get_relay_set(mailman):
+    """Return the RelaySet shared by the backends of the mail state."""
+    return mailman.get_shared(
+        'relay_set',
+        lambda: RelaySet(
+            [parse_relay(relay, mailman.port) for relay in mailman.relays],
+            strategy=mailman.relay_strategy,
+            eject_time=mailman.relay_eject_time,
+        ),
+    )
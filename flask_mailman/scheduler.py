@@ -0,0 +1,85 @@
+"""
+Interleaving bulk mail transactions across destination domains.
+"""
+import threading
+from collections import Counter, deque
+from email.utils import parseaddr
+
+
+def recipient_domain(address):
+    """Return the lowercased domain of a sanitized address."""
+    return parseaddr(address)[1].rpartition('@')[2].lower()
+
+
+class Transaction:
+    """A message to send to the recipients it has in a single domain."""
+
+    def __init__(self, message, domain, recipients, msg=None):
+        self.message = message
+        self.domain = domain
+        self.recipients = recipients
+        # The serialized message, when it's shared by several transactions.
+        self.msg = msg
+
+    def __repr__(self):
+        return '<%s %s (%d recipients)>' % (self.__class__.__name__, self.domain, len(self.recipients))
+
+
+class DomainScheduler:
+    """
+    Hand out transactions to worker threads round-robin across domains, so
+    that a large or throttled domain doesn't hold up the others.
+
+    At most ``concurrency`` transactions of a domain are handed out at once,
+    and a domain whose TokenBucket in ``rate_limiters`` is empty is skipped
+    until it refills. next() only blocks when no domain is ready.
+    """
+
+    def __init__(self, transactions, concurrency=None, rate_limiters=None):
+        self._pending = {}
+        for transaction in transactions:
+            self._pending.setdefault(transaction.domain, deque()).append(transaction)
+        # Domains with pending transactions, the next one to serve on the left.
+        self._domains = deque(self._pending)
+        self._active = Counter()
+        self.concurrency = concurrency
+        self.rate_limiters = rate_limiters or {}
+        self._cond = threading.Condition(threading.Lock())
+
+    def next(self):
+        """Return the next transaction to send, or None when there are no more."""
+        with self._cond:
+            while self._domains:
+                wait = None
+                for _ in range(len(self._domains)):
+                    domain = self._domains[0]
+                    self._domains.rotate(-1)
+                    if self.concurrency and self._active[domain] >= self.concurrency:
+                        continue
+                    limiter = self.rate_limiters.get(domain)
+                    delay = limiter.try_acquire() if limiter is not None else 0
+                    if delay:
+                        wait = delay if wait is None else min(wait, delay)
+                        continue
+                    transactions = self._pending[domain]
+                    transaction = transactions.popleft()
+                    if not transactions:
+                        del self._pending[domain]
+                        self._domains.remove(domain)
+                    self._active[domain] += 1
+                    return transaction
+                # Every domain is busy or throttled: wait for a transaction
+                # to complete or a bucket to refill.
+                self._cond.wait(wait)
+            return None
+
+    def has_pending(self):
+        """Whether some transactions haven't been handed out yet."""
+        with self._cond:
+            return bool(self._domains)
+
+    def done(self, transaction):
+        """Release the slot of a transaction handed out by next()."""
+        with self._cond:
+            self._active[transaction.domain] -= 1
+            self._cond.notify_all()
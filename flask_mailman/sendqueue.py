@@ -0,0 +1,153 @@
+"""
+In-process queue sending email messages from background worker threads.
+"""
+import atexit
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+FULL_POLICIES = ('block', 'drop', 'raise')
+
+# Sentinel telling a worker to stop.
+_STOP = object()
+
+
+class SendQueue:
+    """
+    A bounded queue of EmailMessage objects delivered by a pool of worker
+    threads, so that the request handler doesn't wait for the mail server.
+
+    Each worker keeps its own backend connection open while there is work,
+    and sends up to ``batch_size`` queued messages per send_messages() call.
+    The connection is closed after ``idle_timeout`` seconds without messages.
+
+    When the queue is full, put() blocks (``full_policy='block'``, for at most
+    ``put_timeout`` seconds), drops the message (``'drop'``) or raises
+    queue.Full (``'raise'``).
+    """
+
+    def __init__(
+        self,
+        app,
+        maxsize=1000,
+        workers=1,
+        batch_size=100,
+        full_policy='block',
+        put_timeout=None,
+        idle_timeout=30,
+        backend=None,
+    ):
+        if full_policy not in FULL_POLICIES:
+            raise ValueError('full_policy must be one of %s, got %r.' % (', '.join(FULL_POLICIES), full_policy))
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.full_policy = full_policy
+        self.put_timeout = put_timeout
+        self.idle_timeout = idle_timeout
+        self.backend = backend
+        self._queue = queue.Queue(maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def put(self, message):
+        """
+        Queue a message to be sent. Return whether it was queued (False when
+        it was dropped because the queue is full).
+        """
+        self._start()
+        if self.full_policy == 'block':
+            self._queue.put(message, timeout=self.put_timeout)
+        elif self.full_policy == 'raise':
+            self._queue.put_nowait(message)
+        else:
+            try:
+                self._queue.put_nowait(message)
+            except queue.Full:
+                logger.warning('Email send queue is full, dropping message %r.', message.subject)
+                return False
+        return True
+
+    def qsize(self):
+        """Return the approximate number of messages waiting to be sent."""
+        return self._queue.qsize()
+
+    def join(self):
+        """Block until every queued message has been processed."""
+        self._queue.join()
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stop accepting messages and stop the workers once they have sent
+        everything that was queued. If ``wait`` is True, block until they
+        are done, or for at most ``timeout`` seconds.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(_STOP)
+        if wait:
+            for thread in threads:
+                thread.join(timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Cannot queue messages after shutdown.')
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name='flask-mailman-sender-%d' % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        atexit.register(self.shutdown)
+
+    def _work(self):
+        with self.app.app_context():
+            connection = self.app.extensions['mailman'].get_connection(backend=self.backend)
+            stop = False
+            try:
+                while not stop:
+                    try:
+                        message = self._queue.get(timeout=self.idle_timeout)
+                    except queue.Empty:
+                        # Don't hold an idle connection to the mail server.
+                        connection.close()
+                        continue
+                    batch = []
+                    while True:
+                        if message is _STOP:
+                            stop = True
+                        else:
+                            batch.append(message)
+                        if stop or len(batch) >= self.batch_size:
+                            break
+                        try:
+                            message = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                    self._send(connection, batch)
+                    for _ in range(len(batch) + stop):
+                        self._queue.task_done()
+            finally:
+                connection.close()
+
+    def _send(self, connection, batch):
+        if not batch:
+            return
+        try:
+            connection.open()
+            connection.send_messages(batch)
+        except Exception:
+            logger.exception('Failed to send %d queued email message(s).', len(batch))
+            # Start over with a fresh connection for the next batch.
+            try:
+                connection.close()
+            except Exception:
+                pass
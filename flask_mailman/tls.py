@@ -0,0 +1,87 @@
+"""
+SSL contexts and TLS sessions shared by the SMTP connections of an app.
+"""
+import ssl
+import threading
+
+
+class SharedContext:
+    """
+    An SSLContext built once and shared by every connection, with the last
+    TLS session of each server so that new connections resume it instead of
+    going through a full handshake.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        # (host, port) -> ssl.SSLSession
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def for_server(self, host, port):
+        """Return a context resuming the TLS session of ``host``:``port``."""
+        return _ResumingContext(self, (host, port))
+
+    def get_session(self, server):
+        with self._lock:
+            return self.sessions.get(server)
+
+    def save_session(self, server, sock):
+        """Keep the session of ``sock``, if it's a TLS socket, for the next connections."""
+        session = getattr(sock, 'session', None)
+        if session is None:
+            return
+        with self._lock:
+            self.sessions[server] = session
+
+    def forget_session(self, server):
+        with self._lock:
+            self.sessions.pop(server, None)
+
+
+class _ResumingContext:
+    """
+    Proxy of an SSLContext passing the cached session of a server to
+    wrap_socket(), which smtplib calls without one.
+    """
+
+    def __init__(self, shared, server):
+        self._shared = shared
+        self._server = server
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        kwargs.setdefault('session', self._shared.get_session(self._server))
+        try:
+            return self._shared.context.wrap_socket(sock, *args, **kwargs)
+        except ssl.SSLError:
+            # Don't try to resume a session the server may have rejected.
+            self._shared.forget_session(self._server)
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self._shared.context, name)
+
+
+def create_context(certfile=None, keyfile=None, verify=True):
+    """
+    Return a new client SSLContext, loaded with the client certificate if
+    any. Unless ``verify`` is True, the server's certificate isn't checked,
+    as smtplib does for STARTTLS without a context.
+    """
+    if verify:
+        context = ssl.create_default_context()
+    else:
+        context = ssl.SSLContext(protocol=ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if certfile or keyfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+def get_shared_context(mailman, certfile=None, keyfile=None, verify=True):
+    """Return the SharedContext of the mail state for these settings."""
+    key = (certfile, keyfile, verify)
+    return mailman.get_shared_item(
+        'ssl_contexts', key, lambda: SharedContext(create_context(certfile, keyfile, verify))
+    )
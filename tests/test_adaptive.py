@@ -0,0 +1,149 @@
+import threading
+import time
+from smtplib import SMTPResponseException
+from unittest.mock import Mock, patch
+
+from flask_mailman import EmailMessage
+from flask_mailman.adaptive import AdaptiveConcurrency
+from flask_mailman.backends import smtp
+from tests import TestCase
+
+
+class TestAdaptiveConcurrency(TestCase):
+    def test_additive_increase(self):
+        controller = AdaptiveConcurrency(initial=2, maximum=3)
+        controller.record(0.1)
+        self.assertEqual(controller.limit, 2)
+        controller.record(0.1)
+        self.assertEqual(controller.limit, 3)
+        for i in range(10):
+            controller.record(0.1)
+        self.assertEqual(controller.limit, 3)
+
+    def test_multiplicative_decrease(self):
+        controller = AdaptiveConcurrency(initial=8, maximum=10)
+        controller.record(0.1, pushed_back=True)
+        self.assertEqual(controller.limit, 4)
+        # The failures of the transactions in flight don't decrease it again.
+        for i in range(3):
+            controller.record(0.1, pushed_back=True)
+        self.assertEqual(controller.limit, 4)
+        controller.record(0.1, pushed_back=True)
+        self.assertEqual(controller.limit, 2)
+        for i in range(10):
+            controller.record(0.1, pushed_back=True)
+        self.assertEqual(controller.limit, 1)
+
+    def test_latency_target(self):
+        controller = AdaptiveConcurrency(initial=4, maximum=10, latency_target=1)
+        controller.record(2)
+        self.assertEqual(controller.limit, 2)
+
+    def test_acquire_blocks_at_limit(self):
+        controller = AdaptiveConcurrency(initial=1, maximum=2)
+        controller.acquire()
+        released = threading.Timer(0.05, controller.release)
+        released.start()
+        start = time.monotonic()
+        controller.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        released.join()
+        self.assertEqual(controller.in_use, 1)
+
+    def test_release_if_over_limit(self):
+        controller = AdaptiveConcurrency(initial=2, maximum=2)
+        controller.acquire()
+        controller.acquire()
+        self.assertFalse(controller.release_if_over_limit())
+        controller.record(0, pushed_back=True)
+        self.assertTrue(controller.release_if_over_limit())
+        self.assertFalse(controller.release_if_over_limit())
+        self.assertEqual(controller.in_use, 1)
+
+    def test_backend_adapts(self):
+        self.mail.state.smtp_concurrency_max = 4
+        emails = [EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"]) for i in range(20)]
+        backend = smtp.EmailBackend()
+        controller = backend.concurrency_controller
+        self.assertEqual(controller.limit, 1)
+        open_connections = []
+        peak = []
+        lock = threading.Lock()
+
+        def connect(self):
+            connection = Mock()
+            connection.has_extn.return_value = False
+            connection.sendmail.return_value = {}
+
+            def close():
+                with lock:
+                    open_connections.remove(connection)
+
+            connection.quit.side_effect = close
+            with lock:
+                open_connections.append(connection)
+                peak.append(len(open_connections))
+            return connection
+
+        with patch.object(smtp.EmailBackend, "_connect", connect):
+            self.assertEqual(backend.send_messages(emails), 20)
+        self.assertGreater(controller.limit, 1)
+        self.assertLessEqual(max(peak), 4)
+        self.assertEqual(controller.in_use, 0)
+
+    def test_backend_backs_off_on_throttling(self):
+        self.mail.state.smtp_concurrency = 4
+        self.mail.state.smtp_concurrency_max = 4
+        backend = smtp.EmailBackend(fail_silently=True)
+        backend.connection = Mock()
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        with patch.object(backend, "_sendmail", side_effect=SMTPResponseException(451, b"Slow down")):
+            backend._send(email)
+        self.assertEqual(backend.concurrency_controller.limit, 2)
+
+    def test_idle_workers_dont_connect(self):
+        self.mail.state.smtp_concurrency_max = 8
+        self.mail.state.smtp_latency_target = 0
+        emails = [EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"]) for i in range(20)]
+        backend = smtp.EmailBackend()
+        connections = []
+
+        def connect(self):
+            connection = Mock()
+            connection.has_extn.return_value = False
+            connection.sendmail.return_value = {}
+            connections.append(connection)
+            return connection
+
+        # Every transaction is too slow, the limit stays at 1.
+        with patch.object(smtp.EmailBackend, "_connect", connect):
+            self.assertEqual(backend.send_messages(emails), 20)
+        self.assertEqual(backend.concurrency_controller.limit, 1)
+        self.assertEqual([connection.sendmail.call_count for connection in connections], [20])
+
+    def test_single_message_respects_limit(self):
+        self.mail.state.smtp_concurrency_max = 4
+        backend = smtp.EmailBackend()
+        controller = backend.concurrency_controller
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        connect = Mock()
+        connect.return_value.has_extn.return_value = False
+        connect.return_value.sendmail.return_value = {}
+        sent = []
+
+        def send():
+            with self.app.app_context():
+                sent.append(backend.send_messages([email]))
+
+        # Another backend holds the only connection allowed.
+        controller.acquire()
+        with patch.object(smtp.EmailBackend, "_connect", connect):
+            sender = threading.Thread(target=send)
+            sender.start()
+            time.sleep(0.05)
+            connect.assert_not_called()
+            controller.release()
+            sender.join()
+        connect.assert_called_once_with()
+        self.assertEqual(sent, [1])
+        self.assertEqual(controller.in_use, 0)
@@ -0,0 +1,187 @@
+import os
+import tempfile
+from email import encoders
+from email.mime.base import MIMEBase
+from io import BytesIO
+from unittest import mock
+
+from flask_mailman import EmailMessage, MailMerge
+from flask_mailman.attachments import CHUNK_SIZE, EncodedAttachmentCache, FileContent, get_attachment_cache
+from flask_mailman.backends.smtp import _estimate_size
+from tests import TestCase
+
+
+class TestEncodedAttachmentCache(TestCase):
+    def test_encode_base64(self):
+        cache = EncodedAttachmentCache(max_size=1024 * 1024)
+        for content in (b"", b"content", b"content\n", os.urandom(1000)):
+            with self.subTest(content=content[:10]):
+                expected = MIMEBase("application", "octet-stream")
+                expected.set_payload(content)
+                encoders.encode_base64(expected)
+                self.assertEqual(cache.encode_base64(content), expected.get_payload())
+
+    def test_hits(self):
+        cache = EncodedAttachmentCache(max_size=1024)
+        payload = cache.encode_base64(b"content")
+        self.assertIs(cache.encode_base64(b"content"), payload)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(cache), 1)
+
+    def test_eviction(self):
+        cache = EncodedAttachmentCache(max_size=40)
+        payload_size = len(cache.encode_base64(b"attachment 0"))
+        cache.clear()
+        for content in (b"attachment 1", b"attachment 2", b"attachment 3"):
+            cache.encode_base64(content)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 2 * payload_size)
+        # The least recently used payload was evicted.
+        cache.encode_base64(b"attachment 2")
+        self.assertEqual(cache.hits, 1)
+        cache.encode_base64(b"attachment 1")
+        self.assertEqual(cache.misses, 5)
+
+    def test_too_large(self):
+        cache = EncodedAttachmentCache(max_size=10)
+        cache.encode_base64(b"content too large")
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_shared_by_messages(self):
+        content = os.urandom(1000)
+        payloads = []
+        for i in range(2):
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            email.attach("file.bin", content, "application/octet-stream")
+            attachment = email.message().get_payload()[1]
+            self.assertEqual(attachment["Content-Transfer-Encoding"], "base64")
+            self.assertEqual(attachment.get_payload(decode=True), content)
+            payloads.append(attachment.get_payload())
+        self.assertIs(payloads[0], payloads[1])
+        self.assertEqual(get_attachment_cache(self.mail.state).hits, 1)
+
+    def test_disabled(self):
+        self.mail.state.attachment_cache_size = None
+        self.assertIsNone(get_attachment_cache(self.mail.state))
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        email.attach("file.bin", b"content", "application/octet-stream")
+        self.assertEqual(email.message().get_payload()[1].get_payload(decode=True), b"content")
+
+
+class TestFileContent(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write_file(self, content, name="file.bin"):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "wb") as file:
+            file.write(content)
+        return path
+
+    def test_encode_base64(self):
+        for size in (0, 1, 56, 57, 58, 57 * 3, CHUNK_SIZE + 1):
+            content = os.urandom(size - 1) + b"\n" if size else b""
+            expected = MIMEBase("application", "octet-stream")
+            expected.set_payload(content)
+            encoders.encode_base64(expected)
+            expected = expected.get_payload()
+            path = self.write_file(content)
+            for file_content in (FileContent(path), FileContent(BytesIO(content))):
+                with self.subTest(size=size, file_content=file_content):
+                    self.assertEqual(file_content.encode_base64(), expected)
+                    self.assertEqual("".join(file_content.iter_base64(chunk_size=57 * 2)), expected)
+                    self.assertEqual(file_content.encoded_size(), len(expected))
+
+    def test_attach_file_lazy(self):
+        path = self.write_file(b"content")
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        email.attach_file(path, lazy=True)
+        filename, content, mimetype = email.attachments[0]
+        self.assertEqual((filename, mimetype), ("file.bin", "application/octet-stream"))
+        self.assertIsInstance(content, FileContent)
+        # The file is only read when the message is serialized.
+        self.write_file(b"new content")
+        attachment = email.message().get_payload()[1]
+        self.assertEqual(attachment.get_payload(decode=True), b"new content")
+        self.assertEqual(attachment.get_filename(), "file.bin")
+
+    def test_attach_file_lazy_flattened_once(self):
+        """Lazy attachments are encoded once per flatten and their bytes aren't kept."""
+        path = self.write_file(os.urandom(1000))
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        email.attach_file(path, lazy=True)
+        message = email.message()
+        expected = message.as_bytes()
+        encode = mock.patch.object(FileContent, "encode_base64", autospec=True, side_effect=FileContent.encode_base64)
+        iter_base64 = mock.patch.object(FileContent, "iter_base64", autospec=True, side_effect=FileContent.iter_base64)
+        with encode as encode, iter_base64 as iter_base64:
+            self.assertEqual(message.as_bytes(), expected)
+            self.assertEqual((encode.call_count, iter_base64.call_count), (0, 1))
+            self.assertEqual(message.as_string(), expected.decode())
+            self.assertEqual(encode.call_count, 1)
+        self.assertNotIn("_bytes_cache", vars(message))
+
+    def test_attach_file_eager(self):
+        with tempfile.NamedTemporaryFile(suffix=".bin") as file:
+            file.write(b"content")
+            file.flush()
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            email.attach_file(file.name)
+        # The file was read when attached.
+        self.assertEqual(email.attachments[0][1], b"content")
+        attachment = email.message().get_payload()[1]
+        self.assertEqual(attachment.get_payload(decode=True), b"content")
+
+    def test_attach_file_object(self):
+        path = self.write_file(b"header content")
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        with open(path, "rb") as file:
+            file.read(7)
+            email.attach_file(file, lazy=True)
+            attachment = email.message().get_payload()[1]
+            self.assertEqual(attachment.get_filename(), "file.bin")
+            self.assertEqual(attachment.get_payload(decode=True), b"content")
+        email.attach_file(BytesIO(b"content"), mimetype="image/png", lazy=True)
+        attachment = email.message().get_payload()[2]
+        self.assertIsNone(attachment.get_filename())
+        self.assertEqual(attachment.get_payload(decode=True), b"content")
+
+    def test_attach_text_file(self):
+        path = self.write_file(b"text content", name="file.txt")
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        email.attach_file(path, lazy=True)
+        self.assertEqual(email.attachments, [("file.txt", "text content", "text/plain")])
+
+    def test_attach_missing_file(self):
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        with self.assertRaises(FileNotFoundError):
+            email.attach_file(os.path.join(self.tmpdir.name, "missing.bin"), lazy=True)
+
+    def test_mail_merge(self):
+        path = self.write_file(b"content")
+        template = EmailMessage("Hello $name", "Dear $name", "from@example.com")
+        template.attach_file(path, lazy=True)
+        merge = MailMerge(template)
+        # The file is read once for all the messages.
+        with mock.patch.object(FileContent, "encode_base64", side_effect=AssertionError):
+            for message in merge.messages([("a@example.com", {"name": "A"}), ("b@example.com", {"name": "B"})]):
+                attachment = message.message().get_payload()[1]
+                self.assertEqual(attachment.get_payload(decode=True), b"content")
+
+    def test_write_to(self):
+        content = os.urandom(CHUNK_SIZE * 2 + 100)
+        path = self.write_file(content)
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        email.attach_file(path, lazy=True)
+        message = email.message()
+        expected = message.as_bytes(linesep="\r\n")
+        fp = BytesIO()
+        with mock.patch.object(FileContent, "encode_base64", side_effect=AssertionError):
+            message.write_to(fp, linesep="\r\n")
+            size = _estimate_size(message.get_payload()[1])
+        self.assertEqual(fp.getvalue(), expected)
+        email.attachments = [("file.bin", content, "application/octet-stream")]
+        self.assertEqual(size, _estimate_size(email.message().get_payload()[1]))
@@ -1,33 +1,61 @@
-from email.header import Header
+import asyncio
+import contextlib
+import hmac
+import itertools
+import warnings
+from email.header import Header, decode_header, make_header
 from email.utils import parseaddr
 import os
 import socket
+import ssl
 from ssl import SSLError
 import tempfile
+import time
 from unittest import mock
 import pytest
 
 from pathlib import Path
 from unittest.mock import Mock, patch
-from smtplib import SMTP, SMTPException
+from smtplib import (
+    SMTP,
+    SMTPAuthenticationError,
+    SMTPDataError,
+    SMTPException,
+    SMTPRecipientsRefused,
+    SMTPSenderRefused,
+    SMTPServerDisconnected,
+)
 from email import message_from_binary_file, message_from_bytes
 from io import StringIO
 from flask_mailman import EmailMessage
-from flask_mailman.backends import locmem, smtp
+from flask_mailman import tls
+from flask_mailman.backends import asyncsmtp, locmem, smtp, smtp_pool, spool
 from tests import MailmanCustomizedTestCase
 from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import SMTP as SMTPServer
+from aiosmtpd.smtp import AuthResult
+
+CERTS = Path(__file__).parent / "certs"
 
 
 class SMTPHandler:
     def __init__(self, *args, **kwargs):
         self.mailbox = []
+        # Extra ESMTP extensions advertised in the EHLO response.
+        self.extensions = []
+        # Sizes of the BDAT chunks received.
+        self.chunks = []
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        return responses[:-1] + ["250-%s" % extension for extension in self.extensions] + responses[-1:]
 
     async def handle_DATA(self, server, session, envelope):
         data = envelope.content
         mail_from = envelope.mail_from
 
         message = message_from_bytes(data.rstrip())
-        message_addr = parseaddr(message.get("from"))[1]
+        message_addr = parseaddr(str(message.get("from")))[1]
         if mail_from != message_addr:
             # According to the spec, mail_from does not necessarily match the
             # From header - this is the case where the local part isn't
@@ -45,23 +73,92 @@ class SMTPHandler:
         self.mailbox[:] = []
 
 
+class AuthSMTPHandler(SMTPHandler):
+    """
+    An SMTPHandler accepting the user "user" with the password "password",
+    with aiosmtpd's LOGIN and PLAIN mechanisms and CRAM-MD5.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # The mechanisms of the successful authentications.
+        self.authenticated = []
+
+    def authenticate(self, server, session, envelope, mechanism, auth_data):
+        success = auth_data.login == b"user" and auth_data.password == b"password"
+        if success:
+            self.authenticated.append(mechanism)
+        return AuthResult(success=success, handled=False)
+
+    async def auth_CRAM__MD5(self, server, args):
+        challenge = b"<1896.697170952@example.com>"
+        response = await server.challenge_auth(challenge)
+        user, _, digest = response.partition(b" ")
+        expected = hmac.HMAC(b"password", challenge, "md5").hexdigest().encode()
+        success = user == b"user" and hmac.compare_digest(digest, expected)
+        if success:
+            self.authenticated.append("CRAM-MD5")
+        return AuthResult(success=success, handled=False)
+
+
+class RefusingSMTPHandler(SMTPHandler):
+    """An SMTPHandler refusing every recipient."""
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        return "550 No such user"
+
+
+class ChunkingSMTP(SMTPServer):
+    """A server supporting BDAT (RFC 3030), which aiosmtpd doesn't implement."""
+
+    async def smtp_BDAT(self, arg):
+        size, _, last = arg.partition(" ")
+        chunk = await self._reader.readexactly(int(size))
+        self.event_handler.chunks.append(len(chunk))
+        self.envelope.content = (self.envelope.content or b"") + chunk
+        if last.upper() != "LAST":
+            await self.push("250 %d octets received" % len(chunk))
+            return
+        status = await self._call_handler_hook("DATA")
+        self._set_post_data_state()
+        await self.push(status)
+
+
+class ServerController(Controller):
+    def __init__(self, server_class, *args, **kwargs):
+        self.server_class = server_class
+        super().__init__(*args, **kwargs)
+
+    def factory(self):
+        return self.server_class(self.handler, **self.SMTP_kwargs)
+
+
 class SmtpdContext:
-    def __init__(self, mailman):
+    def __init__(self, mailman, server_class=None, handler_class=SMTPHandler, **server_kwargs):
         self.mailman = mailman
+        self.server_class = server_class
+        self.handler_class = handler_class
+        self.server_kwargs = server_kwargs
 
     def __enter__(self):
         # Find a free port.
         with socket.socket() as s:
             s.bind(("127.0.0.1", 0))
             port = s.getsockname()[1]
-        self.smtp_handler = SMTPHandler()
-        self.smtp_controller = Controller(
+        self.smtp_handler = self.handler_class()
+        server_kwargs = dict(self.server_kwargs)
+        if hasattr(self.smtp_handler, "authenticate"):
+            server_kwargs.setdefault("authenticator", self.smtp_handler.authenticate)
+        self.smtp_controller = ServerController(
+            self.server_class or SMTPServer,
             self.smtp_handler,
             hostname="127.0.0.1",
             port=port,
+            **server_kwargs,
         )
         self.mailman.port = port
         self.smtp_controller.start()
+        return self.smtp_handler
 
     def __exit__(self, *args):
         self.smtp_controller.stop()
@@ -182,6 +279,101 @@ class TestBackend(MailmanCustomizedTestCase):
 
             connection.close()
 
+    def test_spool_backend(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.app.extensions['mailman'].spool_path = tempdir
+            self.app.extensions['mailman'].spool_backend = 'locmem'
+            connection = self.mail.get_connection(backend='spool')
+            email = EmailMessage(
+                "Subject", "Content\n.dot", "from@example.com", ["to@example.com"], bcc=["bcc@example.com"]
+            )
+            self.assertEqual(connection.send_messages([email, EmailMessage("No recipients")]), 1)
+            self.assertEqual(len(connection.spool), 1)
+            self.assertEqual(os.listdir(os.path.join(tempdir, "tmp")), [])
+
+            result = self.app.test_cli_runner().invoke(args=["mailman", "worker", "--once"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Sent 1 message(s).", result.output)
+            self.assertEqual(len(connection.spool), 0)
+            self.assertEqual(os.listdir(os.path.join(tempdir, "cur")), [])
+            sent = self.mail.outbox[0]
+            self.assertEqual(sent.from_email, "from@example.com")
+            self.assertEqual(sent.recipients(), ["to@example.com", "bcc@example.com"])
+            message = sent.message()
+            self.assertEqual(message["Subject"], "Subject")
+            self.assertEqual(message.as_bytes(linesep="\r\n"), sent.data)
+            self.assertIn(b"\nContent\n.dot", message.as_bytes())
+
+    def test_spool_worker_smtp(self):
+        with tempfile.TemporaryDirectory() as tempdir, SmtpdContext(self.app.extensions['mailman']) as handler:
+            self.app.extensions['mailman'].spool_path = tempdir
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            self.mail.get_connection(backend='spool').send_messages([email, email])
+            spooled = spool.Spool(tempdir)
+            self.assertEqual(spool.drain(spooled, self.mail.get_connection(backend='smtp')), 2)
+            self.assertEqual(len(handler.mailbox), 2)
+            self.assertEqual(handler.mailbox[0]["Subject"], "Subject")
+
+    def test_spool_worker_empty(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            connection = self.mail.get_connection(backend='locmem')
+            with patch.object(connection, "open") as open_:
+                self.assertEqual(spool.drain(spool.Spool(tempdir), connection), 0)
+            open_.assert_not_called()
+
+    def test_spool_worker_failures(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.app.extensions['mailman'].spool_path = tempdir
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            self.mail.get_connection(backend='spool').send_messages([email, email])
+            spooled = spool.Spool(tempdir)
+            connection = self.mail.get_connection(backend='locmem')
+            refused = SMTPRecipientsRefused({"to@example.com": (550, b"No such user")})
+            with patch.object(connection, "send_messages", side_effect=[refused, ConnectionError]):
+                self.assertEqual(spool.drain(spooled, connection), 0)
+            self.assertEqual(len(os.listdir(os.path.join(tempdir, "failed"))), 1)
+            self.assertEqual(len(spooled), 1)
+
+    def test_spool_worker_backoff(self):
+        """
+        A message that fails is retried later with backoff, without holding up
+        the rest of the batch, and set aside after MAIL_SPOOL_MAX_FAILURES.
+        """
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.app.extensions['mailman'].spool_path = tempdir
+            emails = [
+                EmailMessage("Subject", "Content", "from@example.com", ["a@example.com", "b@example.com"]),
+                EmailMessage("Subject", "Content", "from@example.com", ["c@example.com"]),
+            ]
+            self.mail.get_connection(backend='spool').send_messages(emails)
+            spooled = spool.Spool(tempdir)
+            connection = self.mail.get_connection(backend='locmem')
+            refused = SMTPRecipientsRefused({"a@example.com": (450, b"Greylisted"), "b@example.com": (550, b"No")})
+            with patch.object(connection, "send_messages", side_effect=[refused, 1]), patch.object(
+                connection, "open", wraps=connection.open
+            ) as open_:
+                self.assertEqual(spool.drain(spooled, connection, max_failures=2, retry_delay=10), 1)
+            # A new session is started after the failure.
+            self.assertEqual(open_.call_count, 2)
+            self.assertEqual(len(spooled), 1)
+            self.assertEqual(spooled.claim(10), [])
+            now = time.time_ns()
+            with patch("time.time_ns", return_value=now + 9 * 10**9):
+                self.assertEqual(spooled.claim(10), [])
+            with patch("time.time_ns", return_value=now + 11 * 10**9):
+                [(name, retry)] = spooled.claim(10)
+            self.assertEqual(retry.failures, 1)
+            self.assertEqual(retry.recipients(), ["a@example.com"])
+            spooled.retry(name)
+
+            # The second failure exceeds max_failures.
+            with patch("time.time_ns", return_value=now + 11 * 10**9), patch.object(
+                connection, "send_messages", side_effect=SMTPServerDisconnected("lost")
+            ):
+                self.assertEqual(spool.drain(spooled, connection, max_failures=2, retry_delay=10), 0)
+            self.assertEqual(len(spooled), 0)
+            self.assertEqual(len(os.listdir(os.path.join(tempdir, "failed"))), 1)
+
     def test_locmem_backend(self):
         self.app.extensions['mailman'].backend = 'locmem'
         msg = EmailMessage(
@@ -378,6 +570,40 @@ class TestBackend(MailmanCustomizedTestCase):
 
             self.assertTrue(backend_one.ssl_context, backend_another.ssl_context)
 
+    def test_ssl_context_shared(self):
+        backend_one = smtp.EmailBackend()
+        backend_another = smtp.EmailBackend()
+        self.assertIs(backend_one.ssl_context, backend_another.ssl_context)
+        self.assertEqual(backend_one.ssl_context.verify_mode, ssl.CERT_REQUIRED)
+
+    def test_tls_session_resumption(self):
+        shared = tls.get_shared_context(self.app.extensions['mailman'], verify=False)
+        self.assertIs(tls.get_shared_context(self.app.extensions['mailman'], verify=False), shared)
+        self.assertEqual(shared.context.verify_mode, ssl.CERT_NONE)
+        session = Mock()
+        with patch.object(shared, "context") as context:
+            shared.for_server("smtp.example.com", 465).wrap_socket("sock", server_hostname="smtp.example.com")
+            context.wrap_socket.assert_called_with("sock", server_hostname="smtp.example.com", session=None)
+            shared.save_session(("smtp.example.com", 465), Mock(session=session))
+            shared.for_server("smtp.example.com", 465).wrap_socket("sock", server_hostname="smtp.example.com")
+            context.wrap_socket.assert_called_with("sock", server_hostname="smtp.example.com", session=session)
+            shared.for_server("other.example.com", 465).wrap_socket("sock")
+            context.wrap_socket.assert_called_with("sock", session=None)
+            # A session the server refuses is forgotten.
+            context.wrap_socket.side_effect = SSLError()
+            with self.assertRaises(SSLError):
+                shared.for_server("smtp.example.com", 465).wrap_socket("sock")
+        self.assertEqual(shared.sessions, {})
+
+    def test_starttls_uses_shared_context(self):
+        self.app.extensions['mailman'].use_tls = True
+        backend = smtp.EmailBackend()
+        with patch("smtplib.SMTP") as connection_class:
+            connection = backend._connect()
+        context = connection.starttls.call_args.kwargs["context"]
+        self.assertIs(context._shared, tls.get_shared_context(self.app.extensions['mailman'], verify=False))
+        self.assertIs(connection, connection_class.return_value)
+
     def test_connection_timeout_default(self):
         """The connection's timeout value is None by default."""
         self.app.extensions['mailman'].backend = "smtp"
@@ -438,6 +664,672 @@ class TestBackend(MailmanCustomizedTestCase):
             finally:
                 SMTP.send = send
 
+    def test_smtp_pool_reuses_connection(self):
+        with SmtpdContext(self.app.extensions['mailman']):
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            with patch.object(
+                smtp_pool.EmailBackend, '_connect', autospec=True, side_effect=smtp.EmailBackend._connect
+            ) as connect:
+                self.assertEqual(self.mail.get_connection('smtp_pool').send_messages([email]), 1)
+                self.assertEqual(self.mail.get_connection('smtp_pool').send_messages([email]), 1)
+            self.assertEqual(connect.call_count, 1)
+            pool = self.mail.get_connection('smtp_pool').pool
+            self.assertEqual(pool.size, 1)
+            self.assertEqual(pool.idle, 1)
+            self.app.extensions['mailman'].close_pools()
+            self.assertEqual(pool.size, 0)
+
+    def test_smtp_pool_discards_dead_connection(self):
+        dead, alive = Mock(), Mock()
+        dead.noop.side_effect = SMTPException("disconnected")
+        alive.noop.return_value = (250, b"OK")
+        pool = smtp_pool.ConnectionPool(Mock(side_effect=[dead, alive]))
+        pool.release(pool.acquire())
+        self.assertIs(pool.acquire(), alive)
+        dead.quit.assert_called_once_with()
+        self.assertEqual(pool.size, 1)
+
+    def test_smtp_pool_expires_old_connections(self):
+        old, new = Mock(), Mock()
+        pool = smtp_pool.ConnectionPool(Mock(side_effect=[old, new]), max_age=10)
+        with patch("time.monotonic", return_value=100):
+            pool.release(pool.acquire())
+        with patch("time.monotonic", return_value=111):
+            self.assertIs(pool.acquire(), new)
+        old.quit.assert_called_once_with()
+        old.noop.assert_not_called()
+
+    def test_smtp_pool_fill(self):
+        connect = Mock(side_effect=lambda: Mock())
+        pool = smtp_pool.ConnectionPool(connect, min_size=3, max_age=10)
+        with patch("time.monotonic", return_value=100):
+            pool.fill()
+            self.assertEqual((pool.size, pool.idle, connect.call_count), (3, 3, 3))
+            pool.fill()
+            self.assertEqual(connect.call_count, 3)
+        # Connections reaped below min_size are replaced.
+        with patch("time.monotonic", return_value=111):
+            connection = pool.acquire()
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.idle, 2)
+        self.assertEqual(connect.call_count, 6)
+        pool.release(connection)
+
+    def test_smtp_pool_prewarms_min_size(self):
+        self.app.extensions['mailman'].pool_min_size = 2
+        with SmtpdContext(self.app.extensions['mailman']):
+            pool = self.mail.get_connection('smtp_pool').pool
+            self.assertEqual((pool.size, pool.idle), (2, 2))
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            self.assertEqual(self.mail.get_connection('smtp_pool').send_messages([email]), 1)
+            self.assertEqual((pool.size, pool.idle), (2, 2))
+            self.app.extensions['mailman'].close_pools()
+
+    def test_smtp_pool_timeout(self):
+        pool = smtp_pool.ConnectionPool(Mock(), max_size=1, timeout=0.01)
+        pool.acquire()
+        with self.assertRaises(smtp_pool.PoolTimeout):
+            pool.acquire()
+
+    def test_smtp_pool_releases_connection_on_error(self):
+        """A send that raises gives its connection back to the pool."""
+        mailman = self.app.extensions['mailman']
+        mailman.pool_max_size = 1
+        mailman.pool_timeout = 1
+        with SmtpdContext(mailman, handler_class=RefusingSMTPHandler):
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            for _ in range(3):
+                with self.assertRaises(SMTPRecipientsRefused):
+                    self.mail.get_connection('smtp_pool').send_messages([email])
+            pool = self.mail.get_connection('smtp_pool').pool
+            self.assertEqual((pool.size, pool.idle), (1, 1))
+            # A connection that can't be reset is discarded instead.
+            backend = self.mail.get_connection('smtp_pool')
+            with patch.object(backend, "_send", side_effect=SMTPServerDisconnected("lost")), patch.object(
+                SMTP, "rset", side_effect=SMTPServerDisconnected("lost")
+            ):
+                with self.assertRaises(SMTPServerDisconnected):
+                    backend.send_messages([email])
+            self.assertIsNone(backend.connection)
+            self.assertEqual((pool.size, pool.idle), (0, 0))
+            mailman.close_pools()
+
+    def test_send_messages_concurrently(self):
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            emails = [
+                EmailMessage("Subject %d" % i, "Content", "from@example.com", ["to@example.com"]) for i in range(5)
+            ]
+            backend = smtp.EmailBackend(concurrency=3)
+            with patch.object(backend, '_connect', wraps=backend._connect) as connect:
+                self.assertEqual(backend.send_messages(emails), 5)
+            self.assertEqual(connect.call_count, 3)
+            self.assertIsNone(backend.connection)
+            self.assertEqual(
+                sorted(message["subject"] for message in handler.mailbox), ["Subject %d" % i for i in range(5)]
+            )
+
+    def test_concurrency_use_settings(self):
+        self.app.extensions['mailman'].smtp_concurrency = 4
+        self.assertEqual(smtp.EmailBackend().concurrency, 4)
+        self.assertEqual(smtp.EmailBackend(concurrency=2).concurrency, 2)
+
+    def test_send_pipelined(self):
+        """
+        The envelope is written in a single send() when the server supports
+        PIPELINING.
+        """
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            handler.extensions.append("PIPELINING")
+            email = EmailMessage(
+                "Subject", "Content\n.dot", "from@example.com", ["to@example.com", "other@example.com"]
+            )
+            with patch.object(SMTP, "send", autospec=True, side_effect=SMTP.send) as send:
+                self.assertEqual(self.mail.get_connection('smtp').send_messages([email]), 1)
+            envelope = [call.args[1] for call in send.call_args_list if str(call.args[1]).startswith("mail FROM")]
+            self.assertEqual(len(envelope), 1)
+            self.assertRegex(
+                envelope[0],
+                r"^mail FROM:<from@example.com> size=\d+\r\n"
+                r"rcpt TO:<to@example.com>\r\nrcpt TO:<other@example.com>\r\ndata\r\n$",
+            )
+            self.assertEqual(len(handler.mailbox), 1)
+            self.assertEqual(handler.mailbox[0].get_payload(), "Content\r\n.dot")
+
+    def test_send_pipelined_refused_sender(self):
+        connection = Mock()
+        connection.has_extn.side_effect = lambda name: name == "pipelining"
+        connection.getreply.side_effect = [(550, b"No"), (503, b"No"), (503, b"No")]
+        backend = smtp.EmailBackend()
+        backend.connection = connection
+        with self.assertRaises(SMTPSenderRefused):
+            backend._sendmail("from@example.com", ["to@example.com"], b"Content")
+        connection._rset.assert_called_once_with()
+
+    def test_send_bdat(self):
+        """
+        With CHUNKING, the message is sent as is in BDAT chunks instead of
+        being dot-stuffed after DATA.
+        """
+        self.app.extensions['mailman'].bdat_chunk_size = 100
+        with SmtpdContext(self.app.extensions['mailman'], server_class=ChunkingSMTP) as handler:
+            for extensions in (["CHUNKING"], ["CHUNKING", "PIPELINING"]):
+                with self.subTest(extensions=extensions):
+                    handler.flush_mailbox()
+                    handler.chunks[:] = []
+                    handler.extensions[:] = extensions
+                    email = EmailMessage(
+                        "Subject", "Content\n.dot\n" + "x" * 300, "from@example.com", ["to@example.com"]
+                    )
+                    with patch("flask_mailman.backends.smtp._quote_periods") as quote, patch.object(
+                        smtp.EmailBackend, "_write_data", autospec=True, side_effect=smtp.EmailBackend._write_data
+                    ) as write_data:
+                        self.assertEqual(smtp.EmailBackend().send_messages([email]), 1)
+                    quote.assert_not_called()
+                    msg_bytes = write_data.call_args.args[1]
+                    self.assertEqual(len(handler.mailbox), 1)
+                    self.assertTrue(handler.mailbox[0].get_payload().startswith("Content\r\n.dot\r\n"))
+                    self.assertEqual(sum(handler.chunks), len(msg_bytes))
+                    self.assertEqual(max(handler.chunks), 100)
+
+    def test_send_bdat_rejected_chunk(self):
+        connection = Mock()
+        connection.has_extn.side_effect = lambda name: name == "chunking"
+        connection.getreply.side_effect = [(250, b"OK"), (250, b"OK"), (250, b"OK"), (552, b"Too big")]
+        self.app.extensions['mailman'].bdat_chunk_size = 4
+        backend = smtp.EmailBackend()
+        backend.connection = connection
+        with self.assertRaises(SMTPDataError):
+            backend._sendmail("from@example.com", ["to@example.com"], b"Content\r\n")
+        self.assertEqual(
+            [call.args[0] for call in connection.send.call_args_list[2:]],
+            [b"BDAT 4\r\nCont", b"BDAT 4\r\nent\r"],
+        )
+        connection._rset.assert_called_once_with()
+
+    def test_send_streamed(self):
+        """
+        Messages over MAIL_STREAM_THRESHOLD are flattened while they're sent,
+        after DATA or in BDAT chunks.
+        """
+        self.app.extensions['mailman'].stream_threshold = 0
+        self.app.extensions['mailman'].bdat_chunk_size = 1000
+        content = os.urandom(10000)
+        for server_class, extensions in ((None, []), (ChunkingSMTP, ["CHUNKING"])):
+            with self.subTest(extensions=extensions):
+                with SmtpdContext(self.app.extensions['mailman'], server_class=server_class) as handler:
+                    handler.extensions[:] = extensions
+                    email = EmailMessage("Subject", "Content\n.dot\n", "from@example.com", ["to@example.com"])
+                    email.attach("file.bin", content, "application/octet-stream")
+                    with patch.object(SMTP, "sendmail") as sendmail, patch(
+                        "flask_mailman.backends.smtp._quote_periods"
+                    ) as quote:
+                        self.assertEqual(smtp.EmailBackend().send_messages([email]), 1)
+                    sendmail.assert_not_called()
+                    quote.assert_not_called()
+                    self.assertEqual(len(handler.mailbox), 1)
+                    body, attachment = handler.mailbox[0].get_payload()
+                    self.assertEqual(body.get_payload(), "Content\r\n.dot\r\n")
+                    self.assertEqual(attachment.get_payload(decode=True), content)
+                    if extensions:
+                        self.assertGreater(len(handler.chunks), 1)
+
+    def test_streamed_single_transaction(self):
+        """
+        Messages sent in several transactions are serialized once instead of
+        being flattened again for every transaction.
+        """
+        mailman = self.app.extensions['mailman']
+        mailman.stream_threshold = 0
+        email = EmailMessage("Subject", "Content", "from@example.com", ["one@example.com", "two@example.com"])
+        for max_recipients, streamed in ((None, True), (1, False)):
+            with self.subTest(max_recipients=max_recipients):
+                mailman.max_recipients_per_transaction = max_recipients
+                backend = smtp.EmailBackend()
+                backend.connection = Mock()
+                with patch.object(backend, "_sendmail", return_value={}) as sendmail:
+                    self.assertEqual(backend.send_messages([email]), 1)
+                msgs = [call.args[2] for call in sendmail.call_args_list]
+                self.assertEqual(len(msgs), 1 if streamed else 2)
+                self.assertEqual(len({id(msg) for msg in msgs}), 1)
+                self.assertIs(isinstance(msgs[0], smtp.StreamedMessage), streamed)
+
+        # One transaction per recipient domain.
+        mailman.max_recipients_per_transaction = None
+        email.to = ["one@example.com", "two@example.org"]
+        transactions = list(smtp.EmailBackend()._transactions([email]))
+        self.assertEqual(len(transactions), 2)
+        self.assertIs(transactions[0].msg, transactions[1].msg)
+        self.assertIsInstance(transactions[0].msg, bytes)
+
+    def test_data_writer_dot_stuffing(self):
+        """Lines starting with a period are dot-stuffed across writes."""
+        connection = Mock()
+        connection.getreply.return_value = (250, b"OK")
+        writer = smtp._DataWriter(connection, 4)
+        for data in (b".a\r\n", b".", b"b\r", b"\n.c", b"\r\n.", b".d"):
+            writer.write(data)
+        self.assertEqual(writer.close(), (250, b"OK"))
+        self.assertEqual(
+            b"".join(call.args[0] for call in connection.send.call_args_list),
+            b"..a\r\n..b\r\n..c\r\n...d\r\n.\r\n",
+        )
+
+    def test_message_too_large(self):
+        """
+        Messages over the server's SIZE limit are refused without being
+        uploaded.
+        """
+        small = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        large = EmailMessage("Subject", "x" * 1000, "from@example.com", ["to@example.com", "other@example.com"])
+        with SmtpdContext(self.app.extensions['mailman'], data_size_limit=800) as handler:
+            backend = smtp.EmailBackend(fail_silently=True)
+            with patch.object(SMTP, "sendmail", autospec=True, side_effect=SMTP.sendmail) as sendmail:
+                self.assertEqual(backend.send_messages([large, small]), 1)
+            self.assertEqual(sendmail.call_count, 1)
+            self.assertEqual(len(handler.mailbox), 1)
+            self.assertEqual(len(backend.results), 2)
+            result = backend.results[0]
+            self.assertEqual(result.accepted, [])
+            self.assertEqual(sorted(result.perm_refused), ["other@example.com", "to@example.com"])
+            self.assertEqual(result.perm_refused["to@example.com"][0], 552)
+            self.assertTrue(backend.results[1].sent)
+
+            with self.assertRaises(smtp.MessageTooLarge) as cm:
+                smtp.EmailBackend().send_messages([large])
+            self.assertEqual(cm.exception.limit, 800)
+            self.assertGreater(cm.exception.size, 1000)
+
+            backend = asyncsmtp.EmailBackend(fail_silently=True)
+            self.assertEqual(asyncio.run(backend.send_messages_async([large, small])), 1)
+            self.assertEqual(len(handler.mailbox), 2)
+            self.assertEqual(backend.results[0].perm_refused["to@example.com"][0], 552)
+
+    def test_send_smtputf8(self):
+        """
+        With MAIL_USE_SMTPUTF8, non-ASCII addresses are sent as is, with the
+        SMTPUTF8 option, or encoded if the server doesn't support it.
+        """
+        self.app.extensions['mailman'].use_smtputf8 = True
+        email = EmailMessage("Sübject", "Content", "Fröm <from@example.com>", ["tó@example.com"])
+        with SmtpdContext(self.app.extensions['mailman'], enable_SMTPUTF8=True) as handler:
+            with patch.object(SMTP, "sendmail", autospec=True, side_effect=SMTP.sendmail) as sendmail:
+                self.assertEqual(smtp.EmailBackend().send_messages([email]), 1)
+            self.assertEqual(sendmail.call_args.args[1:3], ("Fröm <from@example.com>", ["tó@example.com"]))
+            self.assertIn("SMTPUTF8", sendmail.call_args.kwargs["mail_options"])
+            self.assertEqual(asyncio.run(asyncsmtp.EmailBackend().send_messages_async([email])), 1)
+            self.assertEqual(len(handler.mailbox), 2)
+
+        with SmtpdContext(self.app.extensions['mailman'], enable_SMTPUTF8=False) as handler:
+            email = EmailMessage("Sübject", "Content", "José <jose@example.com>", ["to@example.com"])
+            with patch.object(SMTP, "sendmail", autospec=True, side_effect=SMTP.sendmail) as sendmail:
+                self.assertEqual(smtp.EmailBackend().send_messages([email]), 1)
+            self.assertEqual(str(make_header(decode_header(sendmail.call_args.args[1]))), "José <jose@example.com>")
+            self.assertNotIn("SMTPUTF8", sendmail.call_args.kwargs["mail_options"])
+            self.assertEqual(asyncio.run(asyncsmtp.EmailBackend().send_messages_async([email])), 1)
+            self.assertEqual(len(handler.mailbox), 2)
+            for message in handler.mailbox:
+                for name, value in (("From", "José <jose@example.com>"), ("Subject", "Sübject")):
+                    self.assertTrue(message[name].isascii())
+                    self.assertEqual(str(make_header(decode_header(message[name]))), value)
+
+    def test_send_smtputf8_spooled(self):
+        """Spooled messages have their headers encoded for servers without SMTPUTF8."""
+        mailman = self.app.extensions['mailman']
+        mailman.use_smtputf8 = True
+        with tempfile.TemporaryDirectory() as tempdir, SmtpdContext(mailman, enable_SMTPUTF8=False) as handler:
+            mailman.spool_path = tempdir
+            subject = "Sübject " * 10
+            email = EmailMessage(subject, "Cöntent", "José <jose@example.com>", ["to@example.com"])
+            self.mail.get_connection(backend='spool').send_messages([email])
+            queue = spool.Spool(tempdir)
+            self.assertEqual(spool.drain(queue, self.mail.get_connection(backend='smtp')), 1)
+            self.assertEqual(len(queue), 0)
+            [message] = handler.mailbox
+            for name, value in (("From", "José <jose@example.com>"), ("Subject", subject)):
+                self.assertTrue(message[name].isascii())
+                self.assertEqual(str(make_header(decode_header(message[name]))), value)
+            self.assertEqual(message.get_payload(decode=True).decode(), "Cöntent")
+
+    def test_asyncsmtp_backend(self):
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            emails = [
+                EmailMessage("Subject %d" % i, "Content", "from@example.com", ["to@example.com"]) for i in range(2)
+            ]
+            backend = asyncsmtp.EmailBackend()
+            self.assertEqual(asyncio.run(backend.send_messages_async(emails)), 2)
+            self.assertIsNone(backend.connection)
+            self.assertEqual([message["subject"] for message in handler.mailbox], ["Subject 0", "Subject 1"])
+
+    def test_asyncsmtp_backend_pipelined(self):
+        async def send(backend, email):
+            async with backend:
+                return await backend.send_messages_async([email])
+
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            handler.extensions.append("PIPELINING")
+            email = EmailMessage("Subject", "Content\n.dot", "from@example.com", ["to@example.com"])
+            self.assertEqual(asyncio.run(send(asyncsmtp.EmailBackend(), email)), 1)
+            self.assertEqual(handler.mailbox[0].get_payload(), "Content\r\n.dot")
+
+    def test_asyncsmtp_backend_blocking_api(self):
+        self.app.extensions['mailman'].backend = 'asyncsmtp'
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            self.assertEqual(self.mail.send_mail("Subject", "Content", "from@example.com", ["to@example.com"]), 1)
+            with self.mail.get_connection() as connection:
+                email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+                self.assertEqual(connection.send_messages([email, email]), 2)
+            self.assertEqual(len(handler.mailbox), 3)
+
+    def test_asyncsmtp_backend_blocking_api_in_event_loop(self):
+        """The blocking API works from a running event loop, e.g. an async view."""
+        self.app.extensions['mailman'].backend = 'asyncsmtp'
+
+        async def view():
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            return email.send() + self.mail.send_mail("Subject", "Content", "from@example.com", ["to@example.com"])
+
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                self.assertEqual(asyncio.run(view()), 2)
+            self.assertEqual(len(handler.mailbox), 2)
+
+    def test_asyncsmtp_backend_starttls_auth(self):
+        mailman = self.app.extensions['mailman']
+        mailman.use_tls = True
+        mailman.username = "user"
+        mailman.password = "password"
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(CERTS / "server.crt", CERTS / "server.key")
+        client_context = ssl.create_default_context(cafile=str(CERTS / "server.crt"))
+        mechanisms = ["PLAIN", "LOGIN", "CRAM-MD5"]
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        with patch.object(asyncsmtp.EmailBackend, "ssl_context", client_context):
+            for mechanism, start_tls in itertools.product(mechanisms, ("StreamWriter.start_tls", "loop.start_tls")):
+                with self.subTest(mechanism=mechanism, start_tls=start_tls), SmtpdContext(
+                    mailman,
+                    handler_class=AuthSMTPHandler,
+                    tls_context=server_context,
+                    require_starttls=True,
+                    auth_required=True,
+                    auth_exclude_mechanism=[other for other in mechanisms if other != mechanism],
+                ) as handler:
+                    with contextlib.ExitStack() as stack:
+                        if start_tls == "loop.start_tls":
+                            # The workaround for Python < 3.11.
+                            stack.enter_context(patch.object(asyncio.StreamWriter, "start_tls", None, create=True))
+                        self.assertEqual(asyncio.run(asyncsmtp.EmailBackend().send_messages_async([email])), 1)
+                    self.assertEqual(handler.authenticated, [mechanism])
+                    self.assertEqual(len(handler.mailbox), 1)
+
+            with SmtpdContext(
+                mailman, handler_class=AuthSMTPHandler, tls_context=server_context, auth_required=True
+            ) as handler:
+                backend = asyncsmtp.EmailBackend(password="wrong")
+                with self.assertRaises(SMTPAuthenticationError):
+                    asyncio.run(backend.send_messages_async([email]))
+                self.assertEqual(handler.mailbox, [])
+
+    def test_asyncsmtp_backend_fail_silently(self):
+        backend = asyncsmtp.EmailBackend(port=1)
+        with self.assertRaises(ConnectionError):
+            asyncio.run(backend.open_async())
+        backend.fail_silently = True
+        self.assertIsNone(asyncio.run(backend.open_async()))
+
+    def test_asyncsmtp_backend_recipient_chunking(self):
+        mailman = self.app.extensions['mailman']
+        mailman.max_recipients_per_transaction = 2
+        mailman.max_messages_per_connection = 2
+        with SmtpdContext(mailman) as handler:
+            email = EmailMessage("Subject", "Content", "from@example.com", bcc=["to%d@example.com" % i for i in range(5)])
+            backend = asyncsmtp.EmailBackend()
+            with patch.object(backend, "_connect_async", wraps=backend._connect_async) as connect:
+                self.assertEqual(asyncio.run(backend.send_messages_async([email])), 1)
+            self.assertEqual(len(handler.mailbox), 3)
+            self.assertEqual(len({msg["Message-ID"] for msg in handler.mailbox}), 1)
+            # The connection is recycled after two transactions.
+            self.assertEqual(connect.call_count, 2)
+
+    def test_asyncsmtp_backend_reconnect(self):
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            backend = asyncsmtp.EmailBackend(max_retries=1)
+            sendmail = asyncsmtp.AsyncSMTP.sendmail
+            calls = []
+
+            async def flaky(connection, *args, **kwargs):
+                calls.append(connection)
+                if len(calls) == 1:
+                    raise SMTPServerDisconnected("lost")
+                return await sendmail(connection, *args, **kwargs)
+
+            with patch.object(asyncsmtp.AsyncSMTP, "sendmail", flaky), patch.object(
+                backend, "_retry_delay", return_value=0
+            ):
+                self.assertEqual(asyncio.run(backend.send_messages_async([email])), 1)
+            self.assertEqual(len(calls), 2)
+            self.assertIsNot(calls[0], calls[1])
+            self.assertEqual(len(handler.mailbox), 1)
+
+    def test_send_async(self):
+        """Backends without asyncio support send in a worker thread."""
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        self.assertEqual(asyncio.run(email.send_async()), 1)
+        self.assertEqual(asyncio.run(self.mail.send_mail_async("Subject", "Content", None, ["to@example.com"])), 1)
+        self.assertEqual(len(self.mail.outbox), 2)
+
+    @patch("time.sleep")
+    def test_reconnect_on_disconnection(self, sleep):
+        """
+        The batch resumes from the message that failed on a new connection
+        when the server drops the connection.
+        """
+        emails = [EmailMessage("Subject %d" % i, "Content", "from@example.com", ["to@example.com"]) for i in range(3)]
+        backend = smtp.EmailBackend(max_retries=2)
+        backend.connection = first = Mock()
+        second = Mock()
+        sent = []
+
+        def sendmail(from_addr, to_addrs, msg, mail_options=()):
+            if backend.connection is first and len(sent) == 1:
+                raise SMTPServerDisconnected("Connection unexpectedly closed")
+            sent.append(msg)
+            return {}
+
+        with patch.object(backend, "_connect", return_value=second), patch.object(backend, "_sendmail", sendmail):
+            self.assertEqual(backend.send_messages(emails), 3)
+        self.assertEqual([message_from_bytes(msg)["Subject"] for msg in sent], ["Subject 0", "Subject 1", "Subject 2"])
+        self.assertIs(backend.connection, second)
+        first.close.assert_called_once_with()
+        sleep.assert_called_once()
+        self.assertLessEqual(sleep.call_args.args[0], self.app.extensions['mailman'].smtp_retry_backoff)
+
+    @patch("time.sleep")
+    def test_reconnect_gives_up(self, sleep):
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        backend = smtp.EmailBackend(max_retries=2)
+        backend.connection = Mock()
+        with patch.object(backend, "_connect", return_value=Mock()) as connect, patch.object(
+            backend, "_sendmail", side_effect=SMTPServerDisconnected
+        ):
+            with self.assertRaises(SMTPServerDisconnected):
+                backend.send_messages([email])
+            self.assertEqual(connect.call_count, 2)
+            backend.fail_silently = True
+            self.assertEqual(backend.send_messages([email]), 0)
+
+    def test_max_messages_per_connection(self):
+        self.app.extensions['mailman'].max_messages_per_connection = 2
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            emails = [
+                EmailMessage("Subject %d" % i, "Content", "from@example.com", ["to@example.com"]) for i in range(5)
+            ]
+            backend = smtp.EmailBackend()
+            with patch.object(backend, '_connect', wraps=backend._connect) as connect:
+                self.assertEqual(backend.send_messages(emails), 5)
+            self.assertEqual(connect.call_count, 3)
+            self.assertEqual(len(handler.mailbox), 5)
+
+    def test_max_bytes_per_connection(self):
+        self.app.extensions['mailman'].max_bytes_per_connection = 1000
+        email = EmailMessage("Subject", "x" * 600, "from@example.com", ["to@example.com"])
+        backend = smtp.EmailBackend()
+        backend.connection = first = Mock()
+        with patch.object(backend, "_connect", return_value=Mock()) as connect, patch.object(backend, "_sendmail"):
+            self.assertEqual(backend.send_messages([email, email]), 2)
+        connect.assert_called_once_with()
+        first.quit.assert_called_once_with()
+
+    def test_smtp_pool_recycles_exhausted_connection(self):
+        self.app.extensions['mailman'].max_messages_per_connection = 1
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+            self.assertEqual(self.mail.get_connection('smtp_pool').send_messages([email]), 1)
+            pool = self.mail.get_connection('smtp_pool').pool
+            self.assertEqual(pool.idle, 1)
+            # The pooled connection already sent its message.
+            with patch.object(pool, 'discard', wraps=pool.discard) as discard:
+                self.assertEqual(self.mail.get_connection('smtp_pool').send_messages([email]), 1)
+            discard.assert_called_once()
+            self.assertEqual(len(handler.mailbox), 2)
+            self.app.extensions['mailman'].close_pools()
+
+    def test_recipient_chunking(self):
+        self.app.extensions['mailman'].max_recipients_per_transaction = 2
+        with SmtpdContext(self.app.extensions['mailman']) as handler:
+            recipients = ["to%d@example.com" % i for i in range(5)]
+            email = EmailMessage("Subject", "Content", "from@example.com", bcc=recipients)
+            backend = smtp.EmailBackend()
+            with patch.object(email, "message", wraps=email.message) as message:
+                self.assertEqual(backend.send_messages([email]), 1)
+            message.assert_called_once_with()
+            self.assertEqual(len(handler.mailbox), 3)
+            self.assertEqual(len({msg["Message-ID"] for msg in handler.mailbox}), 1)
+
+    def test_recipient_chunking_refused(self):
+        self.app.extensions['mailman'].max_recipients_per_transaction = 1
+        email = EmailMessage("Subject", "Content", "from@example.com", ["a@example.com", "b@example.com"])
+        backend = smtp.EmailBackend()
+        backend.connection = Mock()
+        refused = {"a@example.com": (550, b"No such user")}
+        with patch.object(backend, "_sendmail", side_effect=[SMTPRecipientsRefused(refused), {}]):
+            self.assertEqual(backend.send_messages([email]), 1)
+        refused_b = {"b@example.com": (550, b"No such user")}
+        with patch.object(
+            backend, "_sendmail", side_effect=[SMTPRecipientsRefused(refused), SMTPRecipientsRefused(refused_b)]
+        ):
+            with self.assertRaises(SMTPRecipientsRefused) as cm:
+                backend.send_messages([email])
+        self.assertEqual(cm.exception.recipients, {**refused, **refused_b})
+
+    def test_delivery_results(self):
+        emails = [
+            EmailMessage("Subject", "Content", "from@example.com", ["a@example.com", "b@example.com", "c@example.com"]),
+            EmailMessage("Subject", "Content", "from@example.com", ["d@example.com"]),
+        ]
+        backend = smtp.EmailBackend(fail_silently=True)
+        backend.connection = Mock()
+        refused = {"b@example.com": (450, b"Try again later"), "c@example.com": (550, b"No such user")}
+        with patch.object(
+            backend, "_sendmail", side_effect=[refused, SMTPRecipientsRefused({"d@example.com": (550, b"No")})]
+        ):
+            self.assertEqual(backend.send_messages(emails), 1)
+        self.assertEqual(len(backend.results), 2)
+        result = backend.results[0]
+        self.assertIs(result.message, emails[0])
+        self.assertTrue(result.sent)
+        self.assertEqual(result.accepted, ["a@example.com"])
+        self.assertEqual(result.temp_refused, {"b@example.com": (450, b"Try again later")})
+        self.assertEqual(result.perm_refused, {"c@example.com": (550, b"No such user")})
+        self.assertFalse(backend.results[1].sent)
+
+    def test_retry_refused_recipients(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            mailman = self.app.extensions['mailman']
+            mailman.refused_retries = 1
+            mailman.spool_path = tempdir
+            email = EmailMessage("Subject", "Content", "from@example.com", ["a@example.com", "b@example.com"])
+            backend = smtp.EmailBackend()
+            backend.connection = Mock()
+            with patch.object(backend, "_sendmail", return_value={"b@example.com": (451, b"Greylisted")}):
+                self.assertEqual(backend.send_messages([email]), 1)
+            queue = spool.Spool(tempdir)
+            self.assertEqual(len(queue), 1)
+            # Not due yet.
+            self.assertEqual(queue.claim(10), [])
+            with patch("time.time_ns", return_value=time.time_ns() + 10**12):
+                [(name, retry)] = queue.claim(10)
+            self.assertEqual(retry.recipients(), ["b@example.com"])
+            self.assertEqual(retry.attempts, 1)
+            self.assertEqual(message_from_bytes(retry.data)["To"], "a@example.com, b@example.com")
+            # The retry is refused again, the attempts are exhausted.
+            with patch.object(backend, "_sendmail", return_value={"b@example.com": (451, b"Greylisted")}):
+                self.assertEqual(backend.send_messages([retry]), 1)
+            self.assertEqual(len(queue), 0)
+
+    def test_retry_all_refused_recipients(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            mailman = self.app.extensions['mailman']
+            mailman.refused_retries = 1
+            mailman.spool_path = tempdir
+            email = EmailMessage("Subject", "Content", "from@example.com", ["a@example.com", "b@example.com"])
+            backend = smtp.EmailBackend()
+            backend.connection = Mock()
+            refused = SMTPRecipientsRefused(
+                {"a@example.com": (550, b"No such user"), "b@example.com": (451, b"Greylisted")}
+            )
+            with patch.object(backend, "_sendmail", side_effect=refused):
+                with self.assertRaises(spool.RecipientsDeferred):
+                    backend.send_messages([email])
+            with patch("time.time_ns", return_value=time.time_ns() + 10**12):
+                [(name, retry)] = spool.Spool(tempdir).claim(10)
+            self.assertEqual(retry.recipients(), ["b@example.com"])
+            self.assertEqual(retry.attempts, 1)
+
+    def test_drain_all_refused_recipients(self):
+        """
+        A spooled message refused by all its recipients is done with once it's
+        spooled again for those that refused it temporarily.
+        """
+        with tempfile.TemporaryDirectory() as tempdir:
+            mailman = self.app.extensions['mailman']
+            mailman.refused_retries = 3
+            mailman.spool_path = tempdir
+            email = EmailMessage("Subject", "Content", "from@example.com", ["a@example.com", "b@example.com"])
+            queue = spool.Spool(tempdir)
+            queue.put([email])
+            backend = smtp.EmailBackend()
+            refused = SMTPRecipientsRefused(
+                {"a@example.com": (550, b"No such user"), "b@example.com": (451, b"Greylisted")}
+            )
+            with patch.object(backend, "_connect", return_value=Mock()), patch.object(
+                backend, "_sendmail", side_effect=refused
+            ):
+                for _ in range(3):
+                    self.assertEqual(spool.drain(queue, backend), 0)
+            self.assertEqual(len(queue), 1)
+            self.assertEqual(os.listdir(os.path.join(tempdir, "cur")), [])
+            self.assertEqual(os.listdir(os.path.join(tempdir, "failed")), [])
+            with patch("time.time_ns", return_value=time.time_ns() + 10**12):
+                [(name, retry)] = queue.claim(10)
+            self.assertEqual(retry.recipients(), ["b@example.com"])
+
+    def test_retry_refused_requires_spool(self):
+        self.app.extensions['mailman'].refused_retries = 1
+        with self.assertRaises(smtp.ImproperlyConfigured):
+            smtp.EmailBackend()
+
+    def test_no_retry_when_refused(self):
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        backend = smtp.EmailBackend(max_retries=2)
+        backend.connection = Mock()
+        refused = SMTPRecipientsRefused({"to@example.com": (550, b"No such user")})
+        with patch.object(backend, "_connect") as connect, patch.object(backend, "_sendmail", side_effect=refused):
+            with self.assertRaises(SMTPRecipientsRefused):
+                backend.send_messages([email])
+        connect.assert_not_called()
+
     def test_send_messages_after_open_failed(self):
         """
         send_messages() shouldn't try to send messages if open() raises an
@@ -0,0 +1,84 @@
+import time
+from unittest.mock import Mock, patch
+
+from flask_mailman import EmailMessage
+from flask_mailman.backends import smtp
+from flask_mailman.circuitbreaker import CircuitBreaker, CircuitOpen
+from tests import TestCase
+
+
+class TestCircuitBreaker(TestCase):
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=30)
+        breaker.check()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.check()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertTrue(breaker.is_open)
+        with self.assertRaises(CircuitOpen):
+            breaker.check()
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=30)
+        breaker.record_failure()
+        later = time.monotonic() + 31
+        with patch("time.monotonic", return_value=later):
+            self.assertEqual(breaker.state, "half_open")
+            breaker.check()
+            # A single probe at a time.
+            with self.assertRaises(CircuitOpen):
+                breaker.check()
+            breaker.record_failure()
+            self.assertEqual(breaker.state, "open")
+        with patch("time.monotonic", return_value=later + 31):
+            breaker.check()
+            breaker.record_success()
+            self.assertEqual(breaker.state, "closed")
+            breaker.check()
+
+    def test_backend_fails_fast(self):
+        self.mail.state.circuit_breaker_threshold = 2
+        backend = smtp.EmailBackend()
+        with patch.object(backend, "_connect_to", side_effect=ConnectionRefusedError()) as connect:
+            for i in range(2):
+                with self.assertRaises(ConnectionRefusedError):
+                    backend.open()
+            with self.assertRaises(CircuitOpen):
+                backend.open()
+            # The breaker is shared by the backends connecting to the same server.
+            with self.assertRaises(CircuitOpen):
+                smtp.EmailBackend().open()
+            self.assertIsNone(smtp.EmailBackend(fail_silently=True).open())
+        self.assertEqual(connect.call_count, 2)
+
+    def test_backend_fallback(self):
+        self.mail.state.circuit_breaker_threshold = 1
+        self.mail.state.circuit_breaker_fallback = "locmem"
+        backend = smtp.EmailBackend()
+        with patch.object(backend, "_connect_to", side_effect=ConnectionRefusedError()):
+            with self.assertRaises(ConnectionRefusedError):
+                backend.open()
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        self.assertEqual(smtp.EmailBackend().send_messages([email]), 1)
+        self.assertEqual(self.mail.outbox, [email])
+
+    def test_backend_recovers(self):
+        self.mail.state.circuit_breaker_threshold = 1
+        self.mail.state.circuit_breaker_cooldown = 0
+        backend = smtp.EmailBackend()
+        with patch.object(backend, "_connect_to", side_effect=ConnectionRefusedError()):
+            with self.assertRaises(ConnectionRefusedError):
+                backend.open()
+        connection = Mock()
+        with patch.object(backend, "_connect_to", return_value=connection):
+            self.assertTrue(backend.open())
+        self.assertEqual(backend.circuit_breaker.state, "closed")
@@ -1,10 +1,19 @@
+import io
 import mimetypes
 import os
 from flask_mailman.utils import DNS_NAME
 from email import charset, message_from_bytes
+from email.header import decode_header, make_header
 from email.mime.text import MIMEText
 from unittest import mock
-from flask_mailman.message import EmailMessage, EmailMultiAlternatives, sanitize_address
+from flask_mailman.message import (
+    BadHeaderError,
+    EmailMessage,
+    EmailMultiAlternatives,
+    MailMerge,
+    forbid_multi_line_headers,
+    sanitize_address,
+)
 from tests import MailmanCustomizedTestCase
 
 
@@ -829,6 +838,19 @@ class TestMail(MailmanCustomizedTestCase):
             with self.subTest(email_address=email_address, encoding=encoding):
                 self.assertEqual(sanitize_address(email_address, encoding), expected_result)
 
+    def test_sanitize_address_utf8(self):
+        """With utf8, non-ASCII names and local parts are left as is."""
+        for email_address, expected_result in (
+            ("to@example.com", "to@example.com"),
+            ("tó@example.com", "tó@example.com"),
+            ("to@éxample.com", "to@xn--xample-9ua.com"),
+            (("Tó Example", "tó@example.com"), "Tó Example <tó@example.com>"),
+            ("Tó Example <tó@example.com>", "Tó Example <tó@example.com>"),
+            (("Exámple, Tó", "to@example.com"), '"Exámple, Tó" <to@example.com>'),
+        ):
+            with self.subTest(email_address=email_address):
+                self.assertEqual(sanitize_address(email_address, "utf-8", utf8=True), expected_result)
+
     def test_sanitize_address_invalid(self):
         for email_address in (
             # Invalid address with two @ signs.
@@ -991,3 +1013,175 @@ class TestMail(MailmanCustomizedTestCase):
         self.assertEqual(message.get("subject"), "Subject")
         self.assertEqual(message.get("from"), "tester")
         self.assertEqual(message.get("to"), "little bird")
+
+    def test_write_to(self):
+        """write_to() writes the same bytes as as_bytes()."""
+        child = EmailMessage("Child Subject", "Some child body", "from@example.com", ["to@example.com"])
+        msg = EmailMultiAlternatives(
+            "Subject", "From the start.\n.\nàáä\n", "from@example.com", ["to@example.com"]
+        )
+        msg.attach_alternative("<p>Firstname Sürname</p>", "text/html")
+        msg.attach("file.txt", "file content\n" * 1000)
+        msg.attach("file.bin", os.urandom(100000), "application/octet-stream")
+        msg.attach(content=child, mimetype="message/rfc822")
+        tests = [
+            EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"]),
+            EmailMessage("Subject", "Body with latin characters: àáä.", "from@example.com", ["to@example.com"]),
+            msg,
+        ]
+        for email in tests:
+            with self.subTest(email=email):
+                message = email.message()
+                fp = io.BytesIO()
+                message.write_to(fp, linesep="\r\n")
+                self.assertEqual(fp.getvalue(), message.as_bytes(linesep="\r\n"))
+
+    def test_smtputf8_headers(self):
+        """With MAIL_USE_SMTPUTF8, headers are written in UTF-8 rather than encoded."""
+        self.mail.state.use_smtputf8 = True
+        subject = "Sübject with ünicode characters, and long enough to be folded in two lines"
+        email = EmailMessage(subject, "Content", "Fröm <fröm@example.com>", ["Tó Example <tó@éxample.com>"])
+        message = email.message()
+        self.assertEqual(message["Subject"], subject)
+        self.assertEqual(message["From"], "Fröm <fröm@example.com>")
+        self.assertEqual(message["To"], "Tó Example <tó@éxample.com>")
+        message_bytes = message.as_bytes()
+        self.assertNotIn(b"=?utf-8?", message_bytes)
+        self.assertIn("From: Fröm <fröm@example.com>\n".encode(), message_bytes)
+        self.assertIn(
+            "Subject: Sübject with ünicode characters, and long enough to be folded in two\n lines\n".encode(),
+            message_bytes,
+        )
+        with self.assertRaises(BadHeaderError):
+            email = EmailMessage("Sübject\nInjection", "Content", "from@example.com", ["to@example.com"])
+            email.message()
+
+    def test_message_cached(self):
+        """message() is only built again when the EmailMessage changes."""
+        email = EmailMultiAlternatives("Subject", "Content", "from@example.com", ["to@example.com"])
+        message = email.message()
+        self.assertIs(email.message(), message)
+        changes = [
+            lambda: setattr(email, "subject", "Other subject"),
+            lambda: email.to.append("other@example.com"),
+            lambda: email.extra_headers.update({"X-Header": "value"}),
+            lambda: email.attach("file.txt", "content"),
+            lambda: email.attach_alternative("<p>Content</p>", "text/html"),
+            lambda: setattr(self.mail.state, "use_localtime", True),
+        ]
+        for change in changes:
+            change()
+            new_message = email.message()
+            self.assertIsNot(new_message, message)
+            self.assertIs(email.message(), new_message)
+            message = new_message
+        self.assertEqual(message["Subject"], "Other subject")
+        self.assertEqual(message["To"], "to@example.com, other@example.com")
+        self.assertEqual(message["X-Header"], "value")
+        self.assertEqual(len(message.get_payload()), 2)
+
+    def test_message_cached_modified(self):
+        """A message modified after being returned is built again."""
+
+        class CustomEmailMessage(EmailMessage):
+            def message(self):
+                msg = super().message()
+                msg["X-Custom"] = "value"
+                return msg
+
+        email = CustomEmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        email.message()
+        self.assertEqual(email.message().get_all("X-Custom"), ["value"])
+
+    def test_as_bytes_cached(self):
+        message = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"]).message()
+        message_bytes = message.as_bytes(linesep="\r\n")
+        self.assertIs(message.as_bytes(linesep="\r\n"), message_bytes)
+        self.assertEqual(message.as_bytes(), message_bytes.replace(b"\r\n", b"\n"))
+        message["X-Header"] = "value"
+        self.assertIn(b"X-Header: value\r\n", message.as_bytes(linesep="\r\n"))
+
+    def test_as_bytes_cached_parts_modified(self):
+        """as_bytes() isn't cached across changes to the parts of the message."""
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        email.attach("file.txt", "content")
+        message = email.message()
+        message.as_bytes()
+        body, attachment = message.get_payload()
+        attachment["X-Header"] = "value"
+        self.assertIn(b"X-Header: value\n", message.as_bytes())
+        body.set_payload("Other content")
+        self.assertIn(b"\nOther content", message.as_bytes())
+
+    def test_sanitize_address_cached(self):
+        sanitize_address.cache_clear()
+        for i in range(3):
+            self.assertEqual(
+                sanitize_address(("Tó Example", "to@example.com"), "utf-8"),
+                "=?utf-8?q?T=C3=B3_Example?= <to@example.com>",
+            )
+        info = sanitize_address.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+        # Charset instances can't be hashed, the address isn't cached.
+        self.assertEqual(sanitize_address("to@example.com", charset.Charset("utf-8")), "to@example.com")
+        self.assertEqual(sanitize_address.cache_info().currsize, 1)
+
+    def test_encoded_headers_cached(self):
+        forbid_multi_line_headers.cache_clear()
+        for i in range(3):
+            email = EmailMessage("Sübject", "Content", "Fröm <from@example.com>", ["to@example.com"])
+            message = email.message()
+            self.assertEqual(message["Subject"], "=?utf-8?q?S=C3=BCbject?=")
+            self.assertEqual(message["From"], "=?utf-8?b?RnLDtm0=?= <from@example.com>")
+        info = forbid_multi_line_headers.cache_info()
+        self.assertEqual((info.hits, info.misses), (4, 2))
+
+    def test_mail_merge(self):
+        template = EmailMultiAlternatives(
+            "Hello $name", "Dear $name,\nYour code is ${code}.", "from@example.com", headers={"X-Code": "$code"}
+        )
+        template.attach_alternative("<p>Dear $name</p>", "text/html")
+        template.attach_alternative("Static alternative", "text/x-static")
+        template.attach("file.bin", os.urandom(1000), "application/octet-stream")
+        merge = MailMerge(template)
+        recipients = [
+            ("first@example.com", {"name": "Fïrst", "code": 1}),
+            (["second@example.com", "other@example.com"], {"name": "Second", "code": 2}),
+        ]
+        with mock.patch("flask_mailman.message.Encoders.encode_base64") as encode:
+            self.assertEqual(merge.send(recipients), 2)
+        encode.assert_not_called()
+        first, second = self.mail.outbox
+        self.assertEqual(first.to, ["first@example.com"])
+        self.assertEqual(second.to, ["second@example.com", "other@example.com"])
+        self.assertEqual(template.to, [])
+
+        messages = [email.message() for email in self.mail.outbox]
+        for message, name, code in zip(messages, ("Fïrst", "Second"), ("1", "2")):
+            self.assertEqual(str(make_header(decode_header(message["Subject"]))), "Hello %s" % name)
+            self.assertEqual(message["X-Code"], code)
+            alternatives, attachment = message.get_payload()
+            body, html, static = alternatives.get_payload()
+            self.assertEqual(body.get_payload(decode=True).decode(), "Dear %s,\nYour code is %s." % (name, code))
+            self.assertEqual(html.get_payload(decode=True).decode(), "<p>Dear %s</p>" % name)
+        self.assertIs(messages[0].get_payload()[1], messages[1].get_payload()[1])
+        self.assertIs(messages[0].get_payload()[0].get_payload()[2], messages[1].get_payload()[0].get_payload()[2])
+        self.assertNotEqual(messages[0]["Message-ID"], messages[1]["Message-ID"])
+
+        with self.assertRaises(KeyError):
+            list(merge.messages([("to@example.com", {"name": "Name"})]))
+
+    def test_mail_merge_dollar_signs(self):
+        template = EmailMultiAlternatives("Only $5 for $name", "Only $5 today, $$name, ${name}$", "from@example.com")
+        template.attach_alternative("<p>Only $5 today</p>", "text/html")
+        template.attach_alternative("<p>$$5 for $name</p>", "text/x-name")
+        merge = MailMerge(template)
+        (message,) = merge.messages([("to@example.com", {"name": "Name"})])
+        self.assertEqual(message.subject, "Only $5 for Name")
+        self.assertEqual(message.body, "Only $5 today, $name, Name$")
+        # Alternatives are substituted like the body, and shared unless they
+        # have placeholders.
+        html, name = message.alternatives
+        self.assertIs(html, merge._alternatives[0])
+        self.assertEqual(html.get_payload(), "<p>Only $5 today</p>")
+        self.assertEqual(name, ("<p>$5 for Name</p>", "text/x-name"))
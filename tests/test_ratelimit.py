@@ -0,0 +1,85 @@
+import asyncio
+import time
+from unittest.mock import Mock, patch
+
+from flask_mailman import EmailMessage
+from flask_mailman.backends import smtp
+from flask_mailman.ratelimit import TokenBucket
+from tests import TestCase
+
+
+class TestTokenBucket(TestCase):
+    def test_burst_then_rate(self):
+        now = time.monotonic()
+        with patch("time.monotonic", return_value=now), patch("time.sleep") as sleep:
+            bucket = TokenBucket(rate=2, capacity=3)
+            for i in range(3):
+                bucket.acquire()
+            sleep.assert_not_called()
+            bucket.acquire()
+            sleep.assert_called_once_with(0.5)
+            # Callers queue up behind the reserved tokens.
+            bucket.acquire()
+            sleep.assert_called_with(1.0)
+
+    def test_refill(self):
+        now = time.monotonic()
+        with patch("time.monotonic", return_value=now), patch("time.sleep") as sleep:
+            bucket = TokenBucket(rate=10, capacity=1)
+            bucket.acquire()
+        with patch("time.monotonic", return_value=now + 60), patch("time.sleep") as sleep:
+            bucket.acquire()
+            # Tokens don't accumulate past the capacity.
+            bucket.acquire()
+        sleep.assert_called_once()
+        self.assertAlmostEqual(sleep.call_args.args[0], 0.1)
+
+    def test_acquire_async(self):
+        bucket = TokenBucket(rate=1000, capacity=1)
+
+        async def acquire():
+            start = time.monotonic()
+            for i in range(3):
+                await bucket.acquire_async()
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(asyncio.run(acquire()), 0.0015)
+
+    def test_backend_rate_limited(self):
+        self.mail.state.rate_limit = 5
+        self.mail.state.rate_limit_burst = 1
+        emails = [EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"]) for i in range(3)]
+        backend = smtp.EmailBackend()
+        backend.connection = Mock()
+        with patch.object(backend, "_sendmail", return_value={}), patch("time.sleep") as sleep:
+            self.assertEqual(backend.send_messages(emails), 3)
+        self.assertEqual(sleep.call_count, 2)
+        # Shared by all the backends of the process.
+        self.assertIs(smtp.EmailBackend(host="other.example.com").rate_limiter, backend.rate_limiter)
+
+    def test_rate_limit_per_host(self):
+        self.mail.state.rate_limit = 5
+        self.mail.state.rate_limit_per_host = True
+        limiter = smtp.EmailBackend().rate_limiter
+        self.assertIs(smtp.EmailBackend().rate_limiter, limiter)
+        self.assertIsNot(smtp.EmailBackend(host="other.example.com").rate_limiter, limiter)
+
+    def test_rate_limit_per_relay(self):
+        self.mail.state.rate_limit = 5
+        self.mail.state.rate_limit_per_host = True
+        self.mail.state.relays = ["a.example.com", "b.example.com"]
+        email = EmailMessage("Subject", "Content", "from@example.com", ["to@example.com"])
+        acquired = []
+        for _ in range(2):
+            backend = smtp.EmailBackend()
+            with patch.object(backend, "_connect_to", return_value=Mock()), patch.object(
+                backend, "_sendmail", return_value={}
+            ), patch.object(TokenBucket, "acquire", autospec=True, side_effect=acquired.append):
+                self.assertEqual(backend.send_messages([email]), 1)
+        # One bucket per relay, shared with the backends sending to it directly.
+        self.assertEqual(len(set(map(id, acquired))), 2)
+        self.assertIs(acquired[0], smtp.EmailBackend(host="a.example.com").rate_limiter)
+        self.assertIs(acquired[1], smtp.EmailBackend(host="b.example.com").rate_limiter)
+
+    def test_no_rate_limit(self):
+        self.assertIsNone(smtp.EmailBackend().rate_limiter)
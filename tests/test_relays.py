@@ -0,0 +1,89 @@
+import gc
+import time
+from unittest.mock import Mock, patch
+
+from flask_mailman.backends import smtp
+from flask_mailman.relays import Relay, RelaySet, parse_relay
+from tests import TestCase
+
+
+class TestRelays(TestCase):
+    def test_parse_relay(self):
+        relay = parse_relay("mx.example.com", 25)
+        self.assertEqual((relay.host, relay.port), ("mx.example.com", 25))
+        relay = parse_relay("mx.example.com:2525", 25)
+        self.assertEqual((relay.host, relay.port), ("mx.example.com", 2525))
+        relay = parse_relay("[::1]:2525", 25)
+        self.assertEqual((relay.host, relay.port), ("::1", 2525))
+        relay = parse_relay("::1", 25)
+        self.assertEqual((relay.host, relay.port), ("::1", 25))
+        relay = parse_relay({"host": "mx.example.com", "weight": 3}, 25)
+        self.assertEqual((relay.host, relay.port, relay.weight), ("mx.example.com", 25, 3))
+
+    def test_weighted_round_robin(self):
+        a, b = Relay("a", 25, weight=2), Relay("b", 25)
+        relays = RelaySet([a, b])
+        picks = [relays.candidates()[0].host for i in range(6)]
+        self.assertEqual(picks, ["a", "b", "a", "a", "b", "a"])
+
+    def test_least_outstanding(self):
+        a, b = Relay("a", 25), Relay("b", 25)
+        relays = RelaySet([a, b], strategy="least_outstanding")
+        connection = Mock()
+        relays.connected(a, connection)
+        self.assertEqual(relays.candidates(), [b, a])
+        del connection
+        gc.collect()
+        self.assertEqual(a.outstanding, 0)
+        self.assertEqual(relays.candidates(), [a, b])
+
+    def test_ejected_relays_are_tried_last(self):
+        a, b = Relay("a", 25), Relay("b", 25)
+        relays = RelaySet([a, b], strategy="least_outstanding", eject_time=30)
+        relays.failed(a)
+        self.assertEqual(relays.candidates(), [b, a])
+        with patch("time.monotonic", return_value=time.monotonic() + 31):
+            self.assertEqual(relays.candidates(), [a, b])
+
+    def test_invalid_strategy(self):
+        with self.assertRaises(ValueError):
+            RelaySet([Relay("a", 25)], strategy="random")
+
+    def test_backend_failover(self):
+        self.mail.state.relays = ["down.example.com:25", "up.example.com:2525"]
+        self.mail.state.relay_strategy = "least_outstanding"
+        backend = smtp.EmailBackend()
+        connection = Mock()
+
+        def connect_to(host, port):
+            if host == "down.example.com":
+                raise ConnectionRefusedError()
+            return connection
+
+        with patch.object(backend, "_connect_to", side_effect=connect_to) as connect:
+            backend.open()
+        self.assertIs(backend.connection, connection)
+        self.assertEqual(
+            [call.args for call in connect.call_args_list], [("down.example.com", 25), ("up.example.com", 2525)]
+        )
+        down, up = backend.relays.relays
+        self.assertGreater(down.ejected_until, time.monotonic())
+        self.assertEqual(up.outstanding, 1)
+
+        # The ejected relay isn't tried first anymore.
+        other = smtp.EmailBackend()
+        with patch.object(other, "_connect_to", side_effect=connect_to) as connect:
+            other.open()
+        self.assertEqual(connect.call_args.args, ("up.example.com", 2525))
+        self.assertEqual(connect.call_count, 1)
+
+    def test_backend_all_relays_down(self):
+        self.mail.state.relays = ["a.example.com", "b.example.com"]
+        backend = smtp.EmailBackend()
+        with patch.object(backend, "_connect_to", side_effect=ConnectionRefusedError()):
+            with self.assertRaises(ConnectionRefusedError):
+                backend.open()
+
+    def test_explicit_host_ignores_relays(self):
+        self.mail.state.relays = ["a.example.com"]
+        self.assertIsNone(smtp.EmailBackend(host="localhost").relays)
@@ -0,0 +1,93 @@
+import threading
+import time
+from unittest.mock import Mock, patch
+
+from flask_mailman import EmailMessage
+from flask_mailman.backends import smtp
+from flask_mailman.ratelimit import TokenBucket
+from flask_mailman.scheduler import DomainScheduler, Transaction, recipient_domain
+from tests import TestCase
+
+
+class TestDomainScheduler(TestCase):
+    def drain(self, scheduler):
+        order = []
+        transaction = scheduler.next()
+        while transaction is not None:
+            order.append(transaction.domain)
+            scheduler.done(transaction)
+            transaction = scheduler.next()
+        return order
+
+    def test_recipient_domain(self):
+        self.assertEqual(recipient_domain("Name <to@Example.COM>"), "example.com")
+        self.assertEqual(recipient_domain("to@xn--p8s937b"), "xn--p8s937b")
+
+    def test_interleaves_domains(self):
+        transactions = [Transaction(None, "big.example", ["to@big.example"]) for i in range(4)]
+        transactions.append(Transaction(None, "small.example", ["to@small.example"]))
+        transactions.append(Transaction(None, "other.example", ["to@other.example"]))
+        order = self.drain(DomainScheduler(transactions))
+        self.assertEqual(
+            order, ["big.example", "small.example", "other.example", "big.example", "big.example", "big.example"]
+        )
+
+    def test_domain_concurrency(self):
+        transactions = [Transaction(None, "a.example", []) for i in range(2)] + [Transaction(None, "b.example", [])]
+        scheduler = DomainScheduler(transactions, concurrency=1)
+        first = scheduler.next()
+        second = scheduler.next()
+        self.assertEqual((first.domain, second.domain), ("a.example", "b.example"))
+        scheduler.done(second)
+        released = threading.Timer(0.05, scheduler.done, [first])
+        released.start()
+        # Blocks until the first transaction of a.example is done.
+        self.assertEqual(scheduler.next().domain, "a.example")
+        released.join()
+
+    def test_throttled_domain_does_not_block_others(self):
+        throttled = TokenBucket(rate=20, capacity=1)
+        transactions = [Transaction(None, "slow.example", []) for i in range(2)]
+        transactions += [Transaction(None, "fast.example", []) for i in range(3)]
+        scheduler = DomainScheduler(transactions, rate_limiters={"slow.example": throttled})
+        start = time.monotonic()
+        order = self.drain(scheduler)
+        self.assertEqual(order[:4], ["slow.example", "fast.example", "fast.example", "fast.example"])
+        self.assertEqual(order[4], "slow.example")
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_backend_sends_per_domain(self):
+        self.mail.state.domain_concurrency = 2
+        emails = [
+            EmailMessage("Subject", "Content", "from@example.com", ["a@one.example", "b@two.example", "c@one.example"]),
+            EmailMessage("Subject", "Content", "from@example.com", ["d@two.example"]),
+        ]
+        backend = smtp.EmailBackend()
+        backend.connection = Mock()
+        with patch.object(backend, "_sendmail", return_value={}) as sendmail:
+            with patch.object(emails[0], "message", wraps=emails[0].message) as message:
+                self.assertEqual(backend.send_messages(emails), 2)
+        message.assert_called_once_with()
+        self.assertEqual(
+            [call.args[1] for call in sendmail.call_args_list],
+            [["a@one.example", "c@one.example"], ["b@two.example"], ["d@two.example"]],
+        )
+        self.assertEqual(len(backend.results), 3)
+
+    def test_backend_concurrent_workers(self):
+        self.mail.state.domain_concurrency = 1
+        emails = [
+            EmailMessage("Subject", "Content", "from@example.com", ["to%d@d%d.example" % (i, i % 3)]) for i in range(9)
+        ]
+        backend = smtp.EmailBackend(concurrency=3)
+        sent = []
+
+        def connect(self):
+            connection = Mock()
+            connection.has_extn.return_value = False
+            connection.sendmail.side_effect = lambda from_addr, to_addrs, msg, mail_options: sent.append(to_addrs) or {}
+            return connection
+
+        with patch.object(smtp.EmailBackend, "_connect", connect):
+            self.assertEqual(backend.send_messages(emails), 9)
+        self.assertEqual(len(sent), 9)
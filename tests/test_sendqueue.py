@@ -0,0 +1,62 @@
+import queue
+from unittest.mock import patch
+
+from flask_mailman import EmailMessage
+from flask_mailman.sendqueue import SendQueue
+from tests import TestCase
+
+
+class TestSendQueue(TestCase):
+    def tearDown(self):
+        self.mail.shutdown_queue()
+        super().tearDown()
+
+    def test_enqueue(self):
+        for i in range(5):
+            msg = EmailMessage(subject="testing %d" % i, to=["to@example.com"], body="testing")
+            self.assertTrue(self.mail.enqueue(msg))
+        self.mail.get_send_queue().join()
+        self.assertEqual([msg.subject for msg in self.mail.outbox], ["testing %d" % i for i in range(5)])
+
+    def test_enqueue_without_recipients(self):
+        msg = EmailMessage(subject="testing", to=[], body="testing")
+        self.assertFalse(self.mail.enqueue(msg))
+
+    def test_send_in_batches(self):
+        send_queue = SendQueue(self.app, batch_size=2)
+        msgs = [EmailMessage(subject="testing", to=["to@example.com"], body="testing") for i in range(5)]
+        with patch.object(send_queue, '_start'):
+            for msg in msgs:
+                send_queue.put(msg)
+        with patch('flask_mailman.backends.locmem.EmailBackend.send_messages') as send_messages:
+            send_queue._start()
+            send_queue.join()
+        self.assertEqual([len(call.args[0]) for call in send_messages.call_args_list], [2, 2, 1])
+        send_queue.shutdown()
+
+    def test_shutdown_drains_queue(self):
+        msg = EmailMessage(subject="testing", to=["to@example.com"], body="testing")
+        self.mail.enqueue(msg)
+        self.mail.shutdown_queue()
+        self.assertEqual(len(self.mail.outbox), 1)
+        # A new queue is created after shutdown.
+        self.mail.enqueue(msg)
+        self.mail.get_send_queue().join()
+        self.assertEqual(len(self.mail.outbox), 2)
+
+    def test_full_policy(self):
+        msg = EmailMessage(subject="testing", to=["to@example.com"], body="testing")
+        for policy, expected in [('drop', False), ('raise', queue.Full), ('block', queue.Full)]:
+            with self.subTest(policy=policy):
+                send_queue = SendQueue(self.app, maxsize=1, full_policy=policy, put_timeout=0.01)
+                with patch.object(send_queue, '_start'):
+                    send_queue.put(msg)
+                    if expected is queue.Full:
+                        with self.assertRaises(queue.Full):
+                            send_queue.put(msg)
+                    else:
+                        self.assertIs(send_queue.put(msg), expected)
+
+    def test_invalid_full_policy(self):
+        with self.assertRaises(ValueError):
+            SendQueue(self.app, full_policy='wait')